@@ -0,0 +1,50 @@
+"""
+Compare the nested-loop impedance filter scipy_annotate_eyeblinks used to
+run against the np.searchsorted interval index
+
+usage: python benchmarks/bench_intervals.py
+"""
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper'))
+from intervals import Intervals
+
+
+def filter_legacy(eb_samples, imp_onset, imp_offset):
+    eb_samples_filtered = []
+    for i in range(0, len(eb_samples)):
+        in_range = False
+        for j in range(0, len(imp_onset)):
+            if (imp_onset[j] <= eb_samples[i] <= imp_offset[j]):
+                in_range = True
+        if not in_range:
+            eb_samples_filtered.append(eb_samples[i])
+    return eb_samples_filtered
+
+
+def main(duration=7200., n_imp=40):
+    rng = np.random.RandomState(0)
+    imp_onset = np.sort(rng.uniform(0, duration, n_imp))
+    imp_offset = imp_onset + rng.uniform(5, 60, n_imp)
+    for n_peaks in [1000, 10000, 100000, 1000000]:
+        eb_samples = np.sort(rng.uniform(0, duration, n_peaks))
+
+        t0 = time.time()
+        mask = Intervals(imp_onset, imp_offset).contains(eb_samples)
+        t_index = time.time() - t0
+
+        if n_peaks <= 100000:
+            t0 = time.time()
+            legacy = filter_legacy(eb_samples.tolist(), imp_onset.tolist(), imp_offset.tolist())
+            t_legacy = '%8.4f s' % (time.time() - t0)
+            assert legacy == eb_samples[~mask].tolist()
+        else:
+            t_legacy = '  (skipped)'
+        print('%8d peaks, %d intervals: nested loop %s, searchsorted %8.4f s'
+              % (n_peaks, n_imp, t_legacy, t_index))
+
+
+if __name__ == '__main__':
+    main()
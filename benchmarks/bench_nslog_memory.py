@@ -0,0 +1,60 @@
+"""
+Compare peak memory of the ways to parse the ns event log. Each path runs
+in its own subprocess so the reported peak RSS is not shared between them
+
+usage: python benchmarks/bench_nslog_memory.py [n_lines] [chunksize]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper'))
+import extract_nslog_event
+import synthetic
+from bench_nslog_parser import create_df_legacy
+
+PATHS = ['baseline', 'list-of-lists', 'dataframe', 'chunked']
+
+
+def run(path, fname, chunksize):
+    """
+    Run one parsing path the way walkthrough.py would and keep its results
+    alive until the end, like the session does
+    """
+    if path == 'list-of-lists':
+        results = create_df_legacy(fname)
+    elif path == 'dataframe':
+        nsdata, df_lst, df_plst, df_tlst, df_slst = extract_nslog_event.create_df(fname)
+        results = [nsdata, df_tlst, extract_nslog_event.find_impedances(nsdata)]
+    elif path == 'chunked':
+        results = extract_nslog_event.create_df_chunked(fname, chunksize)
+    else:
+        results = None
+    # ru_maxrss is in kB on linux
+    return results, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main(n_lines=1000000, chunksize=100000):
+    fname = os.path.join(tempfile.mkdtemp(), 'sfv_eeg_999ts_nsevent')
+    print('writing synthetic log with ' + str(n_lines) + ' lines...')
+    synthetic.write_nslog(fname, n_lines=n_lines)
+    print('log size: %.1f MB' % (os.path.getsize(fname) / 1024. ** 2))
+
+    peaks = {}
+    for path in PATHS:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run',
+                                       path, fname, str(chunksize)])
+        peaks[path] = float(out.decode().strip().splitlines()[-1])
+    for path in PATHS[1:]:
+        print('%-14s peak RSS %7.1f MB (+%.1f MB over imports)'
+              % (path, peaks[path], peaks[path] - peaks['baseline']))
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        results, peak = run(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        print(peak)
+    else:
+        main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,84 @@
+"""
+Compare the columnar ns event log parser against the previous line-by-line
+implementation on a synthetic log
+
+usage: python benchmarks/bench_nslog_parser.py [n_lines]
+"""
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper'))
+import extract_nslog_event
+import synthetic
+
+
+def create_df_legacy(ns_eventlog):
+    """
+    The loop-based create_df this repo used before the columnar parser,
+    kept here as the reference for timings and output checks
+    """
+    with open(ns_eventlog) as fp:
+        nsdata = fp.readlines()
+    nsdata = [i.split('\t') for i in nsdata]
+    for i in range(0, len(nsdata)):
+        try:
+            nsdata[i][4] = nsdata[i][4][1:]
+        except IndexError:
+            pass
+    for i in range(0, len(nsdata)):
+        try:
+            hh = int(nsdata[i][4][0:2]) * 3600000
+            mm = int(nsdata[i][4][3:5]) * 60000
+            ss = int(nsdata[i][4][6:8]) * 1000
+            ms = int(nsdata[i][4][9:12])
+            nsdata[i][4] = hh + mm + ss + ms
+        except IndexError:
+            pass
+        except ValueError:
+            pass
+    col_names = ['code', 'label', 'onset', 'cond', 'indx']
+    rows = []
+    for i in range(0, len(nsdata)):
+        try:
+            if nsdata[i][0][1:] == 'lst':
+                rows.append([nsdata[i][0], nsdata[i][1], nsdata[i][4], nsdata[i][7], nsdata[i][9]])
+        except IndexError:
+            pass
+    df_lst = pd.DataFrame(rows, columns=col_names)
+    subs = []
+    for code in ['plst', 'tlst', 'slst']:
+        rows = []
+        for i in range(0, len(df_lst)):
+            if df_lst.iloc[i]['code'] == code:
+                rows.append([df_lst.iloc[i][c] for c in col_names])
+        subs.append(pd.DataFrame(rows, columns=col_names))
+    return [nsdata, df_lst] + subs
+
+
+def main(n_lines=1000000):
+    fname = os.path.join(tempfile.mkdtemp(), 'sfv_eeg_999ts_nsevent')
+    print('writing synthetic log with ' + str(n_lines) + ' lines...')
+    synthetic.write_nslog(fname, n_lines=n_lines)
+
+    t0 = time.time()
+    legacy = create_df_legacy(fname)
+    t_legacy = time.time() - t0
+
+    t0 = time.time()
+    columnar = extract_nslog_event.create_df(fname)
+    t_columnar = time.time() - t0
+
+    # the columnar parser stores compact dtypes, compare the values as text
+    for old, new in zip(legacy[1:], columnar[1:]):
+        pd.testing.assert_frame_equal(old.astype(str), new.astype(str))
+
+    print('legacy create_df:   %.2f s' % t_legacy)
+    print('columnar create_df: %.2f s' % t_columnar)
+    print('speedup: %.1fx' % (t_legacy / t_columnar))
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
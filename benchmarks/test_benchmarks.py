@@ -0,0 +1,296 @@
+"""
+Runtime and memory of the helper functions and the whole pipeline on
+synthetic recordings and event logs (see helper/synthetic.py) of growing size,
+with pytest-benchmark. The peak RSS above the start of each call is stored
+as extra_info['peak_rss_mb'] of every benchmark
+
+usage: python -m pytest benchmarks/test_benchmarks.py --benchmark-autosave
+       python -m pytest benchmarks/test_benchmarks.py --benchmark-compare --benchmark-compare-fail=mean:25%
+       (add -k "not pipeline" to skip the full pipeline runs)
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import mne
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper'))
+import bad_channels
+import epoch_store
+import erp_export
+import extract_nslog_event
+import filtering
+import grand_average
+import meta_index
+import pipeline
+import reject
+import scipy_eog
+import synthetic
+from intervals import Intervals
+from profiling import StageProfiler
+
+N_LINES = [10000, 100000, 1000000]
+DURATIONS = [300., 900., 1800.]
+PIPELINE_DURATIONS = [300., 900.]
+# one channel of every kind 'bad_channels' should find, away from the eye channels
+BAD_CHANNELS = dict(E20='flat', E40='noisy', E60='line', E80='uncorrelated')
+
+mne.set_log_level('error')
+
+
+def measure(benchmark, func, *args, **kwargs):
+    """
+    Benchmark func, then run it once more under a StageProfiler for its peak RSS
+    """
+    rounds = kwargs.pop('rounds', None)
+    if rounds:
+        result = benchmark.pedantic(func, args, rounds=rounds, iterations=1)
+    else:
+        result = benchmark(func, *args)
+    with StageProfiler() as prof:
+        with prof.stage(func.__name__) as record:
+            func(*args)
+    benchmark.extra_info['peak_rss_mb'] = (record['peak_rss'] - record['rss_start']) / 1024. ** 2
+    return result
+
+
+@pytest.fixture(scope='module', params=N_LINES)
+def nslog(request, tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('nslog') / 'sfv_eeg_999ts_nsevent')
+    return synthetic.write_nslog(fname, n_lines=request.param)
+
+
+@pytest.fixture(scope='module', params=DURATIONS)
+def session_raw(request):
+    session = synthetic.make_session(duration=request.param, bad_channels=BAD_CHANNELS,
+                                     n_saccades=int(request.param // 30))
+    raw = synthetic.make_raw(session)
+    raw = mne.set_bipolar_reference(raw, ['E8'], ['E126'], ['EB'])
+    raw.set_channel_types({'EB': 'eog'})
+    return session, raw
+
+
+def test_create_df(benchmark, nslog):
+    measure(benchmark, extract_nslog_event.create_df, nslog)
+
+
+def test_create_df_chunked(benchmark, nslog):
+    measure(benchmark, extract_nslog_event.create_df_chunked, nslog)
+
+
+def test_create_df_onset(benchmark, nslog):
+    df_lst = extract_nslog_event.create_df(nslog)[1]
+    measure(benchmark, extract_nslog_event.create_df_onset, df_lst)
+
+
+def test_find_impedances(benchmark, nslog):
+    nsdata = extract_nslog_event.create_df(nslog)[0]
+    measure(benchmark, extract_nslog_event.find_impedances, nsdata)
+
+
+@pytest.mark.parametrize('n_checks', [1000, 100000])
+def test_match_impedances(benchmark, n_checks):
+    rng = np.random.RandomState(0)
+    checks = np.cumsum(rng.uniform(20000, 60000, n_checks))
+    ends = checks + rng.uniform(5000, 15000, n_checks)
+    # pauses: restarted checks (extra onsets) and extra offsets
+    onset = np.concatenate([checks, checks[::50] + 1000])
+    offset = np.concatenate([ends, ends[::70] + 2000])
+    result = benchmark(extract_nslog_event.match_impedances, rng.permutation(onset), rng.permutation(offset))
+    for found, expected in zip(result, [checks, ends, [], ends[::70] + 2000, checks[::50] + 1000]):
+        np.testing.assert_array_equal(found, expected)
+
+
+def test_assign_event_id(benchmark, session_raw, tmp_path):
+    session, raw = session_raw
+    ns_eventlog = synthetic.write_session_nslog(str(tmp_path / 'sfv_eeg_999ts_nsevent'), session)
+    df_tlst = extract_nslog_event.create_df(ns_eventlog)[3]
+    events = mne.find_events(raw, stim_channel='tlst')
+    # assign_event_id writes into events, so each round gets a fresh copy
+    measure(benchmark, lambda: extract_nslog_event.assign_event_id(df_tlst, events.copy(),
+                                                                   raw.info['sfreq']))
+
+
+def test_filter_mne(benchmark, session_raw):
+    session, raw = session_raw
+    measure(benchmark, lambda: raw.copy().filter(1., 30.), rounds=3)
+
+
+def test_filter_raw(benchmark, session_raw):
+    session, raw = session_raw
+    filtered = measure(benchmark, lambda: filtering.filter_raw(raw.copy(), 1., 30., n_jobs=os.cpu_count()),
+                       rounds=3)
+    # the same as raw.filter up to float32 rounding
+    picks = mne.pick_types(raw.info, eeg=True)
+    expected = raw.copy().filter(1., 30.).get_data(picks)
+    np.testing.assert_allclose(filtered.get_data(picks), expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('n_times', [15000 * 4, 15000 * 4 + 1, 15000 * 4 + 300])
+def test_filter_data_chunked(benchmark, n_times):
+    # 60 s chunks at 250 Hz are 15000 samples: the last chunk is whole, one sample or shorter than the kernel
+    data = np.random.RandomState(0).standard_normal((16, n_times)).astype(np.float32)
+    chunked = measure(benchmark, lambda: filtering.filter_data(data, 250., 1., 30., out=np.empty_like(data),
+                                                               chunk_duration=60.))
+    expected = filtering.filter_data(data, 250., 1., 30., out=np.empty_like(data))
+    np.testing.assert_allclose(chunked, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+def test_find_bad_channels(benchmark, session_raw):
+    session, raw = session_raw
+    raw = raw.copy().set_montage('GSN-HydroCel-128', on_missing='ignore')
+    table = measure(benchmark, bad_channels.find_bad_channels, raw, rounds=3)
+    assert sorted(table.loc[table['bad'], 'ch_name']) == sorted(BAD_CHANNELS)
+
+
+def test_find_eyeblinks(benchmark, session_raw):
+    session, raw = session_raw
+    measure(benchmark, scipy_eog.find_eyeblinks, raw, 'EB')
+
+
+def test_scipy_annotate_eyeblinks(benchmark, session_raw):
+    session, raw = session_raw
+    measure(benchmark, scipy_eog.scipy_annotate_eyeblinks, raw.copy(), 'EB', 100,
+            session['imp_onset'], session['imp_offset'], rounds=3)
+
+
+def test_eye_annotations(benchmark, session_raw):
+    session, raw = session_raw
+    annotations = measure(benchmark, scipy_eog.eye_annotations, raw, 'EB', ('E125', 'E128'),
+                          session['imp_onset'], session['imp_offset'])
+    # every blink (centre) and saccade (0.4 s) away from the impedance checks is found, and nothing else
+    checks = Intervals(np.asarray(session['imp_onset']) - 0.5, np.asarray(session['imp_offset']) + 0.5)
+    for description, start, stop in [('bad eye', session['blinks'], session['blinks']),
+                                     ('bad saccade', session['saccades'], session['saccades'] + 0.4)]:
+        found = annotations.description == description
+        found = Intervals(annotations.onset[found], annotations.onset[found] + annotations.duration[found])
+        clean = ~checks.overlaps(start, stop)
+        assert found.overlaps(start[clean], stop[clean]).all()
+        assert Intervals(start, stop).overlaps(found.onset, found.offset).all()
+
+
+QUERIES = ["label=='lstS' and cond==" + str(c) for c in range(1, 5)] + \
+    ["cond in (1, 2) and indx==" + str(i) for i in (100, 200, 300)] + ["not cond==1 or indx!=100"]
+
+
+def test_metadata_query_pandas(benchmark, nslog):
+    df_tlstS = extract_nslog_event.create_df_onset(extract_nslog_event.create_df(nslog)[3])
+    benchmark(lambda: [df_tlstS.query(q).index.to_numpy() for q in QUERIES])
+
+
+def test_metadata_query_index(benchmark, nslog):
+    df_tlstS = extract_nslog_event.create_df_onset(extract_nslog_event.create_df(nslog)[3])
+
+    def build_and_query():
+        index = meta_index.MetadataIndex(df_tlstS)
+        return [index.query(q) for q in QUERIES]
+    for positions, query in zip(benchmark(build_and_query), QUERIES):
+        np.testing.assert_array_equal(positions, np.flatnonzero(df_tlstS.eval(query)))
+
+
+@pytest.mark.parametrize('n_subjects', [10, 100])
+def test_grand_average(benchmark, n_subjects):
+    info = mne.create_info(['E' + str(i + 1) for i in range(128)], 250., 'eeg')
+    rng = np.random.RandomState(0)
+    evokeds = [dict((name, mne.EvokedArray(rng.standard_normal((128, 263)) * 1e-6, info, tmin=-0.25,
+                                           comment=name, nave=50))
+                    for name in erp_export.CONDITIONS) for _ in range(5)]
+
+    def accumulate():
+        grand = grand_average.GrandAverage(contrasts=erp_export.CONTRASTS)
+        for i in range(n_subjects):
+            grand.add('s' + str(i), evokeds[i % len(evokeds)])
+        return grand
+    grand = measure(benchmark, accumulate, rounds=3)
+    from scipy.stats import ttest_1samp
+    subjects = [evokeds[i % len(evokeds)] for i in range(n_subjects)]
+    expected = mne.grand_average([subject['highcosval'] for subject in subjects])
+    np.testing.assert_allclose(grand.mean('highcosval'), expected.data, rtol=0,
+                               atol=1e-10 * np.abs(expected.data).max())
+    differences = np.array([subject['highcosval'].data - subject['lowcosval'].data for subject in subjects])
+    np.testing.assert_allclose(grand.sem('highcosval - lowcosval'),
+                               differences.std(axis=0, ddof=1) / np.sqrt(n_subjects), rtol=1e-8)
+    np.testing.assert_allclose(grand.tmap('highcosval - lowcosval'),
+                               ttest_1samp(differences, 0., axis=0).statistic, rtol=1e-8)
+
+
+@pytest.fixture(scope='module')
+def ar_epochs():
+    session = synthetic.make_session(duration=PIPELINE_DURATIONS[0])
+    raw = synthetic.make_raw(session)
+    raw.set_montage(mne.channels.make_standard_montage('GSN-HydroCel-128'), on_missing='ignore')
+    # the reference has no position in the 128 channel montage
+    raw.info['bads'] = ['E129']
+    raw.filter(1., 30.)
+    events = mne.find_events(raw, stim_channel='tlst')
+    picks = mne.pick_types(raw.info, eeg=True, exclude='bads')
+    return mne.Epochs(raw, events, tmin=-0.25, tmax=0.8, picks=picks, baseline=(-0.25, 0), preload=True)
+
+
+def test_grouped_evokeds(benchmark, ar_epochs):
+    epochs = _with_conditions(ar_epochs)
+    evokeds = measure(benchmark, erp_export.grouped_evokeds, epochs, erp_export.CONDITIONS, rounds=3)
+    index = meta_index.MetadataIndex(epochs.metadata)
+    for name, cond in erp_export.CONDITIONS.items():
+        expected = epochs['cond==' + str(cond)].average()
+        for evoked in [evokeds[name], meta_index.average(epochs, index.select(cond=cond))]:
+            assert evoked.ch_names == expected.ch_names and evoked.nave == expected.nave
+            np.testing.assert_allclose(evoked.data, expected.data, rtol=1e-10, atol=1e-20)
+
+
+def test_epoch_store(benchmark, ar_epochs, tmp_path):
+    # the same averages read back one chunk of trials at a time from the compressed store
+    root = epoch_store.write_epochs(_with_conditions(ar_epochs), str(tmp_path / 'store-epo'))
+
+    def read_averages():
+        with epoch_store.EpochStore(root) as store:
+            return store.evokeds(erp_export.CONDITIONS)
+    evokeds = measure(benchmark, read_averages, rounds=3)
+    # the data is stored in float32
+    expected = erp_export.grouped_evokeds(_with_conditions(ar_epochs), erp_export.CONDITIONS)
+    for name, evoked in evokeds.items():
+        assert evoked.ch_names == expected[name].ch_names and evoked.nave == expected[name].nave
+        np.testing.assert_allclose(evoked.data, expected[name].data, rtol=0,
+                                   atol=1e-6 * np.abs(expected[name].data).max())
+
+
+def _with_conditions(epochs):
+    epochs = epochs.copy()
+    epochs.metadata = pd.DataFrame(dict(cond=1 + np.arange(len(epochs)) % 4))
+    return epochs
+
+
+def test_autoreject_default(benchmark, ar_epochs):
+    # the walkthrough's call
+    from autoreject import AutoReject
+    measure(benchmark, lambda: AutoReject(random_state=0, verbose=False).fit(ar_epochs), rounds=1)
+
+
+def test_autoreject_adaptive(benchmark, ar_epochs):
+    measure(benchmark, reject.fit_autoreject, ar_epochs, os.cpu_count(), 0, rounds=1)
+
+
+def test_autoreject_thresholds(benchmark, ar_epochs):
+    ar = reject.fit_autoreject(ar_epochs, random_state=0)
+    table = reject.threshold_table(ar, ar_epochs)
+    clean = measure(benchmark, lambda: reject.from_thresholds(table, ar_epochs).transform(ar_epochs), rounds=1)
+    # the rebuilt AutoReject drops and repairs the same epochs as the fitted one
+    expected = ar.transform(ar_epochs)
+    np.testing.assert_array_equal(clean.selection, expected.selection)
+    np.testing.assert_allclose(clean.get_data(), expected.get_data(), rtol=1e-10, atol=1e-20)
+
+
+@pytest.mark.parametrize('duration', PIPELINE_DURATIONS)
+def test_pipeline(benchmark, tmp_path, duration):
+    raw_fname = str(tmp_path / 'sfv_eeg_999ts.raw')
+    ns_eventlog = str(tmp_path / 'sfv_eeg_999ts_nsevent')
+    synthetic.write_session(raw_fname, ns_eventlog, duration=duration)
+    params = dict(autoreject=False, random_state=0)
+
+    def run():
+        status = pipeline.run_subject('sfv_eeg_999ts', raw_fname, ns_eventlog, str(tmp_path),
+                                      params=params)
+        assert status['status'] == 'ok', status['error']
+        return status
+    measure(benchmark, run, rounds=1)
+
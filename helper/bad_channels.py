@@ -0,0 +1,190 @@
+"""
+Bad channel detection from the data, instead of a hand-typed list or clicking
+through raw.plot. One chunked pass over the (unfiltered) recording cuts it
+into short windows, and the FFT of every window gives each channel's
+amplitude in the band of interest, its high-frequency to in-band amplitude
+ratio and its in-band correlation with its nearest neighbours on the montage.
+A channel is bad if it is flat, if its amplitude or its high-frequency ratio
+is an outlier among the channels (robust z-score of its median over the
+windows), or if it hardly correlates with its neighbours
+
+    table = find_bad_channels(raw, exclude=(imp_onset, imp_offset))
+    raw.info['bads'] += bad_names(table)
+"""
+import warnings
+import numpy as np
+import pandas as pd
+from intervals import Intervals
+
+REASONS = ('flat', 'deviation', 'hf_noise', 'correlation')
+# smallest spread of the log amplitudes and log high-frequency ratios across
+# channels: with z_thresh=5, a channel is an outlier from 1.65 times the median
+MIN_LOG_SCALE = 0.1
+
+
+def find_bad_channels(inst, picks=None, window=1., chunk_duration=60., band=(1., 30.), hf_freq=50.,
+                      n_neighbors=6, z_thresh=5., corr_thresh=0.4, flat_thresh=1e-7, exclude=None):
+    """
+    Find bad channels in one pass over the recording
+
+    Parameters (defaults)
+    ---------------------
+    inst: Raw (preloaded or not) or lowmem.MmapRaw, with channel positions
+        for the correlation check
+    picks: list of int (None)
+        channels to check, defaults to all eeg channels (bad or not)
+    window: float (1.)
+        length of the windows in seconds
+    chunk_duration: float (60.)
+        seconds read at a time
+    band: (float, float) ((1., 30.))
+        band of the amplitude and correlation checks, in Hz
+    hf_freq: float (50.)
+        the high-frequency noise is the amplitude above hf_freq Hz
+    n_neighbors: int (6)
+        nearest channels on the montage each channel is correlated with
+    z_thresh: float (5.)
+        robust z-score beyond which a channel's amplitude (either way) or
+        high-frequency ratio (upwards) is an outlier
+    corr_thresh: float (0.4)
+        channels whose median correlation with their neighbours is below
+        it are bad
+    flat_thresh: float (1e-7)
+        channels whose median standard deviation in a window is below it
+        (in V) are flat
+    exclude: (onset, offset) (None)
+        periods in seconds from the first sample to leave out, ie. the
+        impedance checks
+
+    Returns
+    -------
+    table: pandas dataframe with one row per channel: ch_name, std (V),
+        amplitude (in-band rms, V), amplitude_z, hf_ratio, hf_z,
+        correlation, n_neighbors, bad and reason (the REASONS it was
+        flagged for, joined by spaces, '' if good)
+    """
+    import mne
+    from scipy.fft import rfft, rfftfreq
+    sfreq = inst.info['sfreq']
+    if picks is None:
+        picks = mne.pick_types(inst.info, meg=False, eeg=True, exclude=[])
+    picks = np.asarray(picks)
+    ch_names = [inst.info['ch_names'][p] for p in picks]
+    n_channels = len(picks)
+    n_times = inst.n_times
+    size = int(round(window * sfreq))
+    chunk = max(int(round(chunk_duration * sfreq)) // size, 1) * size
+    freqs = rfftfreq(size, 1. / sfreq)
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+    high = freqs >= hf_freq
+    neighbors = channel_neighbors(inst.info, picks, n_neighbors)
+    has_neighbor = neighbors >= 0
+    # centred sample times of a window, to remove each window's linear trend
+    ramp = np.arange(size, dtype=np.float32) - (size - 1) / 2.
+    ramp /= np.sqrt(np.dot(ramp, ramp))
+
+    windows = []
+    stats = dict(std=[], amplitude=[], hf=[], correlation=[])
+    print('checking ' + str(n_channels) + ' channels for bad ones...')
+    for start in range(0, n_times - size + 1, chunk):
+        stop = start + (min(start + chunk, n_times) - start) // size * size
+        data = inst.get_data(picks=picks, start=start, stop=stop).astype(np.float32)
+        data = data.reshape(n_channels, -1, size)
+        windows.append(np.arange(start, stop, size))
+        data -= data.mean(axis=2, keepdims=True)
+        stats['std'].append(np.sqrt(np.mean(data ** 2, axis=2)))
+        data -= np.dot(data, ramp)[:, :, np.newaxis] * ramp
+        spectrum = rfft(data, axis=2)
+        band_spectrum = spectrum[:, :, in_band]
+        amplitude = np.sqrt(np.sum(band_spectrum.real ** 2 + band_spectrum.imag ** 2, axis=2))
+        stats['amplitude'].append(amplitude)
+        high_spectrum = spectrum[:, :, high]
+        stats['hf'].append(np.sqrt(np.sum(high_spectrum.real ** 2 + high_spectrum.imag ** 2, axis=2)))
+        # in-band correlation with each neighbour from the cross spectrum
+        corr = np.full(neighbors.shape + (data.shape[1],), np.nan, dtype=np.float32)
+        for k in range(neighbors.shape[1]):
+            rows = np.flatnonzero(has_neighbor[:, k])
+            other = neighbors[rows, k]
+            cross = np.sum(band_spectrum[rows].real * band_spectrum[other].real
+                           + band_spectrum[rows].imag * band_spectrum[other].imag, axis=2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                corr[rows, k] = cross / (amplitude[rows] * amplitude[other])
+        stats['correlation'].append(corr)
+    if not windows:
+        raise ValueError('recording shorter than one window')
+    windows = np.concatenate(windows)
+    keep = np.ones(len(windows), bool)
+    if exclude is not None and len(exclude[0]):
+        keep = ~Intervals(exclude[0], exclude[1]).overlaps(windows / sfreq, (windows + size) / sfreq)
+    if not keep.any():
+        raise ValueError('every window overlaps an excluded period')
+    for name in stats:
+        stats[name] = np.concatenate(stats[name], axis=-1)[..., keep]
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        # all-NaN slices (flat channels, channels without neighbours) are expected
+        warnings.simplefilter('ignore', RuntimeWarning)
+        std = np.median(stats['std'], axis=1)
+        # rms of the in-band part of the one-sided spectrum
+        amplitude = np.median(stats['amplitude'], axis=1) * np.sqrt(2.) / size
+        hf_ratio = np.median(stats['hf'] / stats['amplitude'], axis=1)
+        correlation = np.nanmedian(np.nanmedian(stats['correlation'], axis=1), axis=1)
+    flat = std < flat_thresh
+    # z-scores of the logs, with a spread of at least MIN_LOG_SCALE so that
+    # very similar channels are not outliers for a few percent
+    amplitude_z = _robust_z(np.log(np.maximum(amplitude, 1e-30)), ~flat, MIN_LOG_SCALE)
+    hf_z = np.full(n_channels, np.nan)
+    if high.any():
+        hf_z = _robust_z(np.log(np.maximum(hf_ratio, 1e-30)), ~flat, MIN_LOG_SCALE)
+
+    flags = dict(flat=flat, deviation=~flat & (np.abs(amplitude_z) > z_thresh),
+                 hf_noise=~flat & (hf_z > z_thresh), correlation=~flat & (correlation < corr_thresh))
+    reason = [' '.join(r for r in REASONS if flags[r][c]) for c in range(n_channels)]
+    table = pd.DataFrame(dict(ch_name=ch_names, std=std, amplitude=amplitude, amplitude_z=amplitude_z,
+                              hf_ratio=hf_ratio, hf_z=hf_z, correlation=correlation,
+                              n_neighbors=(neighbors >= 0).sum(axis=1)))
+    table['bad'] = np.array([r != '' for r in reason], bool)
+    table['reason'] = reason
+    print(str(table['bad'].sum()) + ' bad channels: ' + ' '.join(bad_names(table)))
+    return table
+
+
+def bad_names(table):
+    """
+    Names of the bad channels of a 'find_bad_channels' table
+    """
+    return list(table.loc[table['bad'], 'ch_name'])
+
+
+def channel_neighbors(info, picks, n_neighbors=6):
+    """
+    Nearest channels of every pick by the distance of their montage positions
+
+    Returns
+    -------
+    neighbors: int array (n_picks, n_neighbors) of indices into picks, -1
+        for channels without a position
+    """
+    pos = np.array([info['chs'][p]['loc'][:3] for p in picks], dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(pos).all(axis=1) & (np.abs(pos).sum(axis=1) > 0))
+    n_neighbors = min(n_neighbors, len(valid) - 1)
+    neighbors = np.full((len(picks), max(n_neighbors, 0)), -1)
+    if n_neighbors < 1:
+        return neighbors
+    dist = np.linalg.norm(pos[valid, None] - pos[None, valid], axis=2)
+    np.fill_diagonal(dist, np.inf)
+    neighbors[valid] = valid[np.argsort(dist, axis=1)[:, :n_neighbors]]
+    return neighbors
+
+
+def _robust_z(values, mask, min_scale=0.):
+    """
+    (values - median) / (1.4826 MAD), with median and MAD over values[mask]
+    and the scale at least min_scale
+    """
+    ref = values[mask]
+    if not len(ref):
+        return np.full(len(values), np.nan)
+    median = np.median(ref)
+    scale = max(1.4826 * np.median(np.abs(ref - median)), min_scale, np.finfo(float).eps)
+    return (values - median) / scale
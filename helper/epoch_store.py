@@ -0,0 +1,253 @@
+"""
+On-disk epoch store for out-of-core analysis. The epochs data goes to an HDF5
+array (h5py) chunked by trials and gzip-compressed, next to the trial
+metadata (Parquet) and the measurement info (fif). Condition subsets are
+read lazily, one chunk of trials at a time, and averaged block by block, so
+the epochs of many subjects can be analysed without loading any of them
+
+    write_epochs(epochs_clean, 'results/sfv_eeg_011ts/sfv_eeg_011ts-epo')
+    store = EpochStore('results/sfv_eeg_011ts/sfv_eeg_011ts-epo')
+    evoked = store.average(store.query("cond==1"))
+    evokeds = store.evokeds({'highcosval': 1, 'lowcosval': 2})
+    data = store.get_data(store.query("cond in (1, 2)"), picks=['E62', 'E72'])
+
+A store is a directory with data.h5 (epochs, events, selection, times),
+metadata.parquet (metadata.csv if pyarrow is missing) and info.fif
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from meta_index import MetadataIndex
+
+
+def write_epochs(epochs, root, chunk_epochs=16, dtype='float32', compression='gzip', level=4):
+    """
+    Write preloaded epochs to a store, chunk by chunk
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs (preloaded) with or without metadata
+    root: str
+        directory of the store, replaced if it exists
+    chunk_epochs: int (16)
+        trials per HDF5 chunk, the unit of every read
+    dtype: str ('float32')
+        dtype the data is stored in (float32 halves the size of mne's float64)
+    compression: str ('gzip')
+        HDF5 compression filter, None for none
+    level: int (4)
+        gzip level
+
+    Returns
+    -------
+    root: str
+    """
+    import h5py
+    import mne
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    data = epochs.get_data(copy=False)
+    n_epochs = len(data)
+    chunks = (max(min(chunk_epochs, n_epochs), 1),) + data.shape[1:]
+    tmp = os.path.join(root, 'data.h5.tmp')
+    with h5py.File(tmp, 'w') as f:
+        dset = f.create_dataset('epochs', shape=data.shape, dtype=dtype, chunks=chunks,
+                                compression=compression, compression_opts=level if compression == 'gzip' else None,
+                                shuffle=compression is not None)
+        # whole chunks at a time, so each is compressed once
+        for start in range(0, n_epochs, chunks[0]):
+            dset[start:start + chunks[0]] = data[start:start + chunks[0]]
+        f.create_dataset('events', data=epochs.events)
+        f.create_dataset('selection', data=epochs.selection)
+        f.create_dataset('times', data=epochs.times)
+        f.attrs['event_id'] = json.dumps(epochs.event_id)
+    os.replace(tmp, os.path.join(root, 'data.h5'))
+    mne.io.write_info(os.path.join(root, 'info.fif'), epochs.info)
+    for ext in ['.parquet', '.csv']:
+        if os.path.exists(os.path.join(root, 'metadata' + ext)):
+            os.remove(os.path.join(root, 'metadata' + ext))
+    if epochs.metadata is not None:
+        try:
+            epochs.metadata.to_parquet(os.path.join(root, 'metadata.parquet'), index=False)
+        except ImportError:
+            epochs.metadata.to_csv(os.path.join(root, 'metadata.csv'), index=False)
+    return root
+
+
+class EpochStore(object):
+    """
+    Lazy reader of a store written by 'write_epochs'. Only the metadata is
+    read when it is opened; data is read per chunk of trials
+
+    Parameters
+    ----------
+    root: str, directory of the store
+    """
+    def __init__(self, root):
+        import h5py
+        self.root = root
+        self._file = h5py.File(os.path.join(root, 'data.h5'), 'r')
+        self._data = self._file['epochs']
+        self.times = self._file['times'][:]
+        self.events = self._file['events'][:]
+        self.selection = self._file['selection'][:]
+        self.metadata = None
+        if os.path.exists(os.path.join(root, 'metadata.parquet')):
+            self.metadata = pd.read_parquet(os.path.join(root, 'metadata.parquet'))
+        elif os.path.exists(os.path.join(root, 'metadata.csv')):
+            self.metadata = pd.read_csv(os.path.join(root, 'metadata.csv'))
+        self._info = None
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._data.shape[0]
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def info(self):
+        if self._info is None:
+            import mne
+            self._info = mne.io.read_info(os.path.join(self.root, 'info.fif'), verbose=False)
+        return self._info
+
+    @property
+    def ch_names(self):
+        return self.info['ch_names']
+
+    @property
+    def chunk_epochs(self):
+        return self._data.chunks[0]
+
+    @property
+    def index(self):
+        """
+        'meta_index.MetadataIndex' of the metadata, built on first use
+        """
+        if self._index is None:
+            self._index = MetadataIndex(self.metadata)
+        return self._index
+
+    def query(self, expr):
+        """
+        Positions of the epochs matching a metadata query, see 'meta_index'
+        """
+        return self.index.query(expr)
+
+    def select(self, **terms):
+        """
+        Positions of the epochs whose metadata match every term, see 'meta_index'
+        """
+        return self.index.select(**terms)
+
+    def iter_blocks(self, positions=None, picks=None):
+        """
+        Read the epochs at positions one HDF5 chunk at a time
+
+        Yields
+        ------
+        positions: int array of the epochs in the block
+        data: float array (n_block, n_picks, n_times)
+        """
+        positions = np.arange(len(self)) if positions is None else np.unique(positions)
+        picks = self._picks(picks)
+        chunk = positions // self.chunk_epochs
+        bounds = np.flatnonzero(np.diff(chunk)) + 1
+        for block in np.split(positions, bounds):
+            if not len(block):
+                continue
+            start, stop = block[0], block[-1] + 1
+            # one contiguous read of the chunk's rows, subset in memory
+            data = self._data[start:stop]
+            data = data[block - start] if len(block) < stop - start else data
+            yield block, data if picks is None else data[:, picks]
+
+    def get_data(self, positions=None, picks=None):
+        """
+        Data of the epochs at positions (sorted, all if None) and channels
+
+        Returns
+        -------
+        data: float array (n_epochs, n_picks, n_times), in the stored dtype
+        """
+        blocks = [data for block, data in self.iter_blocks(positions, picks)]
+        if not blocks:
+            n_picks = len(self.ch_names) if picks is None else len(self._picks(picks))
+            return np.zeros((0, n_picks, len(self.times)), self._data.dtype)
+        return np.concatenate(blocks)
+
+    def average(self, positions=None, comment=None):
+        """
+        Average of the epochs at positions, summed block by block in float64.
+        like Epochs.average, the data channels are kept (bad ones marked) and
+        projections are in the info, not applied
+
+        Returns
+        -------
+        evoked: mne.EvokedArray
+        """
+        positions = np.arange(len(self)) if positions is None else np.unique(positions)
+        if not len(positions):
+            raise ValueError('no epochs to average')
+        total = np.zeros((len(self.ch_names), len(self.times)))
+        for block, data in self.iter_blocks(positions):
+            total += data.sum(axis=0, dtype=np.float64)
+        return self._evoked(total / len(positions), len(positions), comment)
+
+    def evokeds(self, conditions, by='cond'):
+        """
+        Average of every condition in one block-wise pass, as
+        'erp_export.grouped_evokeds' does with loaded epochs
+
+        Parameters
+        ----------
+        conditions: dict of condition name -> value of the metadata column by
+        by: str, metadata column holding the condition ('cond')
+
+        Returns
+        -------
+        evokeds: dict of condition name -> mne.EvokedArray
+        """
+        names = list(conditions)
+        values = self.metadata[by].to_numpy()
+        onehot = (values[np.newaxis, :] == np.array([conditions[n] for n in names])[:, np.newaxis])
+        counts = onehot.sum(axis=1)
+        for name, count in zip(names, counts):
+            if count == 0:
+                raise ValueError('no epochs with ' + by + '==' + str(conditions[name]))
+        sums = np.zeros((len(names), len(self.ch_names), len(self.times)))
+        for block, data in self.iter_blocks(np.flatnonzero(onehot.any(axis=0))):
+            sums += np.tensordot(onehot[:, block].astype(np.float64), data, axes=(1, 0))
+        return dict((name, self._evoked(sums[i] / counts[i], int(counts[i]), name))
+                    for i, name in enumerate(names))
+
+    def to_epochs(self, positions=None):
+        """
+        The epochs at positions as an in-memory mne.EpochsArray, with metadata
+        """
+        import mne
+        positions = np.arange(len(self)) if positions is None else np.unique(positions)
+        metadata = None if self.metadata is None else self.metadata.iloc[positions].reset_index(drop=True)
+        event_id = json.loads(self._file.attrs['event_id'])
+        return mne.EpochsArray(self.get_data(positions).astype(np.float64), self.info.copy(),
+                               events=self.events[positions], tmin=self.times[0], event_id=event_id,
+                               metadata=metadata, baseline=None, verbose=False)
+
+    def _picks(self, picks):
+        if picks is None:
+            return None
+        return np.array([self.ch_names.index(p) if isinstance(p, str) else p for p in picks])
+
+    def _evoked(self, data, nave, comment):
+        import mne
+        evoked = mne.EvokedArray(data, self.info.copy(), tmin=self.times[0], comment=comment, nave=nave,
+                                 verbose=False)
+        return evoked.pick('data', exclude=[])
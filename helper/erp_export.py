@@ -0,0 +1,232 @@
+"""
+Batched evoked responses and ERP figure export. The condition averages are
+computed in one grouped pass over the epochs data, and the contrast figures
+are drawn without pyplot (no gui, Agg for images) in a process pool, one page
+per group of channels, into a multi-page PDF or one figure sheet per page
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+CONDITIONS = dict(highcosval=1, lowcosval=2, highcosinval=3, lowcosinval=4)
+# the four comparisons walkthrough.py plots for every channel
+CONTRASTS = [('highcosval', 'lowcosval'), ('highcosinval', 'lowcosinval'),
+             ('highcosval', 'highcosinval'), ('lowcosval', 'lowcosinval')]
+
+
+def grouped_evokeds(epochs, conditions=CONDITIONS, by='cond'):
+    """
+    Average the epochs of every condition in one pass, the same as
+    `epochs[by + '==' + str(value)].average()` for each condition
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs with metadata
+    conditions: dict (CONDITIONS)
+        condition name -> value of the metadata column
+    by: str ('cond')
+        metadata column holding the condition
+
+    Returns
+    -------
+    evokeds: dict of condition name -> mne.Evoked (comment set to the name)
+    """
+    # an average of one epoch gives the channels, projections and info that
+    # Epochs.average would use; only its data and nave are replaced below
+    template = epochs[0].average()
+    picks = [epochs.ch_names.index(ch) for ch in template.ch_names]
+    data = epochs.get_data(picks=picks)
+    values = epochs.metadata[by].to_numpy()
+    names = list(conditions)
+    # (n_conditions, n_epochs) indicator matrix: all sums in one product
+    onehot = (values[None, :] == np.array([conditions[n] for n in names])[:, None]).astype(data.dtype)
+    counts = onehot.sum(axis=1)
+    sums = np.tensordot(onehot, data, axes=(1, 0))
+
+    evokeds = {}
+    for i, name in enumerate(names):
+        if counts[i] == 0:
+            raise ValueError('no epochs with ' + by + '==' + str(conditions[name]))
+        evoked = template.copy()
+        evoked.data = sums[i] / counts[i]
+        evoked.nave = int(counts[i])
+        evoked.comment = name
+        evokeds[name] = evoked
+    return evokeds
+
+
+def export_erps(evokeds, fname, contrasts=CONTRASTS, picks=None, channels_per_page=8,
+                n_jobs=1, dpi=100, errors=None):
+    """
+    Export ERP figures of every picked channel and contrast. The first page
+    shows the butterfly plot of each condition, the next pages one row per
+    channel and one column per contrast
+
+    Parameters (defaults)
+    ---------------------
+    evokeds: dict of condition name -> mne.Evoked, ie. from 'grouped_evokeds'
+    fname: str
+        output file. '.pdf' writes one multi-page PDF, anything else one
+        figure sheet per page (fname with '_p001', '_p002', ... before the
+        extension)
+    contrasts: list of (condition, condition) (CONTRASTS)
+        pairs of conditions drawn together
+    picks: list of channel names or indices (None)
+        channels to plot, defaults to the good eeg/eog channels
+    channels_per_page: int (8)
+        number of channel rows per page
+    n_jobs: int (1)
+        number of worker processes rendering pages. a PDF is rendered in
+        n_jobs parts that are merged with pypdf, or in one part if pypdf is
+        not installed
+    dpi: int (100)
+        resolution of the figure sheets
+    errors: dict of condition name -> mne.Evoked (None)
+        standard errors shaded around each trace of the contrast pages, ie.
+        'grand_average.GrandAverage.evokeds('sem')'
+
+    Returns
+    -------
+    fnames: list of the written files
+    """
+    import mne
+    first = list(evokeds.values())[0]
+    if picks is None:
+        picks = mne.pick_types(first.info, meg=False, eeg=True, eog=True, exclude='bads')
+    ch_names = [first.ch_names[p] if not isinstance(p, str) else p for p in picks]
+    idx = [first.ch_names.index(ch) for ch in ch_names]
+    # plain arrays in uV are all the workers need
+    traces = dict((name, evoked.data[idx] * 1e6) for name, evoked in evokeds.items())
+    if errors is not None:
+        errors = dict((name, evoked.data[[evoked.ch_names.index(ch) for ch in ch_names]] * 1e6)
+                      for name, evoked in errors.items())
+    pages = [(None, traces)]
+    for start in range(0, len(ch_names), channels_per_page):
+        page = slice(start, start + channels_per_page)
+        pages.append((ch_names[page], dict((name, trace[page]) for name, trace in traces.items())))
+        if errors is not None:
+            pages[-1] += (dict((name, error[page]) for name, error in errors.items()),)
+    print('rendering ' + str(len(pages)) + ' ERP pages...')
+
+    base, ext = os.path.splitext(fname)
+    merge = False
+    if ext.lower() != '.pdf':
+        fnames = [base + '_p%03d' % (i + 1) + ext for i in range(len(pages))]
+        groups = [[page] for page in pages]
+    elif n_jobs > 1 and _has_pypdf():
+        merge = True
+        groups = [list(g) for g in np.array_split(np.arange(len(pages)), min(n_jobs, len(pages)))]
+        groups = [[pages[i] for i in g] for g in groups]
+        fnames = [base + '.part' + str(i) + ext for i in range(len(groups))]
+    else:
+        groups = [pages]
+        fnames = [fname]
+
+    jobs = [(f, first.times, g, contrasts, dpi) for f, g in zip(fnames, groups)]
+    if n_jobs == 1 or len(jobs) == 1:
+        for job in jobs:
+            render_pages(*job)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+            list(pool.map(render_pages, *zip(*jobs)))
+    if merge:
+        _merge_pdfs(fnames, fname)
+        fnames = [fname]
+    return fnames
+
+
+def render_pages(fname, times, pages, contrasts, dpi=100):
+    """
+    Render pages into fname: all of them into one PDF if fname ends with
+    .pdf, else the single page as an image through the Agg backend
+
+    Parameters (defaults)
+    ---------------------
+    fname: str
+    times: array of the evoked time points in seconds
+    pages: list of (ch_names, traces) or (ch_names, traces, errors) with
+        traces (and errors) a dict of condition name -> (n_channels, n_times)
+        array in uV, and ch_names None for the butterfly page
+    contrasts: list of (condition, condition)
+    dpi: int (100)
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    if not fname.lower().endswith('.pdf'):
+        fig = page_figure(times, pages[0][0], pages[0][1], contrasts, *pages[0][2:])
+        FigureCanvasAgg(fig)
+        fig.savefig(fname, dpi=dpi)
+        return fname
+    from matplotlib.backends.backend_pdf import PdfPages
+    with PdfPages(fname) as pdf:
+        for page in pages:
+            pdf.savefig(page_figure(times, page[0], page[1], contrasts, *page[2:]))
+    return fname
+
+
+def page_figure(times, ch_names, traces, contrasts, errors=None):
+    """
+    Figure of one page (no pyplot, so no gui and no global state): the
+    butterfly plot of every condition if ch_names is None, else one row per
+    channel and one column per contrast, with errors (if given) shaded
+    around the traces
+    """
+    from matplotlib.figure import Figure
+    if ch_names is None:
+        fig = Figure(figsize=(4 * len(traces), 3))
+        axes = fig.subplots(1, len(traces), sharey=True, squeeze=False)[0]
+        for ax, (name, trace) in zip(axes, traces.items()):
+            ax.plot(times, trace.T, color='k', linewidth=0.3)
+            ax.set_title(name)
+            ax.set_xlabel('time (s)')
+        axes[0].set_ylabel('uV')
+    else:
+        fig = Figure(figsize=(4 * len(contrasts), 2 * len(ch_names)))
+        axes = fig.subplots(len(ch_names), len(contrasts), sharex=True, squeeze=False)
+        for row, ch in enumerate(ch_names):
+            for col, (a, b) in enumerate(contrasts):
+                ax = axes[row, col]
+                for name in (a, b):
+                    line, = ax.plot(times, traces[name][row], label=name)
+                    if errors is not None and name in errors:
+                        ax.fill_between(times, traces[name][row] - errors[name][row],
+                                        traces[name][row] + errors[name][row],
+                                        color=line.get_color(), alpha=0.25, linewidth=0)
+                ax.axvline(0, color='k', linewidth=0.5)
+                ax.axhline(0, color='k', linewidth=0.5)
+                if row == 0:
+                    ax.set_title(a + ' vs ' + b)
+                    ax.legend(fontsize='x-small', loc='upper left')
+                if col == 0:
+                    ax.set_ylabel(ch + ' (uV)')
+        for ax in axes[-1]:
+            ax.set_xlabel('time (s)')
+    # a fixed layout: tight_layout measures every tick label and costs more
+    # than drawing the page
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.5 / fig.get_figheight(),
+                        top=1 - 0.4 / fig.get_figheight(), wspace=0.2, hspace=0.15)
+    return fig
+
+
+def _has_pypdf():
+    try:
+        import pypdf
+        return True
+    except ImportError:
+        return False
+
+
+def _merge_pdfs(parts, fname):
+    """
+    Concatenate part PDFs into fname and remove the parts
+    """
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(part)
+    with open(fname, 'wb') as fp:
+        writer.write(fp)
+    writer.close()
+    for part in parts:
+        os.remove(part)
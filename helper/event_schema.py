@@ -0,0 +1,122 @@
+from dataclasses import dataclass, field
+import csv
+import pandas as pd
+
+
+@dataclass
+class EventSchema:
+    """
+    Declarative description of a netstation paradigm's event log. Everything
+    'extract_nslog_event' needs to know about an experiment lives here, so a
+    new paradigm only needs a new schema instead of new parsing code
+
+    Parameters (defaults are for the sfv experiment)
+    -------------------------------------------------
+    fields: dict
+        field name -> tab-separated position in the event log line.
+        'code', 'label' and 'onset' are required
+    expected: dict
+        event code -> expected number of events. the codes (in this order)
+        are the ones split into their own dataframes. a count of None skips
+        the check for that code
+    onset_label, offset_label: str ('lstS', 'lstE')
+        labels marking stim onset/offset of an event
+    trial_code: str ('tlst')
+        event code used for epochs
+    imp_onset_code: str ('cal+')
+        event code marking the start of an impedance check
+    imp_offset_rules: dict
+        experiment version -> list of (code, label, indx values) that end an
+        impedance check. the version is found in the last 3 characters of the
+        first line of the log (ie. 'sfv_eeg_011ts')
+    int_fields: tuple (('cond', 'indx'))
+        fields stored as small integers in the parsed event dataframes
+    int_dtype: str ('int16[pyarrow]')
+        dtype of int_fields. the pyarrow integers also match the log's text
+        in queries, so "cond==1" and the older "cond=='1'" select the same
+        epochs, and "cond=='x'" raises. without pyarrow, numpy's int16 is
+        used and text comparisons match nothing
+    """
+    fields: dict = field(default_factory=lambda: {'code': 0, 'label': 1, 'onset': 4,
+                                                  'cond': 7, 'indx': 9})
+    expected: dict = field(default_factory=lambda: {'plst': 10, 'tlst': 800, 'slst': 200})
+    onset_label: str = 'lstS'
+    offset_label: str = 'lstE'
+    trial_code: str = 'tlst'
+    imp_onset_code: str = 'cal+'
+    imp_offset_rules: dict = field(default_factory=lambda: {
+        'st': [('prac', 'jitr', ['0']), ('tral', 'jitr', ['100', '200', '300'])],
+        'ts': [('sntn', 'jitr', ['0']), ('tral', 'jitr', ['100', '200', '300'])]})
+    int_fields: tuple = ('cond', 'indx')
+    int_dtype: str = 'int16[pyarrow]'
+
+    @property
+    def codes(self):
+        """event codes split into their own dataframes"""
+        return list(self.expected)
+
+    @property
+    def col_names(self):
+        """column names of the parsed event dataframes, in log order"""
+        return sorted(self.fields, key=self.fields.get)
+
+    def read_csv_kwargs(self):
+        """
+        Keyword arguments for pd.read_csv that keep only the schema fields
+        Text fields are read as categoricals since they take few values
+        """
+        names = ['_' + str(i) for i in range(max(self.fields.values()) + 1)]
+        for name, pos in self.fields.items():
+            names[pos] = name
+        dtype = dict((name, 'category') for name in self.fields)
+        dtype['onset'] = str
+        return dict(sep='\t', header=None, names=names, usecols=self.col_names, dtype=dtype,
+                    quoting=csv.QUOTE_NONE, keep_default_na=False, skip_blank_lines=False)
+
+    def version(self, first_field):
+        """
+        Experiment version (a key of imp_offset_rules) named in the last 3
+        characters of the first field of the log, None if there is no match
+        """
+        for version in self.imp_offset_rules:
+            if version in first_field[-3:]:
+                return version
+        return None
+
+    def compact(self, df):
+        """
+        Convert parsed events to compact dtypes: categorical code/label (and any
+        other text field), int64 onset in ms and int_dtype for int_fields.
+        int fields with non-numeric values fall back to the nullable dtype
+
+        Parameters
+        ----------
+        df: pandas dataframe with the schema columns
+
+        Returns
+        -------
+        df: a new pandas dataframe
+        """
+        df = df.copy()
+        int_dtype = self.int_dtype
+        if int_dtype.endswith('[pyarrow]'):
+            try:
+                import pyarrow
+            except ImportError:
+                int_dtype = int_dtype[:-len('[pyarrow]')]
+        for name in df.columns:
+            if name == 'onset':
+                df[name] = df[name].astype('int64')
+            elif name in self.int_fields:
+                values = pd.to_numeric(df[name].astype(str), errors='coerce')
+                if values.isna().any() and not int_dtype.endswith('[pyarrow]'):
+                    df[name] = values.astype(int_dtype.capitalize())
+                else:
+                    df[name] = values.astype(int_dtype)
+            else:
+                df[name] = df[name].astype(str).astype('category')
+        return df
+
+
+# schema of the sfv experiment this repo was written for
+SFV_SCHEMA = EventSchema()
@@ -1,9 +1,14 @@
 import pandas as pd
 import numpy as np
 import os
+from event_schema import SFV_SCHEMA
 
+# character positions of digits and colons in '_HH:MM:SS:MMM'
+_STAMP_DIGITS = [1, 2, 4, 5, 7, 8, 10, 11, 12]
+_STAMP_COLONS = [3, 6, 9]
 
-def create_df(ns_eventlog):
+
+def create_df(ns_eventlog, schema=SFV_SCHEMA):
     """
     Create dataframes used for checking impedance periods and epochs metadata
     First creates all event df (df_lst), then creates sub dataframes
@@ -11,186 +16,340 @@ def create_df(ns_eventlog):
     Parameters
     ----------
     ns_eventlog: must be a string with netstation event log file name
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
 
     Returns
     -------
-    currently 3 pandas dataframes (df_lst, df_plst, df_tlst, df_slst)
+    nsdata: pandas dataframe of the whole event log with the schema fields
+        (code, label, onset in ms, cond, indx)
+    df_lst and one dataframe per schema code (df_plst, df_tlst, df_slst for sfv)
     """
-    # values below currently fixed for sfv exp
-    expected_plst = 10
-    expected_tlst = 800
-    expected_slst = 200
+    print('creating data frame from ns event log...')
+    nsdata = read_nslog(ns_eventlog, schema)
+    dfs = split_lst(select_lst(nsdata, schema), schema)
 
-    # get the subject number
-    temp = os.path.basename(ns_eventlog)
-    temp = [int(s) for s in temp if s.isdigit()]
-    temp = ''.join(str(x) for x in temp)
+    print('dataframes created for subject ' + subject_number(ns_eventlog))
+    for code, df in zip(schema.codes, dfs[1:]):
+        print(code + ' events found: ' + str(len(df)))
+    return (nsdata,) + dfs
 
-    print('creating data frame from ns event log...')
-    with open(ns_eventlog) as fp:
-        nsdata = fp.readlines()
-    nsdata = [i.split('\t') for i in nsdata]
-    #remove random '_' in front of time format
-    for i in range(0,len(nsdata)):
-        try:
-            nsdata[i][4]=nsdata[i][4][1:]
-        except IndexError:
-            pass
-    #convert from string of HH:MM:SS:MMM to MS
-    for i in range(0,len(nsdata)):
-        try:
-            hh=int(nsdata[i][4][0:2]) * 3600000
-            mm=int(nsdata[i][4][3:5]) * 60000
-            ss=int(nsdata[i][4][6:8]) * 1000
-            ms=int(nsdata[i][4][9:12])
-            nsdata[i][4]=hh+mm+ss+ms
-        except IndexError:
-            pass
-        except ValueError:
-            pass
-
-    # create data frame for labels with particular interest
-    col_names = ['code','label','onset','cond','indx']
-    df_lst = pd.DataFrame(columns=col_names)
-    temp_code = []
-    temp_label = []
-    temp_onset = []
-    temp_cond = []
-    temp_indx = []
-    for i in range(0, len(nsdata)):
-        try:
-            if nsdata[i][0][1:] == 'lst':
-                temp_code.append(nsdata[i][0])
-                temp_label.append(nsdata[i][1])
-                temp_onset.append(nsdata[i][4])
-                temp_cond.append(nsdata[i][7])
-                temp_indx.append(nsdata[i][9])
-        except IndexError:
-            pass
-    df_lst['code']=temp_code
-    df_lst['label']=temp_label
-    df_lst['onset']=temp_onset
-    df_lst['cond']=temp_cond
-    df_lst['indx']=temp_indx
-    assert len(df_lst) == expected_slst+expected_tlst+expected_plst, "df_lst number != expected total lst"
-
-    # create dataframe particular for plst
-    df_plst = pd.DataFrame(columns=col_names)
-    temp_code = []
-    temp_label = []
-    temp_onset = []
-    temp_cond = []
-    temp_indx = []
-    for i in range(0, len(df_lst)):
-        if df_lst.iloc[i]['code'] == 'plst':
-            temp_code.append(df_lst.iloc[i]['code'])
-            temp_label.append(df_lst.iloc[i]['label'])
-            temp_onset.append(df_lst.iloc[i]['onset'])
-            temp_cond.append(df_lst.iloc[i]['cond'])
-            temp_indx.append(df_lst.iloc[i]['indx'])
-    df_plst['code']=temp_code
-    df_plst['label']=temp_label
-    df_plst['onset']=temp_onset
-    df_plst['cond']=temp_cond
-    df_plst['indx']=temp_indx
-    assert len(df_plst) == expected_plst, "ERROR: len(df_plst) != expected plst"
-    # assert len(df_plst) == len(events_plst), "ERROR: len(df_plst) != len(events_plst)"
-
-    # create dataframe particular for tlst
-    df_tlst = pd.DataFrame(columns=col_names)
-    temp_code = []
-    temp_label = []
-    temp_onset = []
-    temp_cond = []
-    temp_indx = []
-    for i in range(0, len(df_lst)):
-        if df_lst.iloc[i]['code'] == 'tlst':
-            temp_code.append(df_lst.iloc[i]['code'])
-            temp_label.append(df_lst.iloc[i]['label'])
-            temp_onset.append(df_lst.iloc[i]['onset'])
-            temp_cond.append(df_lst.iloc[i]['cond'])
-            temp_indx.append(df_lst.iloc[i]['indx'])
-    df_tlst['code']=temp_code
-    df_tlst['label']=temp_label
-    df_tlst['onset']=temp_onset
-    df_tlst['cond']=temp_cond
-    df_tlst['indx']=temp_indx
-    assert len(df_tlst) == expected_tlst, "ERROR: len(df_tlst) != expected tlst"
-    # assert len(df_tlst) == len(events_tlst), "ERROR: len(df_tlst) != len(events_tlst)"
-
-    # create dataframe particular for slst
-    df_slst = pd.DataFrame(columns=col_names)
-    temp_code = []
-    temp_label = []
-    temp_onset = []
-    temp_cond = []
-    temp_indx = []
-    for i in range(0, len(df_lst)):
-        if df_lst.iloc[i]['code'] == 'slst':
-            temp_code.append(df_lst.iloc[i]['code'])
-            temp_label.append(df_lst.iloc[i]['label'])
-            temp_onset.append(df_lst.iloc[i]['onset'])
-            temp_cond.append(df_lst.iloc[i]['cond'])
-            temp_indx.append(df_lst.iloc[i]['indx'])
-    df_slst['code']=temp_code
-    df_slst['label']=temp_label
-    df_slst['onset']=temp_onset
-    df_slst['cond']=temp_cond
-    df_slst['indx']=temp_indx
-    assert len(df_slst) == expected_slst, "ERROR: len(df_slst) != expected slst"
-
-    print('dataframes created for subject ' + temp)
-    print('trials found: ' + str(len(df_tlst)))
-    print('sentences found: ' + str(len(df_slst)))
-    return nsdata, df_lst, df_plst, df_tlst, df_slst
-
-
-def create_df_onset(df_tlst):
+
+def create_df_chunked(ns_eventlog, chunksize=100000, schema=SFV_SCHEMA):
+    """
+    Same as running 'create_df', 'find_impedances' and 'create_df_onset', but
+    streams the event log in chunks so the whole log is never held in memory
+
+    Parameters (defaults)
+    ---------------------
+    ns_eventlog: str
+        netstation event log file name
+    chunksize: int (100000)
+        number of log lines parsed at a time
+    schema: EventSchema (SFV_SCHEMA)
+        description of the experiment's events
+
+    Returns
+    -------
+    df_lst and one dataframe per schema code as in 'create_df'
+    df_tlstS: onset-only dataframe of schema.trial_code as in 'create_df_onset'
+    imp_onset, imp_offset, imp_dur: impedance periods as in 'find_impedances'
+    """
+    print('creating data frame from ns event log in chunks...')
+    lst = LstCollector(schema)
+    onsets = OnsetCollector(schema)
+    impedances = ImpedanceCollector(schema)
+    consume_nslog(ns_eventlog, [lst, onsets, impedances], chunksize, schema)
+    dfs = lst.result()
+
+    print('dataframes created for subject ' + subject_number(ns_eventlog))
+    for code, df in zip(schema.codes, dfs[1:]):
+        print(code + ' events found: ' + str(len(df)))
+    imp = impedances.result()
+    print('found ' + str(len(imp[0])) + ' impedance periods!')
+    return dfs + (onsets.result(),) + imp
+
+
+def subject_number(ns_eventlog):
+    """
+    Get the subject number from the digits of the event log file name
+    """
+    return ''.join(s for s in os.path.basename(ns_eventlog) if s.isdigit())
+
+
+def read_nslog(ns_eventlog, schema=SFV_SCHEMA):
+    """
+    Read the netstation event log into a single dataframe in one pass
+    Only the schema fields are kept; onset is converted to ms
+
+    Parameters
+    ----------
+    ns_eventlog: must be a string with netstation event log file name
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
+
+    Returns
+    -------
+    nsdata: pandas dataframe with one column per schema field. text fields are
+        categorical since they only take a handful of values. rows without a
+        valid time stamp have NaN onset
+    """
+    nsdata = pd.read_csv(ns_eventlog, **schema.read_csv_kwargs())
+    nsdata['onset'] = timestamp_to_ms(nsdata['onset'])
+    return nsdata
+
+
+def iter_nslog(ns_eventlog, chunksize=100000, schema=SFV_SCHEMA):
+    """
+    Generator version of 'read_nslog' that parses the event log in fixed-size
+    chunks. Row index keeps counting across chunks (ie. line number)
+
+    Parameters (defaults)
+    ---------------------
+    ns_eventlog: str
+        netstation event log file name
+    chunksize: int (100000)
+        number of log lines per chunk
+    schema: EventSchema (SFV_SCHEMA)
+        description of the experiment's events
+
+    Yields
+    ------
+    chunk: pandas dataframe with the same columns as 'read_nslog'
+    """
+    reader = pd.read_csv(ns_eventlog, chunksize=chunksize, **schema.read_csv_kwargs())
+    with reader:
+        for chunk in reader:
+            chunk['onset'] = timestamp_to_ms(chunk['onset'])
+            yield chunk
+
+
+def consume_nslog(ns_eventlog, consumers, chunksize=100000, schema=SFV_SCHEMA):
+    """
+    Feed every chunk of the event log to each consumer's `update` method
+    Peak memory is bounded by `chunksize` plus what the consumers keep
+
+    Parameters (defaults)
+    ---------------------
+    ns_eventlog: str
+        netstation event log file name
+    consumers: list
+        objects with an `update(chunk)` method, ie. LstCollector
+    chunksize: int (100000)
+        number of log lines per chunk
+    schema: EventSchema (SFV_SCHEMA)
+        description of the experiment's events
+
+    Returns
+    -------
+    consumers: the same list, call `result()` on each to get their output
+    """
+    for chunk in iter_nslog(ns_eventlog, chunksize, schema):
+        for consumer in consumers:
+            consumer.update(chunk)
+    return consumers
+
+
+def timestamp_to_ms(stamps):
+    """
+    Convert netstation time stamps to milliseconds without a python loop
+    Stamps look like '_HH:MM:SS:MMM' (the first character is dropped)
+
+    Parameters
+    ----------
+    stamps: pandas series (or array) of time stamp strings
+
+    Returns
+    -------
+    onset: float array of ms, NaN where the stamp could not be parsed
+    """
+    # fixed-width unicode array viewed as code points -> (n, 13) digit matrix
+    stamps = np.asarray(stamps, dtype='U13')
+    digits = stamps.view(np.uint32).reshape(len(stamps), 13).astype(np.int64) - ord('0')
+    valid = np.all((digits[:, _STAMP_DIGITS] >= 0) & (digits[:, _STAMP_DIGITS] <= 9), axis=1)
+    valid &= np.all(digits[:, _STAMP_COLONS] == ord(':') - ord('0'), axis=1)
+    hh = digits[:, 1] * 10 + digits[:, 2]
+    mm = digits[:, 4] * 10 + digits[:, 5]
+    ss = digits[:, 7] * 10 + digits[:, 8]
+    ms = digits[:, 10] * 100 + digits[:, 11] * 10 + digits[:, 12]
+    onset = (hh * 3600000 + mm * 60000 + ss * 1000 + ms).astype(np.float64)
+    onset[~valid] = np.nan
+    return onset
+
+
+def select_lst(nsdata, schema=SFV_SCHEMA):
+    """
+    Select the events with a schema code (plst, tlst, slst for sfv) from
+    (a chunk of) the event log and store them with compact dtypes
+
+    Parameters
+    ----------
+    nsdata: event log dataframe from 'read_nslog' or 'iter_nslog'
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
+
+    Returns
+    -------
+    df_lst: pandas dataframe with categorical code/label, int64 onset and
+        small integer cond/indx (see EventSchema.compact)
+    """
+    df_lst = nsdata[nsdata['code'].isin(schema.codes)].reset_index(drop=True)
+    return schema.compact(df_lst)
+
+
+def split_lst(df_lst, schema=SFV_SCHEMA):
+    """
+    Split df_lst into one dataframe per schema code and check the counts
+
+    Parameters
+    ----------
+    df_lst: pandas dataframe from 'select_lst'
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
+
+    Returns
+    -------
+    tuple of df_lst and one pandas dataframe per schema code
+        (df_lst, df_plst, df_tlst, df_slst for sfv)
+    """
+    expected = [n for n in schema.expected.values() if n is not None]
+    if len(expected) == len(schema.expected):
+        assert len(df_lst) == sum(expected), "df_lst number != expected total lst"
+
+    # split into sub dataframes by code in one pass
+    groups = dict((code, df.reset_index(drop=True))
+                  for code, df in df_lst.groupby('code', sort=False, observed=True))
+    dfs = []
+    for code in schema.codes:
+        df = groups.get(code, df_lst.iloc[:0])
+        if schema.expected[code] is not None:
+            assert len(df) == schema.expected[code], "ERROR: len(df_" + code + ") != expected " + code
+        dfs.append(df)
+    return (df_lst,) + tuple(dfs)
+
+
+def create_df_onset(df_tlst, schema=SFV_SCHEMA):
     """
     Extract just the onsets of given dataframe
 
     Parameters
     ----------
     df_tlst: must be dataframe extracted from ns event log
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
 
     Returns
     -------
     df_tlstS: a new pandas dataframe that only contains onsets
     """
-    col_names = ['code','label','onset','cond','indx']
-    df_tlstS = pd.DataFrame(columns=col_names)
-    temp_code = []
-    temp_label = []
-    temp_onset = []
-    temp_cond = []
-    temp_indx = []
-    for i in range(0, len(df_tlst)):
-        try:
-            if df_tlst.iloc[i]['label'] == 'lstS':
-                temp_code.append(df_tlst.iloc[i]['code'])
-                temp_label.append(df_tlst.iloc[i]['label'])
-                temp_onset.append(df_tlst.iloc[i]['onset'])
-                temp_cond.append(df_tlst.iloc[i]['cond'])
-                temp_indx.append(df_tlst.iloc[i]['indx'])
-        except IndexError:
-            pass
-    df_tlstS['code']=temp_code
-    df_tlstS['label']=temp_label
-    df_tlstS['onset']=temp_onset
-    df_tlstS['cond']=temp_cond
-    df_tlstS['indx']=temp_indx
-    return df_tlstS
-
-
-# Things to add: custom labels for imp check, imp index as params
-def find_impedances(nsdata):
+    return df_tlst[df_tlst['label'] == schema.onset_label].reset_index(drop=True)
+
+
+class LstCollector(object):
+    """
+    Incremental consumer that keeps only the events with a schema code
+    `result()` returns the same dataframes as 'split_lst'
+    """
+    def __init__(self, schema=SFV_SCHEMA):
+        self.schema = schema
+        self.chunks = []
+
+    def update(self, chunk):
+        df_lst = select_lst(chunk, self.schema)
+        if len(df_lst):
+            self.chunks.append(df_lst)
+
+    def result(self):
+        return split_lst(concat_events(self.chunks, self.schema), self.schema)
+
+
+class OnsetCollector(object):
+    """
+    Incremental consumer that keeps only the onset events of schema.trial_code
+    `result()` returns the same dataframe as 'create_df_onset'
+    """
+    def __init__(self, schema=SFV_SCHEMA):
+        self.schema = schema
+        self.chunks = []
+
+    def update(self, chunk):
+        df_lst = select_lst(chunk, self.schema)
+        df_onset = create_df_onset(df_lst[df_lst['code'] == self.schema.trial_code], self.schema)
+        if len(df_onset):
+            self.chunks.append(df_onset)
+
+    def result(self):
+        return concat_events(self.chunks, self.schema)
+
+
+class ImpedanceCollector(object):
+    """
+    Incremental consumer that keeps the impedance onset/offset times in ms
+    The experiment version (ts vs st) is read from the first line of the log
+    `result()` returns the same lists as 'find_impedances'
+    """
+    def __init__(self, schema=SFV_SCHEMA):
+        self.schema = schema
+        self.type = None
+        self.onsets = []
+        self.offsets = []
+
+    def update(self, chunk):
+        if self.type is None:
+            self.type = self.schema.version(chunk['code'].iloc[0])
+        onset, offset = impedance_events(chunk, self.type, self.schema)
+        self.onsets.append(onset)
+        self.offsets.append(offset)
+
+    def result(self):
+        return impedance_periods(np.concatenate(self.onsets or [[]]),
+                                 np.concatenate(self.offsets or [[]]))
+
+
+def concat_events(chunks, schema=SFV_SCHEMA):
+    """
+    Concatenate parsed event chunks, keeping the compact dtypes
+    (categoricals from different chunks do not share categories)
+    """
+    if not chunks:
+        return schema.compact(pd.DataFrame(columns=schema.col_names))
+    return schema.compact(pd.concat(chunks, ignore_index=True))
+
+
+def impedance_events(nsdata, type, schema=SFV_SCHEMA):
+    """
+    Find impedance onset (cal+) and offset (jitr) times in (a chunk of) the log
+
+    Parameters
+    ----------
+    nsdata: event log dataframe from 'read_nslog' or 'iter_nslog'
+    type: str, version of the experiment ('ts' or 'st')
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
+
+    Returns
+    -------
+    imp_onset: array of impedance onset timing in ms
+    imp_offset: array of impedance offset timing in ms
+    """
+    code = nsdata['code']
+    label = nsdata['label']
+    indx = nsdata['indx']
+
+    # find impedance onset from ns event log
+    imp_onset = nsdata.loc[code == schema.imp_onset_code, 'onset'].to_numpy()
+
+    # find impedance offset from ns event log
+    is_offset = np.zeros(len(nsdata), dtype=bool)
+    for off_code, off_label, indx_val in schema.imp_offset_rules[type]:
+        is_offset |= ((code == off_code) & (label == off_label) & indx.isin(indx_val)).to_numpy()
+    imp_offset = nsdata.loc[is_offset, 'onset'].to_numpy()
+    return imp_onset, imp_offset
+
+
+def find_impedances(nsdata, schema=SFV_SCHEMA):
     """
     Finds impedance onsets and durations based on netstation event log
     ***run 'create_df' before running this
 
     Parameters
     ----------
-    nsdata: list of event logs created from 'create_df'
+    nsdata: event log dataframe created from 'create_df'
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
 
     Returns
     -------
@@ -199,60 +358,84 @@ def find_impedances(nsdata):
     imp_dur: list of impedance durations in seconds
     """
     print('finding impedance periods...')
-    # first check which version of exp (ts vs st)
-    if 'st' in nsdata[0][0][-3:]:
-        type = 'st'
-    if 'ts' in nsdata[0][0][-3:]:
-        type = 'ts'
+    type = schema.version(nsdata['code'].iloc[0])
+    imp_onset, imp_offset = impedance_events(nsdata, type, schema)
+    imp_onset, imp_offset, imp_dur = impedance_periods(imp_onset, imp_offset)
+    print('found ' + str(len(imp_onset)) + ' impedance periods!')
+    return imp_onset, imp_offset, imp_dur
 
-    # find impedance onset from ns event log
-    imp_df = []
-    for i in range(0, len(nsdata)):
-        if nsdata[i][0] == 'cal+':
-            imp_df.append(nsdata[i])
-    imp_onset =[]
-    for i in range(0, len(imp_df)):
-        imp_onset.append(imp_df[i][4])
-    imp_onset
 
-    # find impedance offset from ns event log
-    if type == 'st':
-        imp_offset = []
-        indx_val = ['100','200','300']
-        for i in range(0, len(nsdata)):
-            if nsdata[i][0] == 'prac' and nsdata[i][1] == 'jitr' and nsdata[i][9] == '0':
-                imp_offset.append(nsdata[i][4])
-            if nsdata[i][0] == 'tral' and nsdata[i][1] == 'jitr' and nsdata[i][9] in indx_val:
-                imp_offset.append(nsdata[i][4])
-        imp_offset
-    if type == 'ts':
-        imp_offset = []
-        indx_val = ['100','200','300']
-        for i in range(0, len(nsdata)):
-            if nsdata[i][0] == 'sntn' and nsdata[i][1] == 'jitr' and nsdata[i][9] == '0':
-                imp_offset.append(nsdata[i][4])
-            if nsdata[i][0] == 'tral' and nsdata[i][1] == 'jitr' and nsdata[i][9] in indx_val:
-                imp_offset.append(nsdata[i][4])
-        imp_offset
+def impedance_periods(imp_onset, imp_offset):
+    """
+    Pair impedance onsets with offsets (see 'match_impedances') and convert
+    them to seconds. unmatched onsets and offsets (ie. from a pause in the
+    session) are reported and left out instead of stopping the run, and
+    repeated onsets before one offset are reported and merged
+
+    Parameters
+    ----------
+    imp_onset: list or array of impedance onset timing in ms
+    imp_offset: list or array of impedance offset timing in ms
 
+    Returns
+    -------
+    imp_onset, imp_offset, imp_dur: lists in seconds
+    """
+    imp_onset, imp_offset, lone_onset, lone_offset, extra_onset = match_impedances(imp_onset, imp_offset)
+    if len(lone_onset):
+        print('WARNING: ' + str(len(lone_onset)) + ' impedance onsets without an offset after them, at '
+              + str((lone_onset * 0.001).tolist()) + ' s. Check for pauses in sessions.')
+    if len(lone_offset):
+        print('WARNING: ' + str(len(lone_offset)) + ' impedance offsets without an onset, at '
+              + str((lone_offset * 0.001).tolist()) + ' s. Check for pauses in sessions.')
+    if len(extra_onset):
+        print('WARNING: ' + str(len(extra_onset)) + ' impedance onsets inside an earlier check, at '
+              + str((extra_onset * 0.001).tolist()) + ' s, merged into it. Check for pauses in sessions.')
     # convert onset, offset to seconds
-    for i in range(0, len(imp_onset)):
-        imp_onset[i] = imp_onset[i] * 0.001
-    for i in range(0, len(imp_offset)):
-        imp_offset[i] = imp_offset[i] * 0.001
+    imp_onset = imp_onset * 0.001
+    imp_offset = imp_offset * 0.001
 
     # get impedance duration ie. offset - onset
-    imp_dur = []
-    for i in range(0, len(imp_onset)):
-        imp_dur.append(imp_offset[i] - imp_onset[i])
-    imp_dur
-    assert len(imp_onset) == len(imp_offset), "ERROR: len of imp_onset is " + str(len(imp_onset) + " while len of imp_offset is " + str(len(imp_offset)) + ". Check for pauses in sessions.")
-
-    print('found ' + str(len(imp_onset)) + ' impedance periods!')
+    imp_dur = imp_offset - imp_onset
+    imp_onset, imp_offset, imp_dur = imp_onset.tolist(), imp_offset.tolist(), imp_dur.tolist()
     return imp_onset, imp_offset, imp_dur
 
 
-def assign_event_id(df, events):
+def match_impedances(imp_onset, imp_offset):
+    """
+    Pair every impedance onset with the first offset at or after it, by
+    binary search over the sorted times. onsets sharing the same offset (a
+    check restarted after a pause, an extra cal+) make one period from the
+    first of them; offsets no onset reaches (an extra jitr) are left over
+
+    Parameters
+    ----------
+    imp_onset: list or array of impedance onset times
+    imp_offset: list or array of impedance offset times (same unit)
+
+    Returns
+    -------
+    onset, offset: float arrays of the paired periods, sorted
+    lone_onset: float array of the onsets with no offset after them (ie. the
+        log ends during a check)
+    lone_offset: float array of the offsets not paired with any onset
+    extra_onset: float array of the onsets merged into an earlier onset's
+        period (sharing its offset)
+    """
+    onset = np.sort(np.asarray(imp_onset, dtype=np.float64).ravel())
+    offset = np.sort(np.asarray(imp_offset, dtype=np.float64).ravel())
+    pair = np.searchsorted(offset, onset, side='left')
+    matched = pair < len(offset)
+    pair = pair[matched]
+    # pair is sorted, so onsets sharing an offset are neighbours
+    first = np.ones(len(pair), dtype=bool)
+    first[1:] = pair[1:] != pair[:-1]
+    used = np.zeros(len(offset), dtype=bool)
+    used[pair] = True
+    return onset[matched][first], offset[pair[first]], onset[~matched], offset[~used], onset[matched][~first]
+
+
+def assign_event_id(df, events, sfreq, schema=SFV_SCHEMA):
     """
     Update event ids to stim onset/offset by 1 and 2 respectively
     also compares sample number as sanity check (will assert if different)
@@ -261,39 +444,42 @@ def assign_event_id(df, events):
     ----------
     df: pandas dataframe created from 'create_df'
     events: events arrary from mne.find_events
+    sfreq: sampling rate of the raw file, ie. raw.info['sfreq']
+    schema: EventSchema of the experiment (defaults to SFV_SCHEMA)
 
     Returns
     -------
     events: overwrites on the given events array to update the third column
     """
     print('updating mne event array and double checking sampling onset time...')
-    for i in range(0, len(df)):
-        # if the sampling time is same, couple them
-        if abs(df.iloc[i]['onset'] * 0.2 - events[i][0]) < 1:
-        # check whether it's onset or offset, based on last letter of label
-            if df.iloc[i]['label'][-1:] == 'S':
-                events[i][2] = 1
-            if df.iloc[i]['label'][-1:] == 'E':
-                events[i][2] = 2
-        assert abs(df.iloc[i]['onset'] * 0.2 - events[i][0]) < 1, "ERROR: df sample number different at " + str(i)
+    n_events = len(df)
+    assert len(events) >= n_events, "ERROR: " + str(n_events) + " df events but only " + str(len(events)) + " mne events"
+    # if the sampling time is same, couple them
+    samples = df['onset'].to_numpy() * (sfreq / 1000.)
+    mismatch = np.flatnonzero(np.abs(samples - events[:n_events, 0]) >= 1)
+    assert len(mismatch) == 0, "ERROR: df sample number different at " + str(mismatch.tolist())
+
+    # check whether it's onset or offset, based on last letter of label
+    suffix = df['label'].astype(str).str[-1:].to_numpy()
+    event_id = events[:n_events, 2]
+    event_id[suffix == schema.onset_label[-1:]] = 1
+    event_id[suffix == schema.offset_label[-1:]] = 2
     return events
 
 
-def find_onsets(events):
+def find_onsets(events, event_id=1):
     """
     Filters and finds just the onset start of event tag from events
 
-    Parameters
-    ----------
-    events: events arrary from mne.find_events
+    Parameters (defaults)
+    ---------------------
+    events: events arrary from mne.find_events (after 'assign_event_id')
+    event_id: int (1)
+        event id of the onsets
 
     Returns
     -------
-    events: overwrites on the given events array to update the third column
+    events_onset: new (n, 3) events array with only the onset events
     """
-    print('updating mne event array and double checking sampling onset time...')
-    events_onset = np.array([])
-    for i in range(0, len(events)):
-        if events[i][2] == 1:
-            events_onset.append(events[i])
-    return events_onset
+    print('filtering onset events from mne event array...')
+    return events[events[:, 2] == event_id]
@@ -0,0 +1,130 @@
+"""
+Single-trial features for group analysis: the mean amplitude of every epoch
+and channel in a few time windows, joined with the trial metadata and written
+as a Parquet dataset partitioned by subject. One row per epoch and window, one
+float32 column per channel, so a study can be read back with only the
+channels, windows and conditions needed (column pruning and predicate
+pushdown) instead of loading every subject's epochs
+
+    table = trial_features(epochs_clean, subject='sfv_eeg_011ts')
+    write_features(table, 'features')
+    df = read_features('features', channels=['E62', 'E72'], windows=['n400'], conds=[1, 2])
+"""
+import numpy as np
+import pandas as pd
+
+# name -> (start, end) in seconds
+WINDOWS = dict(n1=(0.08, 0.15), p2=(0.15, 0.25), n400=(0.3, 0.5))
+METADATA = ('cond', 'indx', 'label')
+
+
+def trial_features(epochs, windows=WINDOWS, picks=None, subject=None, metadata=METADATA):
+    """
+    Mean amplitude of every epoch and channel in each time window
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs with metadata
+    windows: dict (WINDOWS)
+        window name -> (start, end) in seconds, both included
+    picks: list (None)
+        channels, defaults to the good eeg channels
+    subject: str (None)
+        added as a 'subject' column (the partition of 'write_features')
+    metadata: tuple (METADATA)
+        metadata columns joined to every row
+
+    Returns
+    -------
+    table: pandas dataframe with subject, epoch (index in the original
+        events, as in epochs.selection), window, the metadata columns and
+        one float32 column of uV per channel
+    """
+    import mne
+    if picks is None:
+        picks = mne.pick_types(epochs.info, meg=False, eeg=True, exclude='bads')
+    ch_names = [epochs.ch_names[p] for p in picks]
+    data = epochs.get_data(picks=picks)
+    times = epochs.times
+
+    blocks = []
+    for name, (start, end) in windows.items():
+        sel = np.flatnonzero((times >= start) & (times <= end))
+        if not len(sel):
+            raise ValueError('no samples in window ' + name + ' ' + str((start, end)))
+        # windows are contiguous, so a slice instead of fancy indexing (no copy)
+        amplitude = data[:, :, sel[0]:sel[-1] + 1].mean(axis=2) * 1e6
+        block = pd.DataFrame(amplitude.astype(np.float32), columns=ch_names)
+        block.insert(0, 'window', name)
+        block.insert(0, 'epoch', np.asarray(epochs.selection))
+        if epochs.metadata is not None:
+            for i, col in enumerate(metadata):
+                block.insert(2 + i, col, epochs.metadata[col].to_numpy())
+        blocks.append(block)
+    table = pd.concat(blocks, ignore_index=True)
+    table['window'] = pd.Categorical(table['window'], categories=list(windows))
+    if subject is not None:
+        table.insert(0, 'subject', subject)
+    return table
+
+
+def write_features(table, root):
+    """
+    Write (or replace) the subjects of a feature table in the Parquet dataset
+    at root, partitioned by subject (root/subject=<name>/...). Rows are sorted
+    by window and condition so the row group statistics let readers skip what
+    they filter out
+
+    Returns
+    -------
+    root: str
+    """
+    sort = [col for col in ['window', 'cond', 'epoch'] if col in table]
+    table = table.sort_values(sort, kind='stable')
+    table.to_parquet(root, partition_cols=['subject'], index=False,
+                     existing_data_behavior='delete_matching')
+    return root
+
+
+def read_features(root, subjects=None, channels=None, windows=None, conds=None, filters=None):
+    """
+    Read a feature dataset, loading only the requested rows and channels
+
+    Parameters (defaults)
+    ---------------------
+    root: str, dataset of 'write_features'
+    subjects, windows, conds: list (None)
+        values of the subject, window and cond columns to keep (None for all)
+    channels: list (None)
+        channel columns to load (None for all)
+    filters: list (None)
+        further pyarrow filters, ie. [('indx', '<', 100)]
+
+    Returns
+    -------
+    table: pandas dataframe
+    """
+    filters = list(filters or [])
+    for col, values in [('subject', subjects), ('window', windows), ('cond', conds)]:
+        if values is not None:
+            filters.append((col, 'in', list(values)))
+    columns = None
+    if channels is not None:
+        import pyarrow.parquet as pq
+        names = pq.ParquetDataset(root).schema.names
+        columns = [col for col in names if col in ['subject', 'epoch', 'window'] + list(METADATA)]
+        columns += list(channels)
+    table = pd.read_parquet(root, columns=columns, filters=filters or None)
+    table['subject'] = table['subject'].astype(str)
+    return table
+
+
+def window_means(table, by=('subject', 'cond', 'window'), channels=None):
+    """
+    Average the single-trial features per group, ie. a subject x condition x
+    window table of mean amplitudes for group statistics
+    """
+    if channels is None:
+        channels = [col for col in table.columns
+                    if col not in ['subject', 'epoch', 'window'] + list(METADATA)]
+    return table.groupby(list(by), observed=True)[list(channels)].mean()
@@ -0,0 +1,248 @@
+"""
+Grand averages across subjects without keeping their evoked responses. Every
+subject's condition averages are folded, as the subject finishes, into one
+float64 running mean and sum of squared deviations per condition (Welford's
+update), kept in a single .npz file. Grand averages, standard errors and
+one-sample t-maps can be read from it at any time, in memory of the order of
+channels x times whatever the number of subjects. Contrasts are folded as
+per-subject differences, so their t-maps are paired tests
+
+    grand = GrandAverage('results/grand_average.npz', contrasts=[('highcosval', 'lowcosval')])
+    grand.add('sfv_eeg_011ts', evokeds)     # dict of condition -> Evoked
+    grand.save()
+    grand.tmap('highcosval - lowcosval')    # (n_channels, n_times)
+
+Subjects are the observations (random effects): the standard error is the
+spread of the subject averages, whatever their number of trials; the trials
+are only counted (nave)
+"""
+import os
+import numpy as np
+
+
+class GrandAverage(object):
+    """
+    Running grand average of evoked responses per condition
+
+    Parameters (defaults)
+    ---------------------
+    fname: str (None)
+        .npz file the accumulators are read from (if it exists) and saved to
+    contrasts: list of (condition, condition) (None)
+        pairs whose per-subject difference is accumulated too, under the
+        name 'a - b'
+    digest: str (None)
+        digest of the settings the evoked responses were made with (ie.
+        PipelineConfig.digest). a saved file with another digest is not
+        continued: the grand average starts over
+    """
+    def __init__(self, fname=None, contrasts=None, digest=None):
+        self.fname = fname
+        self.contrasts = [tuple(pair) for pair in (contrasts or [])]
+        self.digest = digest
+        self.subjects = []
+        self.ch_names = []
+        self.ch_types = []
+        self.locs = np.zeros((0, 12))
+        self.times = None
+        self.sfreq = None
+        # condition -> dict(n=(n_channels,) subjects, mean and m2=(n_channels, n_times), nave=trials)
+        self.stats = {}
+        if fname is not None and os.path.exists(fname):
+            self._load(fname)
+
+    @property
+    def conditions(self):
+        return list(self.stats)
+
+    def add(self, subject, evokeds):
+        """
+        Fold one subject's evoked responses in, with their projections (ie.
+        the average reference) applied. Channels missing from a subject (its
+        bad channels) are averaged over the other subjects only
+
+        Parameters
+        ----------
+        subject: str
+            a subject already in the grand average is not added again
+        evokeds: dict of condition -> mne.Evoked, or a list of Evoked whose
+            comments are the conditions (ie. from mne.read_evokeds)
+
+        Returns
+        -------
+        added: bool
+        """
+        if subject in self.subjects:
+            print(subject + ' is already in the grand average')
+            return False
+        if not isinstance(evokeds, dict):
+            evokeds = dict((evoked.comment, evoked) for evoked in evokeds)
+        data = {}
+        for name, evoked in evokeds.items():
+            evoked = evoked.copy().apply_proj() if evoked.info['projs'] else evoked
+            rows = self._channel_rows(evoked)
+            data[name] = (rows, evoked.data, evoked.nave)
+        for a, b in self.contrasts:
+            if a not in data or b not in data:
+                continue
+            (rows_a, data_a, nave_a), (rows_b, data_b, nave_b) = data[a], data[b]
+            common, ia, ib = np.intersect1d(rows_a, rows_b, return_indices=True)
+            data[a + ' - ' + b] = (common, data_a[ia] - data_b[ib], min(nave_a, nave_b))
+        for name, (rows, values, nave) in data.items():
+            self._fold(name, rows, values, nave)
+        self.subjects.append(subject)
+        return True
+
+    def n(self, condition):
+        """
+        Number of subjects averaged in each channel, (n_channels,)
+        """
+        return self.stats[condition]['n']
+
+    def mean(self, condition):
+        """
+        Grand average (n_channels, n_times), NaN for channels without subjects
+        """
+        stats = self.stats[condition]
+        return np.where(stats['n'][:, np.newaxis] > 0, stats['mean'], np.nan)
+
+    def std(self, condition):
+        """
+        Standard deviation across subjects, NaN for channels with fewer than 2
+        """
+        stats = self.stats[condition]
+        n = stats['n'][:, np.newaxis].astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 1, np.sqrt(stats['m2'] / (n - 1)), np.nan)
+
+    def sem(self, condition):
+        """
+        Standard error of the grand average
+        """
+        with np.errstate(invalid='ignore'):
+            return self.std(condition) / np.sqrt(self.n(condition))[:, np.newaxis]
+
+    def tmap(self, condition):
+        """
+        One-sample t-value of the grand average against 0 (for a contrast,
+        the paired t-value), with n - 1 degrees of freedom
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.mean(condition) / self.sem(condition)
+
+    def evokeds(self, stat='mean', conditions=None):
+        """
+        Grand averages (or their standard errors or t-maps) as Evoked objects,
+        ie. for 'erp_export.export_erps' or mne.viz.plot_compare_evokeds.
+        channels without subjects are bad
+
+        Parameters (defaults)
+        ---------------------
+        stat: 'mean', 'sem' or 'tmap' ('mean')
+        conditions: list (None)
+            defaults to all conditions and contrasts
+
+        Returns
+        -------
+        evokeds: dict of condition -> mne.EvokedArray, nave is the number of subjects
+        """
+        import mne
+        info = mne.create_info(list(self.ch_names), self.sfreq, list(self.ch_types))
+        for ch, loc in zip(info['chs'], self.locs):
+            ch['loc'][:] = loc
+        evokeds = {}
+        for name in (conditions or self.conditions):
+            data = getattr(self, stat)(name)
+            evoked = mne.EvokedArray(np.nan_to_num(data), info.copy(), tmin=self.times[0], comment=name,
+                                     nave=int(self.n(name).max()))
+            evoked.info['bads'] = [ch for ch, n in zip(self.ch_names, self.n(name)) if n == 0]
+            evokeds[name] = evoked
+        return evokeds
+
+    def save(self, fname=None):
+        """
+        Write the accumulators to fname (self.fname if None), replacing the
+        file only once it is complete
+
+        Returns
+        -------
+        fname: str
+        """
+        fname = fname or self.fname
+        arrays = dict(subjects=np.array(self.subjects, dtype=str), ch_names=np.array(self.ch_names, dtype=str),
+                      ch_types=np.array(self.ch_types, dtype=str), locs=self.locs,
+                      times=self.times if self.times is not None else np.zeros(0),
+                      sfreq=np.array(self.sfreq if self.sfreq is not None else np.nan),
+                      conditions=np.array(self.conditions, dtype=str),
+                      contrasts=np.array(self.contrasts, dtype=str).reshape(-1, 2),
+                      digest=np.array(self.digest or '', dtype=str))
+        for i, name in enumerate(self.conditions):
+            for key, value in self.stats[name].items():
+                arrays[key + str(i)] = value
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, **arrays)
+        os.replace(tmp, fname)
+        return fname
+
+    def _load(self, fname):
+        with np.load(fname) as f:
+            digest = str(f['digest'])
+            if self.digest is not None and digest != self.digest:
+                print('settings changed since ' + fname + ' was written, starting a new grand average')
+                return
+            self.digest = digest or self.digest
+            self.subjects = [str(name) for name in f['subjects']]
+            self.ch_names = [str(ch) for ch in f['ch_names']]
+            self.ch_types = [str(kind) for kind in f['ch_types']]
+            self.locs = f['locs']
+            self.times = f['times'] if len(f['times']) else None
+            self.sfreq = None if np.isnan(f['sfreq']) else float(f['sfreq'])
+            if not self.contrasts:
+                self.contrasts = [tuple(str(c) for c in pair) for pair in f['contrasts']]
+            for i, name in enumerate(f['conditions']):
+                self.stats[str(name)] = dict((key, f[key + str(i)]) for key in ['n', 'mean', 'm2', 'nave'])
+        print(str(len(self.subjects)) + ' subjects in ' + fname)
+
+    def _channel_rows(self, evoked):
+        """
+        Rows of the evoked channels in the accumulators, adding rows for
+        channels not seen before. checks the time points
+        """
+        if self.times is None:
+            self.times = evoked.times.copy()
+            self.sfreq = float(evoked.info['sfreq'])
+        elif len(evoked.times) != len(self.times) or not np.allclose(evoked.times, self.times):
+            raise ValueError('evoked time points differ from the grand average ('
+                             + str(len(evoked.times)) + ' vs ' + str(len(self.times)) + ')')
+        new = [i for i, ch in enumerate(evoked.ch_names) if ch not in self.ch_names]
+        if new:
+            self.ch_names += [evoked.ch_names[i] for i in new]
+            self.ch_types += evoked.get_channel_types(picks=new)
+            self.locs = np.concatenate([self.locs, [evoked.info['chs'][i]['loc'][:12] for i in new]])
+            for stats in self.stats.values():
+                self._grow(stats)
+        index = dict((ch, i) for i, ch in enumerate(self.ch_names))
+        return np.array([index[ch] for ch in evoked.ch_names])
+
+    def _grow(self, stats):
+        extra = len(self.ch_names) - len(stats['n'])
+        stats['n'] = np.concatenate([stats['n'], np.zeros(extra, stats['n'].dtype)])
+        for key in ['mean', 'm2']:
+            stats[key] = np.concatenate([stats[key], np.zeros((extra, len(self.times)))])
+
+    def _fold(self, name, rows, values, nave):
+        """
+        Welford's update of the rows of one condition with one subject's values
+        """
+        if name not in self.stats:
+            self.stats[name] = dict(n=np.zeros(len(self.ch_names), np.int64),
+                                    mean=np.zeros((len(self.ch_names), len(self.times))),
+                                    m2=np.zeros((len(self.ch_names), len(self.times))),
+                                    nave=np.array(0, np.int64))
+        stats = self.stats[name]
+        stats['n'][rows] += 1
+        delta = values - stats['mean'][rows]
+        stats['mean'][rows] += delta / stats['n'][rows][:, np.newaxis]
+        stats['m2'][rows] += delta * (values - stats['mean'][rows])
+        stats['nave'] = stats['nave'] + nave
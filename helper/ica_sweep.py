@@ -0,0 +1,254 @@
+"""
+ICA fits of several configurations (n_components, random_state, method) on
+one shared PCA decomposition. The epochs are pre-whitened and reduced with
+PCA once, as mne's ICA.fit does before every fit, and only the unmixing of
+the first n_components PCA scores is estimated per candidate, in a process
+pool. Candidates of the same method and random_state are fit in order of
+n_components, each starting from the unmixing of the previous one
+
+    icas, report = sweep_ica(epochs, n_components=[15, 20, 25], random_states=[0, 1], n_jobs=4)
+    print(report)   # fit time, iterations and eog scores of every candidate
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+def pca_decompose(epochs, picks=None, decim=None, reject=None):
+    """
+    Pre-whiten and PCA-reduce the epochs data like ICA.fit does, once for all
+    candidates
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs
+    picks: list (None)
+        channels to decompose, defaults to the good data channels as in ICA.fit
+    decim: int (None)
+        only every decim-th sample of each epoch is used
+    reject: dict (None)
+        peak-to-peak rejection thresholds, ie. from autoreject's
+        get_rejection_threshold. epochs exceeding them are left out
+        (ICA.fit ignores reject for epochs)
+
+    Returns
+    -------
+    pca: dict with info, scores (n_samples, n_channels) of whitened PCA scores,
+        pre_whitener, mean, components, explained_variance and n_samples
+    """
+    import mne
+    if reject is not None:
+        epochs = epochs.copy().drop_bad(reject)
+    if picks is None:
+        picks = mne.pick_types(epochs.info, meg=True, eeg=True, seeg=True, ecog=True, dbs=True,
+                               fnirs=True, exclude='bads')
+    info = mne.pick_info(epochs.info, picks)
+    data = epochs.get_data(picks=picks)
+    if decim is not None:
+        data = data[:, :, ::decim]
+    data = np.hstack(data)
+
+    # z-score every channel type, as ICA's pre-whitener does
+    types = np.array(info.get_channel_types())
+    pre_whitener = np.empty((len(data), 1))
+    for ch_type in np.unique(types):
+        pre_whitener[types == ch_type] = np.std(data[types == ch_type])
+    data /= pre_whitener
+
+    # PCA from the (n_channels, n_channels) covariance instead of an svd of
+    # all samples
+    mean = data.mean(axis=1)
+    data -= mean[:, None]
+    explained_variance, vectors = np.linalg.eigh(np.dot(data, data.T) / (data.shape[1] - 1))
+    order = np.argsort(explained_variance)[::-1]
+    explained_variance = np.maximum(explained_variance[order], 0)
+    components = vectors[:, order].T
+    norms = np.sqrt(explained_variance)
+    norms[norms == 0] = 1.
+    scores = np.dot(components, data).T / norms
+    return dict(info=info, scores=scores, pre_whitener=pre_whitener, mean=mean,
+                components=components, explained_variance=explained_variance,
+                n_samples=scores.shape[0])
+
+
+def sweep_ica(epochs, n_components=(15, 20, 25), random_states=(None,), methods=('fastica',),
+              max_iter=200, fit_params=None, decim=None, reject=None, warm_start=True,
+              eog_ch=None, n_jobs=1, pca=None):
+    """
+    Fit one ICA per combination of n_components, random_states and methods
+    and score each against the eye channels
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs
+    n_components: list of int ((15, 20, 25))
+    random_states: list of int or None ((None,))
+    methods: list of str (('fastica',))
+        'fastica', 'infomax' or 'picard' (needs python-picard). extended
+        infomax is 'infomax' with fit_params=dict(extended=True)
+    max_iter: int (200)
+    fit_params: dict (None)
+        extra parameters of the ICA method, as in mne's ICA
+    decim, reject: int (None), dict (None)
+        see 'pca_decompose'
+    warm_start: bool (True)
+        start each candidate from the unmixing of the previous one with the
+        same method and random_state (and fewer components)
+    eog_ch: str or list (None)
+        eye channels of ICA.find_bads_eog, defaults to the eog channels
+    n_jobs: int (1)
+        number of worker processes
+    pca: dict (None)
+        result of 'pca_decompose' to reuse, ie. from a cache
+
+    Returns
+    -------
+    icas: list of fitted mne ICA objects with the eog components excluded
+    report: pandas dataframe with one row per candidate: n_components,
+        random_state, method, explained variance of the PCA components used,
+        fit time (s), iterations, eog components and their highest |score|
+    """
+    if pca is None:
+        print('computing PCA for ' + str(len(epochs)) + ' epochs...')
+        pca = pca_decompose(epochs, decim=decim, reject=reject)
+    candidates = [(k, method, seed) for method in methods for seed in random_states
+                  for k in sorted(n_components)]
+    # one chain of increasing n_components per (method, random_state)
+    chains = []
+    for method in methods:
+        for seed in random_states:
+            chains.append([i for i, c in enumerate(candidates) if c[1] == method and c[2] == seed])
+    print('fitting ' + str(len(candidates)) + ' ICA candidates in ' + str(len(chains)) + ' chains...')
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # workers memory-map the scores instead of each receiving a copy
+        scores_fname = os.path.join(tmp_dir, 'scores.npy')
+        np.save(scores_fname, pca['scores'])
+        jobs = [(scores_fname, [candidates[i] for i in chain], max_iter, fit_params, warm_start)
+                for chain in chains]
+        if n_jobs == 1 or len(jobs) == 1:
+            fits = [fit_chain(*job) for job in jobs]
+        else:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+                fits = list(pool.map(fit_chain, *zip(*jobs)))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    icas = [None] * len(candidates)
+    rows = [None] * len(candidates)
+    ratio = np.cumsum(pca['explained_variance']) / np.sum(pca['explained_variance'])
+    for chain, chain_fits in zip(chains, fits):
+        for i, (unmixing, n_iter, fit_time) in zip(chain, chain_fits):
+            k, method, seed = candidates[i]
+            ica = make_ica(pca, unmixing, k, method, seed, max_iter, fit_params, n_iter)
+            eog_inds, scores = ica.find_bads_eog(epochs, ch_name=eog_ch)
+            ica.exclude = list(eog_inds)
+            icas[i] = ica
+            rows[i] = dict(n_components=k, random_state=seed, method=method,
+                           explained_variance=ratio[k - 1], fit_time=fit_time, n_iter=n_iter,
+                           n_eog=len(eog_inds), eog_components=' '.join(str(c) for c in eog_inds),
+                           max_eog_score=np.max(np.abs(scores)))
+    return icas, pd.DataFrame(rows)
+
+
+def fit_chain(scores_fname, chain, max_iter=200, fit_params=None, warm_start=True):
+    """
+    Fit the candidates of one chain on the memory-mapped PCA scores (runs in
+    the worker processes)
+
+    Parameters (defaults)
+    ---------------------
+    scores_fname: str, .npy file of the whitened PCA scores
+    chain: list of (n_components, method, random_state), increasing n_components
+    max_iter, fit_params, warm_start: see 'sweep_ica'
+
+    Returns
+    -------
+    fits: list of (unmixing, n_iter, fit time) of every candidate, with the
+        unmixing in the whitened PCA space
+    """
+    from mne.preprocessing import ICA
+    scores = np.load(scores_fname, mmap_mode='r')
+    fits = []
+    w_init = None
+    for k, method, seed in chain:
+        # ICA fills in the method's default parameters
+        params = ICA(k, method=method, max_iter=max_iter, fit_params=fit_params).fit_params
+        data = np.array(scores[:, :k])
+        if warm_start and w_init is not None:
+            init = np.eye(k)
+            init[:len(w_init), :len(w_init)] = w_init
+        else:
+            init = None
+        t0 = time.time()
+        unmixing, n_iter = _fit_unmixing(data, method, seed, params, init)
+        fits.append((unmixing, n_iter, time.time() - t0))
+        w_init = unmixing
+    return fits
+
+
+def make_ica(pca, unmixing, n_components, method='fastica', random_state=None, max_iter=200,
+             fit_params=None, n_iter=None):
+    """
+    mne ICA object of an unmixing found on the shared PCA, the same as what
+    ICA.fit would leave (components sorted by explained variance)
+    """
+    from mne.preprocessing import ICA
+    ica = ICA(n_components, method=method, max_iter=max_iter, fit_params=fit_params,
+              random_state=random_state)
+    ica.info = pca['info']
+    ica.ch_names = pca['info']['ch_names']
+    ica.pre_whitener_ = pca['pre_whitener']
+    ica.pca_mean_ = pca['mean']
+    ica.pca_components_ = pca['components']
+    ica.pca_explained_variance_ = pca['explained_variance']
+    ica.n_components_ = n_components
+    ica.n_samples_ = pca['n_samples']
+    ica.n_iter_ = n_iter
+    ica.reject_ = None
+    ica._update_ica_names()
+
+    norms = np.sqrt(pca['explained_variance'][:n_components])
+    norms[norms == 0] = 1.
+    sources = np.dot(unmixing, pca['scores'][:, :n_components].T)
+    mixing = np.linalg.pinv(unmixing / norms)
+    var = np.sum(mixing ** 2, axis=0) * np.mean(sources ** 2, axis=1)
+    order = np.argsort(var)[::-1]
+    ica.unmixing_matrix_ = (unmixing / norms)[order]
+    ica.mixing_matrix_ = mixing[:, order]
+    ica.current_fit = 'epochs'
+    return ica
+
+
+def _fit_unmixing(data, method, random_state, params, w_init=None):
+    """
+    Run one ICA method on whitened data (n_samples, n_components)
+
+    Returns
+    -------
+    unmixing, n_iter
+    """
+    if method == 'fastica':
+        from sklearn.decomposition import FastICA
+        ica = FastICA(whiten=False, random_state=random_state, w_init=w_init, **params)
+        ica.fit(data)
+        return ica.components_, ica.n_iter_
+    if method == 'infomax':
+        from mne.preprocessing import infomax
+        # infomax takes and returns the transposed unmixing
+        weights = None if w_init is None else w_init.T
+        return infomax(data, weights=weights, random_state=random_state, return_n_iter=True,
+                       verbose=False, **params)
+    if method == 'picard':
+        from picard import picard
+        _, unmixing, _, n_iter = picard(data.T, whiten=False, return_n_iter=True,
+                                        random_state=random_state, w_init=w_init, **params)
+        return unmixing, n_iter + 1
+    raise ValueError('unknown ICA method ' + str(method))
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class Intervals(object):
+    """
+    Sorted, non-overlapping set of closed intervals [onset, offset] for fast
+    membership tests, ie. impedance periods. Overlapping intervals are merged
+    once when the index is built, so every query is a single np.searchsorted
+
+    Parameters
+    ----------
+    onset: list or array of interval onsets
+    offset: list or array of interval offsets (same length and unit as onset)
+    """
+    def __init__(self, onset, offset):
+        onset = np.asarray(onset, dtype=np.float64).ravel()
+        offset = np.asarray(offset, dtype=np.float64).ravel()
+        assert len(onset) == len(offset), "ERROR: onset and offset must have the same length"
+        order = np.argsort(onset, kind='mergesort')
+        onset = onset[order]
+        offset = offset[order]
+        # merge overlapping intervals: a new block starts wherever the onset is
+        # past every offset seen so far
+        reach = np.maximum.accumulate(offset) if len(offset) else offset
+        starts = np.ones(len(onset), dtype=bool)
+        starts[1:] = onset[1:] > reach[:-1]
+        self.onset = onset[starts]
+        self.offset = offset
+        if len(offset):
+            self.offset = np.maximum.reduceat(offset, np.flatnonzero(starts))
+
+    def __len__(self):
+        return len(self.onset)
+
+    def find(self, times):
+        """
+        Index of the interval containing each time, -1 if none
+
+        Parameters
+        ----------
+        times: list or array of times (same unit as the intervals)
+
+        Returns
+        -------
+        index: int array, same shape as times
+        """
+        times = np.asarray(times, dtype=np.float64)
+        index = np.searchsorted(self.onset, times, side='right') - 1
+        inside = index >= 0
+        inside[inside] = times[inside] <= self.offset[index[inside]]
+        return np.where(inside, index, -1)
+
+    def contains(self, times):
+        """
+        Boolean mask of which times fall inside any interval (bounds included)
+
+        Parameters
+        ----------
+        times: list or array of times (same unit as the intervals)
+
+        Returns
+        -------
+        mask: bool array, same shape as times
+        """
+        return self.find(times) >= 0
+
+    def overlaps(self, start, stop):
+        """
+        Boolean mask of which windows [start, stop] overlap any interval
+        (ie. epochs touching a bad segment)
+
+        Parameters
+        ----------
+        start, stop: lists or arrays of window bounds (same unit as the intervals)
+
+        Returns
+        -------
+        mask: bool array, same shape as start
+        """
+        start = np.asarray(start, dtype=np.float64)
+        stop = np.asarray(stop, dtype=np.float64)
+        # last interval starting before the window ends; intervals are merged
+        # so it is also the one reaching furthest
+        index = np.searchsorted(self.onset, stop, side='right') - 1
+        mask = index >= 0
+        mask[mask] = self.offset[index[mask]] >= start[mask]
+        return mask
+
+
+def in_intervals(times, onset, offset):
+    """
+    Boolean mask of which times fall inside any [onset, offset] interval
+    See 'Intervals' to reuse the index for several queries
+
+    Parameters
+    ----------
+    times: list or array of times
+    onset: list or array of interval onsets
+    offset: list or array of interval offsets
+
+    Returns
+    -------
+    mask: bool array, same shape as times
+    """
+    return Intervals(onset, offset).contains(times)
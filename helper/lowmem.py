@@ -0,0 +1,351 @@
+"""
+Low-memory alternative to `read_raw_egi(..., preload=True)`: the recording is
+converted once into a memory-mapped float32 store on disk, filtered chunk by
+chunk into a second store, and epochs are cut directly from the memory map.
+Only the chunk being processed and the epochs are ever held in RAM
+"""
+import json
+import os
+import numpy as np
+import mne
+import filtering
+from intervals import Intervals
+
+
+class MmapRaw(object):
+    """
+    Memory-mapped (n_channels, n_times) float32 recording with its mne Info.
+    It has the parts of the Raw interface the helpers use (ch_names, n_times,
+    info, get_data), so ie. 'scipy_eog.find_eyeblinks' runs on it directly.
+    Use 'convert_egi' or 'MmapRaw.open' to get one
+
+    Bipolar channels added with 'add_bipolar' are virtual: they are computed
+    from their two channels whenever data is read
+    """
+    def __init__(self, fname, info, shape, first_samp=0, virtual=None, hidden=None,
+                 annotations=None, mode='r'):
+        self.fname = fname
+        self.info = info
+        self.first_samp = first_samp
+        self.data = np.memmap(fname + '.dat', dtype=np.float32, mode=mode, shape=tuple(shape))
+        # virtual channel name -> (anode, cathode, channel type)
+        self.virtual = virtual or {}
+        # channels replaced by a bipolar channel
+        self.hidden = hidden or []
+        self.annotations = annotations or mne.Annotations([], [], [])
+
+    @classmethod
+    def open(cls, fname, mode='r'):
+        """
+        Open a store written by 'convert_egi' or 'MmapRaw.filter'
+        """
+        with open(fname + '.json') as fp:
+            meta = json.load(fp)
+        info = mne.io.read_info(fname + '-info.fif')
+        annotations = mne.Annotations(meta['annot_onset'], meta['annot_duration'],
+                                      meta['annot_description'])
+        return cls(fname, info, meta['shape'], meta['first_samp'],
+                   dict((k, tuple(v)) for k, v in meta['virtual'].items()),
+                   meta['hidden'], annotations, mode)
+
+    def save(self):
+        """
+        Write the sidecar files (info, virtual channels, annotations)
+        The data itself is already on disk
+        """
+        self.data.flush()
+        if os.path.exists(self.fname + '-info.fif'):
+            os.remove(self.fname + '-info.fif')
+        mne.io.write_info(self.fname + '-info.fif', self.info)
+        meta = dict(shape=list(self.data.shape), first_samp=self.first_samp,
+                    virtual=self.virtual, hidden=self.hidden,
+                    annot_onset=self.annotations.onset.tolist(),
+                    annot_duration=self.annotations.duration.tolist(),
+                    annot_description=self.annotations.description.tolist())
+        with open(self.fname + '.json', 'w') as fp:
+            json.dump(meta, fp)
+        return self
+
+    @property
+    def n_times(self):
+        return self.data.shape[1]
+
+    @property
+    def ch_names(self):
+        """physical channels (minus hidden ones) followed by virtual channels"""
+        return [ch for ch in self.info['ch_names'] if ch not in self.hidden] + list(self.virtual)
+
+    def get_data(self, picks=None, start=0, stop=None):
+        """
+        Read channels from the store, computing virtual channels on the fly
+
+        Parameters (defaults)
+        ---------------------
+        picks: list of int or str (None)
+            indices into ch_names or channel names. None reads all ch_names
+        start, stop: int (0, None)
+            first and last (excluded) sample to read
+
+        Returns
+        -------
+        data: float64 array (n_picks, n_samples)
+        """
+        names = self._pick_names(picks)
+        stop = self.n_times if stop is None else stop
+        out = np.empty((len(names), stop - start))
+        for i, name in enumerate(names):
+            if name in self.virtual:
+                anode, cathode, kind = self.virtual[name]
+                out[i] = self._row(anode, start, stop)
+                out[i] -= self._row(cathode, start, stop)
+            else:
+                out[i] = self._row(name, start, stop)
+        return out
+
+    def add_bipolar(self, anode, cathode, name, ch_type='eog', drop_refs=True):
+        """
+        Add a virtual bipolar channel (anode - cathode), like
+        mne.set_bipolar_reference but without copying any data
+        """
+        self.virtual[name] = (anode, cathode, ch_type)
+        if drop_refs:
+            self.hidden = self.hidden + [ch for ch in (anode, cathode) if ch not in self.hidden]
+        return self
+
+    def set_annotations(self, annotations):
+        self.annotations = annotations
+        return self
+
+    def find_events(self, stim_channel):
+        """
+        Onsets of a stim channel as an mne events array (sample, 0, value),
+        like mne.find_events with its default settings
+        """
+        stim = self._row(stim_channel, 0, self.n_times)
+        onsets = np.flatnonzero(np.diff(stim) > 0) + 1
+        events = np.zeros((len(onsets), 3), dtype=np.int64)
+        events[:, 0] = onsets + self.first_samp
+        events[:, 2] = stim[onsets]
+        return events
+
+    def filter(self, l_freq, h_freq, fname, chunk_duration=60., picks=None, method='fir',
+               n_jobs=1):
+        """
+        Zero-phase filter the store chunk by chunk into a new store
+        (overlap-save: every chunk is read with half a filter length on each
+        side and only the fully filtered samples are written, see
+        'filtering.filter_data')
+
+        Parameters (defaults)
+        ---------------------
+        l_freq, h_freq: float
+            highpass and lowpass edges, as in raw.filter
+        fname: str
+            base file name of the new store
+        chunk_duration: float (60.)
+            seconds of data filtered at a time ('fir' only, 'iir' filters
+            whole channels)
+        picks: list of str (None)
+            channels to filter, defaults to the eeg and eog channels. other
+            channels (ie. stim) are copied unchanged
+        method: 'fir' or 'iir' ('fir')
+        n_jobs: int (1)
+            threads filtering blocks of channels in parallel
+
+        Returns
+        -------
+        filtered: MmapRaw of the new store
+        """
+        sfreq = self.info['sfreq']
+        if picks is None:
+            picks = mne.pick_types(self.info, meg=False, eeg=True, eog=True, exclude=[])
+        else:
+            picks = [self.info['ch_names'].index(ch) for ch in picks]
+        filtered = MmapRaw(fname, self.info.copy(), self.data.shape, self.first_samp,
+                           dict(self.virtual), list(self.hidden), self.annotations.copy(), mode='w+')
+        chunk = max(int(round(chunk_duration * sfreq)), 1)
+        others = np.setdiff1d(np.arange(self.data.shape[0]), picks)
+        for start in range(0, self.n_times, chunk):
+            filtered.data[others, start:start + chunk] = self.data[others, start:start + chunk]
+        print('filtering ' + str(len(picks)) + ' channels...')
+        filtering.filter_data(self.data, sfreq, l_freq, h_freq, method, picks, out=filtered.data,
+                              n_jobs=n_jobs, chunk_duration=chunk_duration)
+        filtering._set_filter_info(filtered.info, l_freq, h_freq)
+        return filtered.save()
+
+    def epochs(self, events, event_id, tmin, tmax, baseline=None, metadata=None, picks=None,
+               reject_by_annotation=True):
+        """
+        Cut epochs straight from the memory map into an mne.EpochsArray
+        Epochs outside the recording or overlapping a 'bad' annotation are
+        dropped (with their metadata rows) and logged in drop_log, as
+        mne.Epochs does
+
+        Parameters (defaults)
+        ---------------------
+        events: mne events array
+        event_id: dict of event name -> id
+        tmin, tmax: float
+            start and end of each epoch in seconds
+        baseline: tuple (None)
+            baseline period, as in mne.Epochs
+        metadata: pandas dataframe (None)
+            one row per selected event
+        picks: list of str (None)
+            channel names, defaults to good eeg/eog channels (virtual included)
+        reject_by_annotation: bool (True)
+            drop epochs overlapping annotations starting with 'bad'
+
+        Returns
+        -------
+        epochs: mne.EpochsArray (projections are added but not applied)
+        """
+        sfreq = self.info['sfreq']
+        events = events[np.isin(events[:, 2], list(event_id.values()))]
+        first = int(np.round(tmin * sfreq))
+        last = int(np.round(tmax * sfreq))
+        start = events[:, 0] - self.first_samp + first
+        # (reason, mask) of every drop reason, named like mne's drop_log
+        reasons = [('NO_DATA', (start < 0) | (start + last - first >= self.n_times))]
+        if reject_by_annotation and len(self.annotations):
+            description = self.annotations.description
+            onset = self.annotations.onset
+            offset = onset + self.annotations.duration
+            for desc in np.unique(description):
+                if desc.lower().startswith('bad'):
+                    sel = description == desc
+                    overlaps = Intervals(onset[sel], offset[sel]).overlaps(start / sfreq,
+                                                                          (start + last - first) / sfreq)
+                    reasons.append((desc, overlaps & ~reasons[0][1]))
+        keep = ~np.any([mask for reason, mask in reasons], axis=0)
+        drop_log = [()] * len(keep)
+        for i in np.flatnonzero(~keep):
+            drop_log[i] = tuple(reason for reason, mask in reasons if mask[i])
+        print(str(np.sum(~keep)) + ' of ' + str(len(keep)) + ' epochs dropped')
+        events = events[keep]
+        start = start[keep]
+        if metadata is not None:
+            metadata = metadata[keep].reset_index(drop=True)
+
+        if picks is None:
+            picks = self._default_picks()
+        physical = [ch for ch in picks if ch not in self.virtual]
+        virtual = [ch for ch in picks if ch in self.virtual]
+        needed = sorted(set(physical) | set(ch for v in virtual for ch in self.virtual[v][:2]),
+                        key=self.info['ch_names'].index)
+        rows = [self.info['ch_names'].index(ch) for ch in needed]
+        data = np.empty((len(start), len(needed), last - first + 1))
+        for i, s in enumerate(start):
+            data[i] = self.data[rows, s:s + last - first + 1]
+        kwargs = dict(tmin=first / sfreq, baseline=baseline, proj=False,
+                      selection=np.flatnonzero(keep), drop_log=tuple(drop_log))
+
+        info = mne.pick_info(self.info, [self.info['ch_names'].index(ch) for ch in physical])
+        epochs = mne.EpochsArray(data[:, [needed.index(ch) for ch in physical]], info, events,
+                                 event_id=event_id, metadata=metadata, **kwargs)
+        for name in virtual:
+            anode, cathode, kind = self.virtual[name]
+            v_info = mne.pick_info(self.info, [self.info['ch_names'].index(anode)])
+            mne.rename_channels(v_info, {anode: name})
+            v_data = data[:, [needed.index(anode)]] - data[:, [needed.index(cathode)]]
+            v_epochs = mne.EpochsArray(v_data, v_info, events, event_id=event_id, **kwargs)
+            v_epochs.set_channel_types({name: kind})
+            epochs.add_channels([v_epochs], force_update_info=True)
+        return epochs
+
+    def _default_picks(self):
+        picks = mne.pick_types(self.info, meg=False, eeg=True, eog=True, stim=False, exclude='bads')
+        names = [self.info['ch_names'][i] for i in picks]
+        return [ch for ch in names if ch not in self.hidden] + list(self.virtual)
+
+    def _pick_names(self, picks):
+        names = self.ch_names
+        if picks is None:
+            return names
+        return [names[p] if isinstance(p, (int, np.integer)) else p for p in picks]
+
+    def _row(self, name, start, stop):
+        return self.data[self.info['ch_names'].index(name), start:stop]
+
+
+def read_egi_header(raw_fname):
+    """
+    Read the header of an unsegmented EGI simple binary file (as
+    mne.io.read_raw_egi does)
+
+    Returns
+    -------
+    header: dict with sfreq, n_channels, n_events, event_codes, n_samples (as
+        written in the header), dtype, cal (V per unit) and offset of the
+        data in bytes. None if the file is missing or its header incomplete
+    """
+    if not os.path.exists(raw_fname) or os.path.getsize(raw_fname) < 36:
+        return None
+    with open(raw_fname, 'rb') as fp:
+        version = int(np.fromfile(fp, '>i4', 1)[0])
+        fp.seek(20)
+        sfreq, n_channels, gain, bits, value_range = np.fromfile(fp, '>i2', 5).tolist()
+        n_samples = int(np.fromfile(fp, '>i4', 1)[0])
+        n_events = int(np.fromfile(fp, '>i2', 1)[0])
+        codes = fp.read(4 * n_events)
+    if version & 1:
+        raise ValueError(raw_fname + ': only unsegmented EGI files are supported')
+    if len(codes) < 4 * n_events:
+        return None
+    dtype = {2: '>i2', 4: '>f4', 6: '>f8'}[version & 6]
+    cal = value_range / 2. ** bits if value_range and bits else 1e-6
+    return dict(sfreq=sfreq, n_channels=n_channels, n_events=n_events,
+                event_codes=[codes[i:i + 4].decode().strip() for i in range(0, len(codes), 4)],
+                n_samples=n_samples, dtype=np.dtype(dtype), cal=cal, offset=36 + 4 * n_events)
+
+
+def convert_egi(raw_fname, fname, montage='GSN-HydroCel-128', chunk_duration=60.):
+    """
+    Convert an EGI .raw file into a memory-mapped float32 store, reading
+    chunk_duration seconds at a time (the raw file is never preloaded)
+
+    Parameters (defaults)
+    ---------------------
+    raw_fname: str
+        EGI raw file
+    fname: str
+        base file name of the store (fname.dat, fname.json, fname-info.fif)
+    montage: str ('GSN-HydroCel-128')
+        montage to set on the channels
+    chunk_duration: float (60.)
+        seconds of data converted at a time
+
+    Returns
+    -------
+    store: MmapRaw
+    """
+    raw = mne.io.read_raw_egi(raw_fname, preload=False)
+    raw.set_montage(mne.channels.make_standard_montage(montage), on_missing='ignore')
+    return convert_raw(raw, fname, chunk_duration)
+
+
+def convert_raw(raw, fname, chunk_duration=60.):
+    """
+    Convert any (preferably not preloaded) mne Raw into a memory-mapped float32
+    store, reading chunk_duration seconds at a time
+
+    Parameters (defaults)
+    ---------------------
+    raw: Raw object
+    fname: str
+        base file name of the store (fname.dat, fname.json, fname-info.fif)
+    chunk_duration: float (60.)
+        seconds of data converted at a time
+
+    Returns
+    -------
+    store: MmapRaw
+    """
+    store = MmapRaw(fname, raw.info.copy(), (len(raw.ch_names), raw.n_times), raw.first_samp,
+                    annotations=raw.annotations.copy(), mode='w+')
+    chunk = max(int(round(chunk_duration * raw.info['sfreq'])), 1)
+    print('converting raw file to memory-mapped float32...')
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        store.data[:, start:stop] = raw.get_data(start=start, stop=stop)
+    return store.save()
@@ -0,0 +1,224 @@
+"""
+Precomputed index of the trial metadata (the 'create_df_onset' dataframe, ie.
+the epochs metadata) for fast condition subsets. Every value of every indexed
+field gets a bitmap of the trials that have it, so a query is a few bitwise
+ANDs/ORs of packed bitmaps instead of a pandas string query, and it returns
+trial positions instead of an Epochs copy
+
+    index = MetadataIndex(epochs.metadata)
+    pos = index.query("label=='lstS' and cond==1")      # or index.select(label='lstS', cond=1)
+    evoked = average(epochs, pos)                       # same as epochs[pos].average(), no copy
+    pos = index.query("cond in (1, 2) or indx==300")
+
+An index of the log's onsets (df_tlstS) is turned into one of the epochs that
+were kept with 'restrict(epochs.selection)'
+"""
+import ast
+import numpy as np
+
+FIELDS = ('label', 'cond', 'indx')
+# epochs summed at a time by 'average'
+_AVERAGE_BLOCK = 256
+
+
+class MetadataIndex(object):
+    """
+    Bitmap index of some fields of a trial dataframe
+
+    Parameters (defaults)
+    ---------------------
+    df: pandas dataframe, one row per trial (ie. from 'create_df_onset' or
+        epochs.metadata)
+    fields: list of column names (FIELDS)
+        columns to index, missing ones are skipped
+    """
+    def __init__(self, df, fields=FIELDS):
+        self.n_rows = len(df)
+        # field -> (value -> row of bitmaps), and the (n_values, n_bytes) packed bitmaps
+        self.values = {}
+        self.bitmaps = {}
+        for name in fields:
+            if name not in df.columns:
+                continue
+            codes, uniques = _factorize(df[name])
+            onehot = codes[np.newaxis, :] == np.arange(len(uniques))[:, np.newaxis]
+            self.values[name] = dict((value, i) for i, value in enumerate(uniques))
+            self.bitmaps[name] = np.packbits(onehot, axis=1)
+        self._all = np.packbits(np.ones(self.n_rows, bool))
+        self._queries = {}
+
+    @property
+    def fields(self):
+        return list(self.values)
+
+    def bitmap(self, **terms):
+        """
+        Packed bitmap (uint8 array) of the trials matching every term (AND);
+        a term's value can be a list of values, matching any of them (OR).
+        combine bitmaps with & and |, and turn them into positions with
+        'positions'
+        """
+        result = self._all
+        for name, value in terms.items():
+            result = result & self._field_bitmap(name, value)
+        return result
+
+    def positions(self, bitmap):
+        """
+        Sorted int positions of the trials set in a bitmap
+        """
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.n_rows))
+
+    def select(self, **terms):
+        """
+        Positions of the trials matching every term, see 'bitmap'
+        """
+        return self.positions(self.bitmap(**terms))
+
+    def query(self, expr):
+        """
+        Positions of the trials matching a pandas-style query of ==, !=, in,
+        not in, and, or and not on the indexed fields, ie. "label=='lstS' and
+        cond in (1, 2)". repeated queries come from a cache
+
+        Returns
+        -------
+        positions: int array, read-only (it is shared with later calls)
+        """
+        if expr not in self._queries:
+            tree = ast.parse(expr, mode='eval')
+            positions = self.positions(self._evaluate(tree.body))
+            positions.flags.writeable = False
+            self._queries[expr] = positions
+        return self._queries[expr]
+
+    def counts(self, name):
+        """
+        Number of trials of every value of a field
+
+        Returns
+        -------
+        counts: dict of value -> int
+        """
+        bits = np.unpackbits(self.bitmaps[name], axis=1, count=self.n_rows)
+        return dict((value, int(bits[i].sum())) for value, i in self.values[name].items())
+
+    def restrict(self, selection):
+        """
+        Index of the given trials only, ie. epochs.selection for the epochs
+        left after dropping: positions of the result are epoch positions
+
+        Returns
+        -------
+        index: MetadataIndex
+        """
+        selection = np.asarray(selection)
+        index = MetadataIndex.__new__(MetadataIndex)
+        index.n_rows = len(selection)
+        index.values = dict((name, dict(values)) for name, values in self.values.items())
+        index.bitmaps = dict((name, np.packbits(np.unpackbits(bitmaps, axis=1, count=self.n_rows)[:, selection],
+                                                axis=1))
+                             for name, bitmaps in self.bitmaps.items())
+        index._all = np.packbits(np.ones(index.n_rows, bool))
+        index._queries = {}
+        return index
+
+    def _field_bitmap(self, name, value):
+        """
+        Bitmap of one field equal to value (or any of a list of values)
+        """
+        if name not in self.values:
+            raise KeyError('field ' + str(name) + ' is not indexed, indexed fields are ' + str(self.fields))
+        if isinstance(value, (list, tuple, set, np.ndarray)):
+            result = np.zeros_like(self._all)
+            for v in value:
+                result = result | self._field_bitmap(name, v)
+            return result
+        row = _lookup(self.values[name], value)
+        if row is None:
+            return np.zeros_like(self._all)
+        return self.bitmaps[name][row]
+
+    def _evaluate(self, node):
+        """
+        Bitmap of a parsed query expression
+        """
+        if isinstance(node, ast.BoolOp):
+            bitmaps = [self._evaluate(value) for value in node.values]
+            result = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                result = result & bitmap if isinstance(node.op, ast.And) else result | bitmap
+            return result
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~self._evaluate(node.operand) & self._all
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            left, op, right = node.left, node.ops[0], node.comparators[0]
+            if isinstance(right, ast.Name) and not isinstance(left, ast.Name):
+                left, right = right, left
+            if isinstance(left, ast.Name):
+                value = ast.literal_eval(right)
+                bitmap = self._field_bitmap(left.id, value)
+                if isinstance(op, (ast.Eq, ast.In)):
+                    return bitmap
+                if isinstance(op, (ast.NotEq, ast.NotIn)):
+                    return ~bitmap & self._all
+        raise ValueError('unsupported query ' + ast.dump(node) + ", use ==, !=, in, not in, and, or, not")
+
+
+def average(epochs, positions, comment=None):
+    """
+    Average of the epochs at positions, the same as
+    `epochs[positions].average()` but without copying the epochs (preloaded)
+
+    Returns
+    -------
+    evoked: mne.Evoked
+    """
+    positions = np.asarray(positions)
+    if not len(positions):
+        raise ValueError('no epochs to average')
+    # as in 'erp_export.grouped_evokeds', a one epoch average gives the channels and info
+    template = epochs[int(positions[0])].average()
+    picks = [epochs.ch_names.index(ch) for ch in template.ch_names]
+    data = epochs.get_data(copy=False)
+    # sum the selected epochs a block at a time: the cost follows the subset and no
+    # subset copy larger than a block is made (sorted, so each block reads in order)
+    positions = np.unique(positions)
+    total = np.zeros(data.shape[1:], data.dtype)
+    for start in range(0, len(positions), _AVERAGE_BLOCK):
+        total += data[positions[start:start + _AVERAGE_BLOCK]].sum(axis=0)
+    nave = len(positions)
+    evoked = template
+    evoked.data = total[picks] / nave
+    evoked.nave = nave
+    if comment is not None:
+        evoked.comment = comment
+    return evoked
+
+
+def _factorize(column):
+    """
+    Integer codes and unique values of a column, categoricals without a copy
+    """
+    import pandas as pd
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), list(column.cat.categories)
+    codes, uniques = pd.factorize(column, sort=True)
+    return codes, list(np.asarray(uniques).tolist())
+
+
+def _lookup(values, value):
+    """
+    Row of a value, also matching '1' to 1 and 1 to '1' since the log fields
+    are read as text or small integers
+    """
+    if value in values:
+        return values[value]
+    for convert in (str, int):
+        try:
+            key = convert(value)
+        except (TypeError, ValueError):
+            continue
+        if key in values:
+            return values[key]
+    return None
@@ -0,0 +1,757 @@
+"""
+Batch version of walkthrough.py: every step of the walkthrough is a stage
+function, 'run_subject' chains them for one subject and 'run_batch' runs many
+subjects in a process pool, writing each subject's results to disk
+
+All settings come from one validated PipelineConfig (see 'pipeline_config'),
+read from a TOML/YAML file and/or the command line. mne, autoreject and
+matplotlib are only imported by the stages that use them
+
+usage: python helper/pipeline.py data_dir out_dir [--n-jobs 4] [--blas-threads 1] [--cache-dir cache/]
+       [--ica-sweep 15 20 25] [--ica-n-jobs 4]
+       python helper/pipeline.py --config config.toml [data_dir out_dir] [...]
+"""
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import bad_channels
+import erp_export
+import extract_nslog_event
+import features
+import qc
+import reject
+from grand_average import GrandAverage
+from pipeline_config import EOG_METHODS, check_subject, load_config, make_config
+from profiling import StageProfiler, profiled, stage, summarize
+from stage_cache import StageCache, cached
+
+# parameters each cached stage depends on (see 'run_subject')
+STAGE_PARAMS = dict(
+    filter=['montage', 'l_freq', 'h_freq', 'filter_method'],
+    events=['expected'],
+    epochs=['bads', 'auto_bads', 'bads_z_thresh', 'bads_corr_thresh', 'eog_anode', 'eog_cathode',
+            'eog_method', 'eog_thresh', 'eog_duration', 'eog_k', 'eog_window', 'saccade_anode',
+            'saccade_cathode', 'stim_channel', 'event_id', 'tmin', 'tmax', 'low_memory'],
+    ica=['ica_n_components', 'ica_method', 'ica_max_iter', 'random_state', 'ica_decim'],
+    ica_sweep=['ica_n_components', 'ica_method', 'ica_max_iter', 'random_state', 'ica_decim', 'ica_sweep'],
+    autoreject=['random_state', 'ar_grid'],
+)
+# settings of the evoked responses, a grand average is only continued while they are unchanged
+# (the ICA sweep is only reported, it does not change them)
+GRAND_PARAMS = sorted(set(name for stage, names in STAGE_PARAMS.items() if stage != 'ica_sweep' for name in names)
+                      | {'conditions', 'autoreject'})
+# environment variables read by the BLAS/OpenMP libraries when they load
+_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+@profiled()
+def load_raw(raw_fname, params):
+    """
+    Read the EGI .raw file and set the montage
+    """
+    import mne
+    print('reading raw file...')
+    raw = mne.io.read_raw_egi(raw_fname, preload=True)
+    raw.set_montage(mne.channels.make_standard_montage(params.montage), on_missing='ignore')
+    return raw
+
+
+@profiled()
+def filter_raw(raw, params):
+    """
+    Apply bandpass filter to raw file (highpass, lowpass), in place, with
+    params.filter_n_jobs threads (see 'filtering.filter_raw')
+    """
+    import filtering
+    return filtering.filter_raw(raw, params.l_freq, params.h_freq, params.filter_method,
+                                n_jobs=params.filter_n_jobs)
+
+
+@profiled()
+def parse_events(ns_eventlog, params):
+    """
+    Parse the ns event log (see 'extract_nslog_event.create_df_chunked'),
+    checking the event counts against params.expected
+
+    Returns
+    -------
+    events: dict with df_tlst, df_tlstS, imp_onset, imp_offset and imp_dur
+    """
+    (df_lst, df_plst, df_tlst, df_slst, df_tlstS,
+     imp_onset, imp_offset, imp_dur) = extract_nslog_event.create_df_chunked(
+        ns_eventlog, schema=params.schema())
+    return dict(df_tlst=df_tlst, df_tlstS=df_tlstS, imp_onset=imp_onset,
+                imp_offset=imp_offset, imp_dur=imp_dur)
+
+
+@profiled()
+def detect_bads(raw_fname, events, params):
+    """
+    Find bad channels in the unfiltered recording, read chunk by chunk and
+    leaving out the impedance checks (see 'bad_channels.find_bad_channels')
+
+    Returns
+    -------
+    table: pandas dataframe with the measures of every channel and why it is bad
+    """
+    import mne
+    raw = mne.io.read_raw_egi(raw_fname, preload=False)
+    raw.set_montage(mne.channels.make_standard_montage(params.montage), on_missing='ignore')
+    return bad_channels.find_bad_channels(raw, z_thresh=params.bads_z_thresh,
+                                          corr_thresh=params.bads_corr_thresh,
+                                          exclude=(events['imp_onset'], events['imp_offset']))
+
+
+@profiled()
+def annotate_raw(raw, events, params, bads=None):
+    """
+    Mark impedance periods and eye blinks as bad segments, set the bad
+    channels (params.bads if bads is None), create the bipolar 'EB' eye
+    channel and set the eeg reference
+    """
+    import mne
+    from mne.preprocessing import eog
+    annot_imp = mne.Annotations(events['imp_onset'], events['imp_dur'], 'bad imp',
+                                orig_time=raw.info['meas_date'])
+    raw.set_annotations(annot_imp)
+    bads = params.bads if bads is None else bads
+    raw.info['bads'] = [ch for ch in bads if ch in raw.ch_names]
+
+    raw = mne.set_bipolar_reference(raw, [params.eog_anode], [params.eog_cathode], ['EB'])
+    raw.set_channel_types({'EB': 'eog'})
+    if params.eog_method == 'adaptive':
+        import scipy_eog
+        with stage('eye_annotations'):
+            annot_eog = scipy_eog.eye_annotations(raw, 'EB', _saccade_pair(params), events['imp_onset'],
+                                                  events['imp_offset'], orig_time=raw.info['meas_date'],
+                                                  k=params.eog_k, window=params.eog_window)
+    else:
+        with stage('find_eog_events'):
+            events_eog = eog.find_eog_events(raw, reject_by_annotation=True, thresh=params.eog_thresh)
+        eog_onset = (events_eog[:, 0] - raw.first_samp) / raw.info['sfreq']
+        annot_eog = mne.Annotations(eog_onset, params.eog_duration, 'bad eye',
+                                    orig_time=raw.info['meas_date'])
+    raw.set_annotations(annot_imp + annot_eog)
+
+    with stage('set_eeg_reference'):
+        raw.set_eeg_reference('average', projection=True)
+    return raw
+
+
+@profiled()
+def make_epochs(raw, events, params):
+    """
+    Epoch the trial onsets with the onset dataframe as metadata
+    """
+    import mne
+    events_tlst = mne.find_events(raw, stim_channel=params.stim_channel)
+    events_tlst = extract_nslog_event.assign_event_id(events['df_tlst'], events_tlst, raw.info['sfreq'],
+                                                      params.schema())
+    # mne checks the metadata against every event passed, not just the event_id ones
+    events_tlst = events_tlst[np.isin(events_tlst[:, 2], list(params.event_id.values()))]
+    picks = mne.pick_types(raw.info, meg=False, eeg=True, eog=True, stim=False, exclude='bads')
+    return mne.Epochs(raw, events_tlst, params.event_id, params.tmin, params.tmax,
+                      proj=False, picks=picks, baseline=(params.tmin, 0), preload=True,
+                      reject=None, reject_by_annotation=True, metadata=events['df_tlstS'])
+
+
+@profiled()
+def prepare_lowmem(raw_fname, events, params, store_dir, bads=None):
+    """
+    Low-memory version of load_raw, filter_raw and annotate_raw: the raw file
+    is converted to a memory-mapped float32 store in store_dir, filtered
+    chunk-wise and given a virtual bipolar 'EB' channel (see 'lowmem.MmapRaw').
+    Eye blinks are found with 'scipy_eog.find_eyeblinks' on the EB channel
+    (or 'scipy_eog.eye_annotations' if params.eog_method is 'adaptive')
+
+    Returns
+    -------
+    store: the annotated lowmem.MmapRaw
+    """
+    import mne
+    import lowmem
+    import scipy_eog
+    from intervals import in_intervals
+    store = lowmem.convert_egi(raw_fname, os.path.join(store_dir, 'raw'), params.montage)
+    store = store.filter(params.l_freq, params.h_freq, os.path.join(store_dir, 'filtered'),
+                         method=params.filter_method, n_jobs=params.filter_n_jobs)
+    bads = params.bads if bads is None else bads
+    store.info['bads'] = [ch for ch in bads if ch in store.info['ch_names']]
+    store.add_bipolar(params.eog_anode, params.eog_cathode, 'EB')
+
+    if params.eog_method == 'adaptive':
+        annot_eog = scipy_eog.eye_annotations(store, 'EB', _saccade_pair(params), events['imp_onset'],
+                                              events['imp_offset'], k=params.eog_k, window=params.eog_window,
+                                              chunk_duration=60.)
+    else:
+        samples, heights = scipy_eog.find_eyeblinks(store, 'EB', threshold=params.eog_thresh,
+                                                    chunk_duration=60.)
+        eog_onset = samples / store.info['sfreq']
+        eog_onset = eog_onset[~in_intervals(eog_onset, events['imp_onset'], events['imp_offset'])]
+        annot_eog = mne.Annotations(eog_onset, params.eog_duration, 'bad eye')
+    store.set_annotations(mne.Annotations(events['imp_onset'], events['imp_dur'], 'bad imp') + annot_eog)
+    return store
+
+
+def _saccade_pair(params):
+    """
+    The horizontal eye channel pair of 'adaptive' eye detection, None if not set
+    """
+    if params.saccade_anode is None:
+        return None
+    return (params.saccade_anode, params.saccade_cathode)
+
+
+@profiled()
+def make_epochs_lowmem(store, events, params):
+    """
+    Low-memory version of make_epochs: epochs are cut straight from the
+    memory map of 'prepare_lowmem'
+    """
+    events_tlst = store.find_events(params.stim_channel)
+    events_tlst = extract_nslog_event.assign_event_id(events['df_tlst'], events_tlst, store.info['sfreq'],
+                                                      params.schema())
+    events_tlst = events_tlst[np.isin(events_tlst[:, 2], list(params.event_id.values()))]
+    epochs = store.epochs(events_tlst, params.event_id, params.tmin, params.tmax,
+                          baseline=(params.tmin, 0), metadata=events['df_tlstS'])
+    epochs.set_eeg_reference('average', projection=True)
+    return epochs
+
+
+@profiled()
+def fit_ica(epochs, params):
+    """
+    Fit ICA and exclude the components correlating with the eye channel
+    (apply it with `ica.apply(epochs)`)
+
+    Returns
+    -------
+    ica: the fitted ICA object
+    """
+    from autoreject import get_rejection_threshold
+    from mne.preprocessing import ICA
+    with stage('get_rejection_threshold'):
+        reject = get_rejection_threshold(epochs, random_state=params.random_state)
+    ica = ICA(n_components=params.ica_n_components, method=params.ica_method,
+              max_iter=params.ica_max_iter, random_state=params.random_state)
+    print('fitting ica...')
+    with stage('ica.fit'):
+        ica.fit(epochs, reject=reject, decim=params.ica_decim)
+    eog_inds, scores = ica.find_bads_eog(epochs)
+    ica.exclude += eog_inds
+    return ica
+
+
+@profiled()
+def sweep_ica(epochs, params, reject=None):
+    """
+    Fit every ICA configuration of params.ica_sweep (keyword arguments of
+    'ica_sweep.sweep_ica', ie. dict(n_components=[15, 20, 25], random_states=[0, 1]))
+    on one shared PCA, params.ica_n_jobs at a time, for comparison only: the
+    candidates are warm-started, so the ICA that cleans the data is still the
+    one of 'fit_ica'. The configured ica_n_components, random_state and
+    ica_method are always among them
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs
+    params: PipelineConfig
+    reject: dict (None)
+        rejection threshold of the PCA, ie. the fitted ICA's reject_, so the
+        candidates see the same epochs as 'fit_ica'
+
+    Returns
+    -------
+    report: pandas dataframe, one row per candidate (see 'ica_sweep.sweep_ica'),
+        'configured' marks the configured one
+    """
+    import ica_sweep
+    sweep = dict(params.ica_sweep)
+    sweep['n_components'] = sorted(set(sweep.get('n_components', [])) | {params.ica_n_components})
+    sweep['random_states'] = list(sweep.get('random_states', []))
+    if params.random_state not in sweep['random_states']:
+        sweep['random_states'].append(params.random_state)
+    sweep['methods'] = list(sweep.get('methods', []))
+    if params.ica_method not in sweep['methods']:
+        sweep['methods'].append(params.ica_method)
+    sweep.setdefault('max_iter', params.ica_max_iter)
+    sweep.setdefault('decim', params.ica_decim)
+    sweep.setdefault('reject', reject)
+    icas, report = ica_sweep.sweep_ica(epochs, n_jobs=params.ica_n_jobs, **sweep)
+    report['configured'] = [ica.n_components == params.ica_n_components and ica.method == params.ica_method
+                            and ica.random_state == params.random_state for ica in icas]
+    return report
+
+
+@profiled()
+def fit_autoreject(epochs, params, prior=None):
+    """
+    Fit autoreject on the epochs (clean them with `ar.transform(epochs)`),
+    searching the channel thresholds on params.ar_n_jobs cores (see
+    'reject.fit_autoreject')
+    """
+    return reject.fit_autoreject(epochs, n_jobs=params.ar_n_jobs, random_state=params.random_state,
+                                 grid=params.ar_grid, prior=prior)
+
+
+def get_autoreject(subject, epochs, params, cache=None, key=None):
+    """
+    AutoReject of the subject: rebuilt from the thresholds of an earlier run
+    in params.ar_thresholds/subject/ar_thresholds.csv if there are any
+    (refit around their n_interpolate and consensus if the channels changed),
+    else fit (and cached)
+    """
+    previous = None
+    if params.ar_thresholds:
+        previous = os.path.join(params.ar_thresholds, subject, 'ar_thresholds.csv')
+    if previous and os.path.exists(previous):
+        thresholds = reject.read_thresholds(previous)
+        try:
+            ar = reject.from_thresholds(thresholds, epochs)
+            print('reusing autoreject thresholds of ' + previous)
+            return ar
+        except ValueError:
+            return fit_autoreject(epochs, params, reject.prior_of(thresholds))
+    return cached(cache, 'autoreject', key, lambda: fit_autoreject(epochs, params))
+
+
+@profiled()
+def make_evokeds(epochs, params):
+    """
+    Average the epochs of each condition (see 'erp_export.grouped_evokeds')
+
+    Returns
+    -------
+    evokeds: dict of condition name -> Evoked
+    """
+    return erp_export.grouped_evokeds(epochs, params.conditions)
+
+
+def run_subject(subject, raw_fname, ns_eventlog, out_dir, params=None, cache_dir=None,
+                cache_size=None, run_start=None):
+    """
+    Run the whole walkthrough pipeline for one subject and write the cleaned
+    epochs, ICA, evoked responses and (if params.erp_report) the ERP
+    figures as one PDF (see 'erp_export.export_erps') to out_dir/subject
+
+    Parameters (defaults)
+    ---------------------
+    subject: str
+        subject name, used for the output file names
+    raw_fname, ns_eventlog: str
+        EGI raw file and netstation event log of the subject
+    out_dir: str
+        output directory
+    params: PipelineConfig or dict (None)
+        the config, or overrides of the PipelineConfig defaults (see
+        'pipeline_config'). it is validated before anything runs and checked
+        against the raw file header before the raw file is read
+    cache_dir: str (None)
+        if given, the filtered raw, parsed events, epochs, ICA and autoreject
+        stages are cached there (see 'stage_cache.StageCache') and reused
+        while their inputs and STAGE_PARAMS are unchanged. defaults to
+        params.cache_dir
+    cache_size: int (None)
+        size limit of the cache in bytes, defaults to params.cache_size
+    run_start: float (None)
+        start time of the batch, cache entries used since then are not
+        evicted (see 'stage_cache.StageCache'). defaults to the subject's start
+
+    Returns
+    -------
+    status: dict with subject, status ('ok' or 'error'), number of epochs,
+        elapsed time and the traceback if the subject failed. wall time, CPU
+        time, peak RSS and output size of every stage are written to
+        out_dir/subject/profile.json and profile.csv (see 'profiling'), the
+        reason every epoch was dropped to out_dir/subject/drops.parquet
+        (see 'qc.drop_table'), the autoreject thresholds to
+        out_dir/subject/ar_thresholds.csv (see 'reject') and, with
+        params.ica_sweep, the ICA candidates to out_dir/subject/ica_sweep.csv.
+        with params.auto_bads, the measures of every channel and why it was
+        marked bad go to out_dir/subject/bad_channels.csv (see
+        'bad_channels'). with params.feature_windows, the single-trial window amplitudes go
+        to the out_dir/features Parquet dataset (see 'features'), and with
+        params.epoch_store the epochs also go to the on-disk store
+        out_dir/subject/subject-epo (see 'epoch_store')
+    """
+    params = make_config(params)
+    cache_dir = params.cache_dir if cache_dir is None else cache_dir
+    cache_size = params.cache_size if cache_size is None else cache_size
+    subject_dir = os.path.join(out_dir, subject)
+    if not os.path.isdir(subject_dir):
+        os.makedirs(subject_dir)
+    with open(os.path.join(subject_dir, 'config.json'), 'w') as fp:
+        json.dump(dict(params.to_dict(), digest=params.digest()), fp, indent=2)
+    status = dict(subject=subject, status='ok', error=None, n_epochs=None)
+    t0 = time.time()
+    with StageProfiler(subject) as profiler:
+        try:
+            check_subject(params, raw_fname, ns_eventlog)
+            cache = StageCache(cache_dir, cache_size, run_start) if cache_dir else None
+            keys = stage_keys(cache, raw_fname, ns_eventlog, params)
+
+            def compute_epochs():
+                events = cached(cache, 'events', keys['events'], lambda: parse_events(ns_eventlog, params))
+                bads, bads_table = list(params.bads), None
+                if params.auto_bads:
+                    bads_table = detect_bads(raw_fname, events, params)
+                    bads += [ch for ch in bad_channels.bad_names(bads_table) if ch not in bads]
+                if params.low_memory:
+                    store_dir = tempfile.mkdtemp(dir=subject_dir)
+                    try:
+                        store = prepare_lowmem(raw_fname, events, params, store_dir, bads)
+                        epochs = make_epochs_lowmem(store, events, params)
+                        annotations = store.annotations
+                    finally:
+                        shutil.rmtree(store_dir, ignore_errors=True)
+                else:
+                    raw = cached(cache, 'filter', keys['filter'],
+                                 lambda: filter_raw(load_raw(raw_fname, params), params))
+                    raw = annotate_raw(raw, events, params, bads)
+                    epochs = make_epochs(raw, events, params)
+                    annotations = raw.annotations
+                # the drop table is cached with the epochs, so the drop counts
+                # never need the raw file again
+                drops = qc.drop_table(epochs, events['df_tlstS'], annotations=annotations,
+                                      imp_onset=events['imp_onset'], subject=subject)
+                result = dict(epochs=epochs, drops=drops)
+                if bads_table is not None:
+                    result['bads'] = bads_table
+                return result
+
+            # later stages only need the epochs, so raw is not even read when they are cached
+            result = cached(cache, 'epochs', keys['epochs'], compute_epochs)
+            epochs = result['epochs']
+            if 'bads' in result:
+                result['bads'].to_csv(os.path.join(subject_dir, 'bad_channels.csv'), index=False)
+            ica = cached(cache, 'ica', keys['ica'], lambda: fit_ica(epochs, params))
+            if params.ica_sweep:
+                report = cached(cache, 'ica_sweep', keys['ica_sweep'],
+                                lambda: sweep_ica(epochs, params, getattr(ica, 'reject_', None)))
+                report.to_csv(os.path.join(subject_dir, 'ica_sweep.csv'), index=False)
+            with stage('ica.apply'):
+                ica.apply(epochs)
+            print('number of ICs dropped: ' + str(len(ica.exclude)))
+            if params.autoreject:
+                ar = get_autoreject(subject, epochs, params, cache, keys['autoreject'])
+                reject.write_thresholds(reject.threshold_table(ar, epochs, subject),
+                                        os.path.join(subject_dir, 'ar_thresholds.csv'))
+                with stage('autoreject.transform'):
+                    epochs = ar.transform(epochs)
+            drops = qc.update_table(result['drops'], epochs)
+            qc.write_table(drops, os.path.join(subject_dir, 'drops'))
+            evokeds = make_evokeds(epochs, params)
+
+            with stage('save'):
+                fname = os.path.join(subject_dir, subject)
+                epochs.save(fname + '-epo.fif', overwrite=True)
+                ica.save(fname + '-ica.fif', overwrite=True)
+                from mne import write_evokeds
+                write_evokeds(fname + '-ave.fif', list(evokeds.values()), overwrite=True)
+                if params.epoch_store:
+                    import epoch_store
+                    epoch_store.write_epochs(epochs, fname + '-epo')
+            if params.erp_report:
+                with stage('export_erps'):
+                    erp_export.export_erps(evokeds, fname + '-erp.pdf', params.erp_contrasts)
+            if params.feature_windows:
+                with stage('export_features'):
+                    features.write_features(features.trial_features(epochs, params.feature_windows,
+                                                                    subject=subject),
+                                            os.path.join(out_dir, 'features'))
+            status['n_epochs'] = len(epochs)
+        except Exception:
+            # one subject failing should not stop the batch
+            status['status'] = 'error'
+            status['error'] = traceback.format_exc()
+    status['elapsed'] = time.time() - t0
+    profiler.write(os.path.join(subject_dir, 'profile'))
+    with open(os.path.join(subject_dir, 'status.json'), 'w') as fp:
+        json.dump(status, fp, indent=2)
+    return status
+
+
+def stage_keys(cache, raw_fname, ns_eventlog, params):
+    """
+    Cache keys of every stage: input file hashes plus the config digest of
+    the stage's STAGE_PARAMS, chained through the stages each one depends on.
+    None for all stages without a cache
+    """
+    if cache is None:
+        return dict((stage, None) for stage in STAGE_PARAMS)
+
+    def stage_params(stage):
+        return dict(config=params.digest(STAGE_PARAMS[stage]))
+
+    keys = {}
+    keys['filter'] = cache.key('filter', [raw_fname], stage_params('filter'))
+    keys['events'] = cache.key('events', [ns_eventlog], stage_params('events'))
+    keys['epochs'] = cache.key('epochs', params=stage_params('epochs'),
+                               parents=[keys['filter'], keys['events']])
+    keys['ica'] = cache.key('ica', params=stage_params('ica'), parents=[keys['epochs']])
+    keys['ica_sweep'] = cache.key('ica_sweep', params=stage_params('ica_sweep'), parents=[keys['epochs']])
+    keys['autoreject'] = cache.key('autoreject', params=stage_params('autoreject'),
+                                   parents=[keys['ica']])
+    return keys
+
+
+def find_subjects(data_dir):
+    """
+    Pair every EGI .raw file in data_dir with its '<name>_nsevent' event log
+
+    Returns
+    -------
+    subjects: list of (subject, raw_fname, ns_eventlog) tuples
+    """
+    subjects = []
+    for raw_fname in sorted(glob.glob(os.path.join(data_dir, '*.raw'))):
+        subject = os.path.splitext(os.path.basename(raw_fname))[0]
+        ns_eventlog = os.path.join(data_dir, subject + '_nsevent')
+        if os.path.exists(ns_eventlog):
+            subjects.append((subject, raw_fname, ns_eventlog))
+        else:
+            print('no event log for ' + subject + ', skipping')
+    return subjects
+
+
+def run_batch(subjects, out_dir, n_jobs=1, blas_threads=1, params=None, cache_dir=None,
+              cache_size=None):
+    """
+    Run 'run_subject' for many subjects in a process pool. Each worker is
+    limited to blas_threads BLAS/OpenMP threads so n_jobs workers do not
+    oversubscribe the cores. A summary of every subject is written to
+    out_dir/summary.csv, a per-stage profile summary across subjects to
+    out_dir/profile_summary.csv, the drop tables of all subjects (see
+    'qc.drop_table') to out_dir/drops.parquet and their drop counts per
+    subject and condition to out_dir/drop_summary.csv. with
+    params.grand_average, every subject is folded into the running grand
+    average out_dir/grand_average.npz as soon as it finishes (see
+    'grand_average'), which is written as out_dir/grand-ave.fif and (with
+    params.erp_report) out_dir/grand-erp.pdf with standard errors
+
+    Parameters (defaults)
+    ---------------------
+    subjects: list of (subject, raw_fname, ns_eventlog) tuples
+        ie. from 'find_subjects'
+    out_dir: str
+        output directory
+    n_jobs: int (1)
+        number of worker processes. 1 runs the subjects in this process
+    blas_threads: int (1)
+        number of BLAS/OpenMP threads per worker
+    params: PipelineConfig or dict (None)
+        see 'run_subject', validated once before any subject starts
+    cache_dir, cache_size: str (None), int (None)
+        stage cache shared by all workers, see 'run_subject'
+
+    Returns
+    -------
+    summary: pandas dataframe with one status row per subject
+    """
+    params = make_config(params)
+    run_start = time.time()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    grand = None
+    if params.grand_average:
+        grand = GrandAverage(os.path.join(out_dir, 'grand_average.npz'), params.erp_contrasts,
+                             params.digest(GRAND_PARAMS))
+    results = []
+    if n_jobs == 1:
+        with limit_threads(blas_threads):
+            for subject in subjects:
+                results.append(run_subject(*subject, out_dir=out_dir, params=params, cache_dir=cache_dir,
+                                           cache_size=cache_size, run_start=run_start))
+                add_to_grand_average(grand, out_dir, results[-1])
+    else:
+        # spawn so workers start clean and read the thread limits on import
+        context = multiprocessing.get_context('spawn')
+        with _worker_thread_env(blas_threads):
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context,
+                                     initializer=_init_worker, initargs=(blas_threads,)) as pool:
+                futures = dict((pool.submit(run_subject, *subject, out_dir=out_dir, params=params,
+                                            cache_dir=cache_dir, cache_size=cache_size,
+                                            run_start=run_start), subject[0])
+                               for subject in subjects)
+                for future in as_completed(futures):
+                    try:
+                        results.append(future.result())
+                    except Exception:
+                        # the worker itself died (ie. killed out of memory), run_subject could not
+                        # catch it: the pool is broken, and this and the pending subjects fail here
+                        results.append(dict(subject=futures[future], status='error', n_epochs=None,
+                                            elapsed=None, error=traceback.format_exc()))
+                    print(results[-1]['subject'] + ': ' + results[-1]['status'])
+                    add_to_grand_average(grand, out_dir, results[-1])
+    summary = pd.DataFrame(results, columns=['subject', 'status', 'n_epochs', 'elapsed', 'error'])
+    summary.to_csv(os.path.join(out_dir, 'summary.csv'), index=False)
+    profiles = [os.path.join(out_dir, result['subject'], 'profile.csv') for result in results]
+    profiles = [fname for fname in profiles if os.path.exists(fname)]
+    if profiles:
+        summarize(profiles).to_csv(os.path.join(out_dir, 'profile_summary.csv'), index=False)
+    drops = [os.path.join(out_dir, result['subject'], 'drops' + ext) for result in results
+             for ext in ['.parquet', '.csv']]
+    drops = [fname for fname in drops if os.path.exists(fname)]
+    if drops:
+        drops = qc.read_tables(drops)
+        qc.write_table(drops, os.path.join(out_dir, 'drops'))
+        qc.drop_counts(drops, ['subject', 'cond']).to_csv(os.path.join(out_dir, 'drop_summary.csv'))
+    if grand is not None and grand.subjects:
+        write_grand_average(grand, out_dir, params)
+    print(str(np.sum(summary['status'] == 'ok')) + '/' + str(len(summary)) + ' subjects done')
+    return summary
+
+
+def add_to_grand_average(grand, out_dir, result):
+    """
+    Fold a finished subject's evoked responses (out_dir/subject/subject-ave.fif)
+    into the grand average and save it, so it is up to date whenever the
+    batch stops
+    """
+    if grand is None or result['status'] != 'ok':
+        return
+    from mne import read_evokeds
+    subject = result['subject']
+    try:
+        if grand.add(subject, read_evokeds(os.path.join(out_dir, subject, subject + '-ave.fif'))):
+            grand.save()
+            print(subject + ' added to the grand average (' + str(len(grand.subjects)) + ' subjects)')
+    except Exception:
+        # ie. other time points: the subject is done, only left out of the grand average
+        print('WARNING: ' + subject + ' could not be added to the grand average\n' + traceback.format_exc())
+
+
+def write_grand_average(grand, out_dir, params):
+    """
+    Write the grand averages of the conditions and contrasts to
+    out_dir/grand-ave.fif and, with params.erp_report, their ERP figures with
+    standard errors to out_dir/grand-erp.pdf
+    """
+    from mne import write_evokeds
+    evokeds = grand.evokeds()
+    write_evokeds(os.path.join(out_dir, 'grand-ave.fif'), list(evokeds.values()), overwrite=True)
+    if params.erp_report:
+        erp_export.export_erps(evokeds, os.path.join(out_dir, 'grand-erp.pdf'), params.erp_contrasts,
+                               errors=grand.evokeds('sem'))
+
+
+def run_config(config):
+    """
+    Run every subject of config.data_dir into config.out_dir with the
+    config's jobs, threads and cache (see 'run_batch')
+
+    Parameters (defaults)
+    ---------------------
+    config: PipelineConfig, dict of settings or the name of a config file
+    """
+    if isinstance(config, str):
+        config = load_config(config)
+    config = make_config(config)
+    return run_batch(find_subjects(config.data_dir), config.out_dir, config.n_jobs,
+                     config.blas_threads, params=config)
+
+
+@contextlib.contextmanager
+def limit_threads(n_threads):
+    """
+    Cap the BLAS/OpenMP thread pools of this process while the block runs.
+    The libraries only read the environment variables when they load, so
+    once numpy is imported this needs threadpoolctl (a no-op without it)
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        yield
+        return
+    with threadpool_limits(n_threads):
+        yield
+
+
+@contextlib.contextmanager
+def _worker_thread_env(n_threads):
+    """
+    Set the BLAS/OpenMP thread environment variables while the block runs,
+    so worker processes spawned inside it read them when they load the libraries
+    """
+    old = dict((var, os.environ.get(var)) for var in _THREAD_VARS)
+    os.environ.update((var, str(n_threads)) for var in _THREAD_VARS)
+    try:
+        yield
+    finally:
+        for var, value in old.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(n_threads):
+    """
+    Also cap libraries that were already loaded, if threadpoolctl is installed
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n_threads)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run the walkthrough pipeline on every subject in a directory')
+    parser.add_argument('data_dir', nargs='?', default=None,
+                        help='directory with <subject>.raw and <subject>_nsevent files')
+    parser.add_argument('out_dir', nargs='?', default=None, help='output directory')
+    parser.add_argument('--config', default=None, metavar='FILE',
+                        help='.toml or .yaml config file (see pipeline_config.PipelineConfig), '
+                             'the options below override it')
+    parser.add_argument('--n-jobs', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--blas-threads', type=int, default=None, help='BLAS threads per worker')
+    parser.add_argument('--cache-dir', default=None, help='directory to cache pipeline stages in')
+    parser.add_argument('--cache-size', type=float, default=None, help='cache size limit in bytes')
+    parser.add_argument('--low-memory', action='store_true', default=None,
+                        help='epoch from a memory-mapped float32 copy instead of preloading the raw file')
+    parser.add_argument('--auto-bads', action='store_true', default=None,
+                        help='also mark the bad channels detected in each recording as bad')
+    parser.add_argument('--filter-n-jobs', type=int, default=None,
+                        help='threads filtering blocks of channels')
+    parser.add_argument('--eog-method', choices=EOG_METHODS, default=None,
+                        help="eye artifact detection: blink peaks above a fixed threshold ('peaks') "
+                             "or excursions above a running median/MAD threshold ('adaptive')")
+    parser.add_argument('--epoch-store', action='store_true', default=None,
+                        help='also write the cleaned epochs to a chunked, compressed HDF5 store')
+    parser.add_argument('--ica-sweep', type=int, nargs='+', default=None, metavar='N',
+                        help='also fit ICA with these numbers of components and report them '
+                             '(for comparison only, the data is still cleaned with the configured ICA)')
+    parser.add_argument('--ica-n-jobs', type=int, default=None, help='worker processes of the ICA sweep')
+    parser.add_argument('--ar-n-jobs', type=int, default=None, help='jobs of the autoreject threshold search')
+    parser.add_argument('--ar-thresholds', default=None, metavar='DIR',
+                        help='output directory of an earlier run whose autoreject thresholds are reused')
+    args = parser.parse_args(argv)
+    try:
+        config = load_config(args.config, data_dir=args.data_dir, out_dir=args.out_dir,
+                             n_jobs=args.n_jobs, blas_threads=args.blas_threads,
+                             cache_dir=args.cache_dir, cache_size=args.cache_size,
+                             low_memory=args.low_memory, auto_bads=args.auto_bads,
+                             filter_n_jobs=args.filter_n_jobs, eog_method=args.eog_method,
+                             epoch_store=args.epoch_store,
+                             ica_n_jobs=args.ica_n_jobs,
+                             ar_n_jobs=args.ar_n_jobs, ar_thresholds=args.ar_thresholds,
+                             ica_sweep=dict(n_components=args.ica_sweep) if args.ica_sweep else None)
+    except ValueError as err:
+        parser.error(str(err))
+    run_config(config)
+
+
+if __name__ == '__main__':
+    main()
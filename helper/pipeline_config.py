@@ -0,0 +1,381 @@
+"""
+Typed configuration of the pipeline. Every setting walkthrough.py and the
+pipeline stages use lives in one PipelineConfig, read from a TOML or YAML
+file and validated as a whole when it is created, before anything is read.
+Only the standard library and the lightweight helper modules are imported
+here, so loading and checking a config does not pay for importing mne
+
+    config = load_config('config.toml', tmax=0.6)
+    config.digest(['l_freq', 'h_freq'])   # hash of those settings, ie. for cache keys
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import typing
+from dataclasses import dataclass, field
+from typing import Optional, Union
+import erp_export
+import features
+from event_schema import SFV_SCHEMA
+
+FILTER_METHODS = ('fir', 'iir')
+EOG_METHODS = ('peaks', 'adaptive')
+ICA_METHODS = ('fastica', 'infomax', 'picard')
+AR_GRIDS = ('adaptive', 'default')
+# keyword arguments of 'ica_sweep.sweep_ica' allowed in ica_sweep
+SWEEP_KEYS = ('n_components', 'random_states', 'methods', 'max_iter', 'fit_params', 'decim',
+              'reject', 'warm_start', 'eog_ch')
+
+
+@dataclass
+class PipelineConfig:
+    """
+    Settings of the pipeline (defaults follow walkthrough.py)
+
+    Parameters (defaults)
+    ---------------------
+    data_dir, out_dir: str ('data', 'results')
+        directory with <subject>.raw and <subject>_nsevent files, and output directory
+    cache_dir: str (None)
+        stage cache directory (see 'stage_cache'), no cache if None
+    cache_size: float (20e9)
+        cache size limit in bytes
+    n_jobs, blas_threads: int (1, 1)
+        subjects run in parallel and BLAS threads per worker
+    montage: str ('GSN-HydroCel-128')
+    l_freq, h_freq: float (1., 30.)
+        bandpass filter band in Hz
+    filter_method: str ('fir')
+        one of FILTER_METHODS, see 'filtering'
+    filter_n_jobs: int (1)
+        threads filtering blocks of channels
+    bads: list
+        bad channels
+    auto_bads: bool (False)
+        also mark the channels 'bad_channels.find_bad_channels' finds in
+        the unfiltered recording as bad
+    bads_z_thresh, bads_corr_thresh: float (5., 0.4)
+        outlier z-score and neighbour correlation thresholds of the detection
+    selection: list
+        channels plotted in detail ('EB' is the bipolar eye channel)
+    eog_anode, eog_cathode: str ('E8', 'E126')
+        channels of the bipolar eye channel 'EB'
+    eog_method: str ('peaks')
+        one of EOG_METHODS: 'peaks' annotates eog_duration from every blink
+        peak above eog_thresh, 'adaptive' annotates the whole excursions
+        above a running median + eog_k robust standard deviations of
+        eog_window s (see 'scipy_eog.eye_annotations')
+    eog_thresh, eog_duration: float (0.0001, 0.1)
+        'peaks' blink threshold in V and length of the 'bad eye' annotations in s
+    eog_k, eog_window: float (5., 10.)
+        'adaptive' threshold in robust standard deviations and length of the
+        running statistics in s
+    saccade_anode, saccade_cathode: str (None, None)
+        horizontal eye channel pair whose 'adaptive' excursions are 'bad
+        saccade' annotations, ie. 'E125', 'E128' (neither may be in bads:
+        E128 is in the default list). None to leave saccades in
+    stim_channel: str ('tlst')
+    event_id: dict ({'lstS': 1})
+    tmin, tmax: float (-0.25, 0.8)
+        epoch window in s, baseline is (tmin, 0)
+    expected: dict
+        event code -> expected number of events in the log (None skips the check)
+    ica_n_components: int or float (20)
+    ica_method: str ('fastica')
+        one of ICA_METHODS
+    ica_max_iter: int (200)
+    random_state: int (None)
+        seed of ICA and autoreject
+    ica_decim: int (None)
+        fit ICA on every ica_decim-th sample
+    ica_sweep: dict (None)
+        ICA candidates to compare, keyword arguments of 'ica_sweep.sweep_ica'
+    ica_n_jobs: int (1)
+    autoreject: bool (True)
+    ar_grid: str ('adaptive')
+        one of AR_GRIDS, see 'reject.fit_autoreject'
+    ar_n_jobs: int (1)
+    ar_thresholds: str (None)
+        output directory of an earlier run whose autoreject thresholds are reused
+    conditions: dict
+        condition name -> value of the metadata 'cond' column
+    low_memory: bool (False)
+        epoch from a memory-mapped copy of the raw file (see 'lowmem')
+    erp_report: bool (True)
+    erp_contrasts: list
+        pairs of conditions plotted together
+    feature_windows: dict
+        single-trial feature windows (see 'features'), name -> (start, end) in s
+    grand_average: bool (True)
+        fold every finished subject into the running grand average of
+        out_dir (see 'grand_average')
+    epoch_store: bool (False)
+        also write the cleaned epochs to a chunked, compressed HDF5 store
+        with their metadata (see 'epoch_store', needs h5py)
+    """
+    data_dir: str = 'data'
+    out_dir: str = 'results'
+    cache_dir: Optional[str] = None
+    cache_size: float = 20e9
+    n_jobs: int = 1
+    blas_threads: int = 1
+    montage: str = 'GSN-HydroCel-128'
+    l_freq: Optional[float] = 1.
+    h_freq: Optional[float] = 30.
+    filter_method: str = 'fir'
+    filter_n_jobs: int = 1
+    bads: list = field(default_factory=lambda: [
+        'E128', 'E127', 'E107', 'E56', 'E57', 'E18', 'E49', 'E48', 'E115', 'E113',
+        'E122', 'E121', 'E123', 'E124', 'E108', 'E63', 'E1', 'E32', 'E33'])
+    auto_bads: bool = False
+    bads_z_thresh: float = 5.
+    bads_corr_thresh: float = 0.4
+    selection: list = field(default_factory=lambda: ['EB', 'E11', 'E24', 'E124', 'E36', 'E104',
+                                                     'E52', 'E62', 'E92'])
+    eog_anode: str = 'E8'
+    eog_cathode: str = 'E126'
+    eog_method: str = 'peaks'
+    eog_thresh: float = 0.0001
+    eog_duration: float = 0.1
+    eog_k: float = 5.
+    eog_window: float = 10.
+    saccade_anode: Optional[str] = None
+    saccade_cathode: Optional[str] = None
+    stim_channel: str = 'tlst'
+    event_id: dict = field(default_factory=lambda: {'lstS': 1})
+    tmin: float = -0.25
+    tmax: float = 0.8
+    expected: dict = field(default_factory=lambda: dict(SFV_SCHEMA.expected))
+    ica_n_components: Union[int, float] = 20
+    ica_method: str = 'fastica'
+    ica_max_iter: int = 200
+    random_state: Optional[int] = None
+    ica_decim: Optional[int] = None
+    ica_sweep: Optional[dict] = None
+    ica_n_jobs: int = 1
+    autoreject: bool = True
+    ar_grid: str = 'adaptive'
+    ar_n_jobs: int = 1
+    ar_thresholds: Optional[str] = None
+    conditions: dict = field(default_factory=lambda: {'highcosval': 1, 'lowcosval': 2,
+                                                      'highcosinval': 3, 'lowcosinval': 4})
+    low_memory: bool = False
+    erp_report: bool = True
+    erp_contrasts: list = field(default_factory=lambda: [list(c) for c in erp_export.CONTRASTS])
+    feature_windows: dict = field(default_factory=lambda: dict((k, list(v)) for k, v in features.WINDOWS.items()))
+    grand_average: bool = True
+    epoch_store: bool = False
+
+    def __post_init__(self):
+        self.validate()
+
+    def validate(self):
+        """
+        Check the type and value of every setting; raises one ValueError
+        listing all problems
+        """
+        errors = []
+        for f in dataclasses.fields(self):
+            value = getattr(self, f.name)
+            if not _is_type(value, f.type):
+                errors.append(f.name + ' should be ' + _type_name(f.type) + ', got ' + repr(value))
+        if errors:
+            raise ValueError('invalid config:\n  ' + '\n  '.join(errors))
+
+        def check(ok, message):
+            if not ok:
+                errors.append(message)
+        for name in ['cache_size', 'n_jobs', 'blas_threads', 'filter_n_jobs', 'ica_max_iter', 'ica_n_jobs', 'ar_n_jobs',
+                     'eog_thresh', 'eog_duration', 'eog_k', 'eog_window', 'bads_z_thresh']:
+            check(getattr(self, name) > 0, name + ' should be positive')
+        check(self.l_freq is None or self.l_freq >= 0, 'l_freq should be >= 0')
+        check(self.l_freq is None or self.h_freq is None or self.l_freq < self.h_freq,
+              'l_freq should be below h_freq')
+        check(self.filter_method in FILTER_METHODS, 'filter_method should be one of ' + str(FILTER_METHODS))
+        check(self.tmin <= 0 <= self.tmax and self.tmin < self.tmax,
+              'tmin and tmax should be around the event (baseline is (tmin, 0))')
+        check(-1 <= self.bads_corr_thresh <= 1, 'bads_corr_thresh should be a correlation')
+        check(self.eog_anode != self.eog_cathode, 'eog_anode and eog_cathode should differ')
+        check(self.eog_method in EOG_METHODS, 'eog_method should be one of ' + str(EOG_METHODS))
+        check((self.saccade_anode is None) == (self.saccade_cathode is None)
+              and (self.saccade_anode is None or self.saccade_anode != self.saccade_cathode),
+              'saccade_anode and saccade_cathode should be two channels or both None')
+        check(all(isinstance(ch, str) for ch in self.bads + self.selection),
+              'bads and selection should be channel names')
+        for name in ['eog_anode', 'eog_cathode', 'saccade_anode', 'saccade_cathode']:
+            check(getattr(self, name) not in self.bads,
+                  name + ' ' + str(getattr(self, name)) + ' is in bads, an eye channel should be good')
+        check(all(_is_int(v) for v in self.event_id.values()), 'event_id values should be ints')
+        check(all(_is_int(v) for v in self.conditions.values()), 'conditions values should be ints')
+        check(all(v is None or (_is_int(v) and v >= 0) for v in self.expected.values()),
+              'expected counts should be ints or None')
+        if isinstance(self.ica_n_components, float):
+            check(0 < self.ica_n_components < 1, 'a float ica_n_components should be a variance fraction in (0, 1)')
+        else:
+            check(self.ica_n_components > 0, 'ica_n_components should be positive')
+        check(self.ica_method in ICA_METHODS, 'ica_method should be one of ' + str(ICA_METHODS))
+        check(self.ica_decim is None or self.ica_decim > 0, 'ica_decim should be positive')
+        if self.ica_sweep is not None:
+            unknown = set(self.ica_sweep) - set(SWEEP_KEYS)
+            check(not unknown, 'unknown ica_sweep keys ' + str(sorted(unknown)))
+        check(self.ar_grid in AR_GRIDS, 'ar_grid should be one of ' + str(AR_GRIDS))
+        for pair in self.erp_contrasts:
+            check(isinstance(pair, (list, tuple)) and len(pair) == 2 and all(c in self.conditions for c in pair),
+                  'erp_contrasts ' + str(pair) + ' should be a pair of conditions')
+        if self.epoch_store:
+            try:
+                import h5py
+            except ImportError:
+                errors.append('epoch_store needs h5py')
+        for name, window in self.feature_windows.items():
+            check(isinstance(window, (list, tuple)) and len(window) == 2
+                  and all(_is_type(t, float) for t in window) and self.tmin <= window[0] < window[1] <= self.tmax,
+                  'feature window ' + name + ' ' + str(window) + ' should be a (start, stop) pair within tmin and tmax')
+        if errors:
+            raise ValueError('invalid config:\n  ' + '\n  '.join(errors))
+
+    def replace(self, **changes):
+        """
+        A validated copy with some settings changed
+        """
+        return dataclasses.replace(self, **changes)
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    def digest(self, names=None):
+        """
+        sha1 of the settings (all, or only those in names), the same for
+        equal settings whatever file they came from
+        """
+        values = self.to_dict()
+        if names is not None:
+            values = dict((name, values[name]) for name in names)
+        return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+    def schema(self):
+        """
+        Event schema with the expected event counts of this config
+        """
+        return dataclasses.replace(SFV_SCHEMA, expected=dict(self.expected))
+
+
+def load_config(fname=None, **overrides):
+    """
+    Read a config file (.toml, or .yaml/.yml with PyYAML installed)
+
+    Parameters (defaults)
+    ---------------------
+    fname: str (None)
+        config file, only defaults and overrides if None
+    **overrides:
+        settings that replace the file's (None values are ignored, so
+        unset command line options can be passed as they are). a dict
+        replaces only its own keys of the file's, ie. ica_sweep's n_components
+
+    Returns
+    -------
+    config: PipelineConfig
+    """
+    values = {}
+    if fname is not None:
+        ext = os.path.splitext(fname)[1].lower()
+        if ext == '.toml':
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+            with open(fname, 'rb') as fp:
+                values = tomllib.load(fp)
+        elif ext in ('.yaml', '.yml'):
+            import yaml
+            with open(fname) as fp:
+                values = yaml.safe_load(fp) or {}
+        else:
+            raise ValueError('config file should be .toml, .yaml or .yml: ' + fname)
+    for key, value in overrides.items():
+        if value is None:
+            continue
+        if isinstance(value, dict) and isinstance(values.get(key), dict):
+            value = dict(values[key], **value)
+        values[key] = value
+    return make_config(values)
+
+
+def make_config(params=None):
+    """
+    PipelineConfig of a config, a dict of settings or None (defaults)
+    """
+    if isinstance(params, PipelineConfig):
+        return params
+    params = dict(params or {})
+    names = set(f.name for f in dataclasses.fields(PipelineConfig))
+    unknown = set(params) - names
+    if unknown:
+        raise ValueError('unknown config settings: ' + ', '.join(sorted(unknown)))
+    return PipelineConfig(**params)
+
+
+def check_subject(config, raw_fname, ns_eventlog):
+    """
+    Check a subject's files against the config from the raw file header
+    only: the files exist, the eye and stim channels are in the recording
+    and the montage exists. raises ValueError
+
+    Returns
+    -------
+    header: dict, see 'lowmem.read_egi_header'
+    """
+    for fname in [raw_fname, ns_eventlog]:
+        if not os.path.exists(fname):
+            raise ValueError('missing file ' + fname)
+    from lowmem import read_egi_header
+    header = read_egi_header(raw_fname)
+    if header is None:
+        raise ValueError('incomplete EGI header in ' + raw_fname)
+    ch_names = ['E' + str(i + 1) for i in range(header['n_channels'])]
+    errors = []
+    names = ['eog_anode', 'eog_cathode']
+    if config.eog_method == 'adaptive' and config.saccade_anode is not None:
+        names += ['saccade_anode', 'saccade_cathode']
+    for name in names:
+        if getattr(config, name) not in ch_names:
+            errors.append(name + ' ' + getattr(config, name) + ' is not in the recording')
+    if config.stim_channel not in header['event_codes']:
+        errors.append('stim_channel ' + config.stim_channel + ' is not an event code of the recording '
+                      + str(header['event_codes']))
+    import mne
+    if config.montage not in mne.channels.get_builtin_montages():
+        errors.append('unknown montage ' + config.montage)
+    if errors:
+        raise ValueError(raw_fname + ':\n  ' + '\n  '.join(errors))
+    return header
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_type(value, tp):
+    """
+    isinstance for the annotations used above (Optional/Union of plain types)
+    ints are accepted for floats, bools are not accepted for numbers
+    """
+    if typing.get_origin(tp) is Union:
+        return any(_is_type(value, t) for t in typing.get_args(tp))
+    if tp is type(None):
+        return value is None
+    if tp is float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if tp is int:
+        return _is_int(value)
+    if tp is list:
+        return isinstance(value, (list, tuple))
+    return isinstance(value, tp)
+
+
+def _type_name(tp):
+    if typing.get_origin(tp) is Union:
+        return ' or '.join(_type_name(t) for t in typing.get_args(tp))
+    return 'None' if tp is type(None) else tp.__name__
@@ -0,0 +1,199 @@
+"""
+Lightweight per-stage instrumentation: wall time, CPU time, peak RSS and the
+size of each stage's output. Stages are marked with the 'stage' context
+manager or the 'profiled' decorator; they are only recorded while a
+StageProfiler is active, so instrumented code costs nothing otherwise
+
+    with StageProfiler('sfv_eeg_011ts') as prof:
+        raw = load_raw(raw_fname, params)   # decorated with @profiled()
+        with stage('plotting'):
+            ...
+    prof.write('sfv_eeg_011ts_profile')
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+_ACTIVE = []
+_COLUMNS = ['subject', 'stage', 'depth', 'wall', 'cpu', 'rss_start', 'peak_rss', 'nbytes']
+
+
+class StageProfiler(object):
+    """
+    Collects one record per stage while active (use it as a context manager)
+    RSS is sampled every `interval` seconds by a background thread so the
+    peak of each stage is caught even between its start and end
+
+    Parameters (defaults)
+    ---------------------
+    subject: str ('')
+        subject name written in every record
+    interval: float (0.01)
+        RSS sampling interval in seconds
+    """
+    def __init__(self, subject='', interval=0.01):
+        self.subject = subject
+        self.interval = interval
+        self.records = []
+        self._open = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        _ACTIVE.append(self)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        _ACTIVE.remove(self)
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Record one stage. yields the record dict; set record['nbytes'] to log
+        the size of the stage's output
+        """
+        rss = current_rss()
+        record = dict(subject=self.subject, stage=name, depth=len(self._open),
+                      rss_start=rss, peak_rss=rss, nbytes=np.nan)
+        self.records.append(record)
+        self._open.append(record)
+        wall = time.time()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.time() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['peak_rss'] = max(record['peak_rss'], current_rss())
+            self._open.remove(record)
+
+    def to_frame(self):
+        """
+        Records as a dataframe, RSS in MB
+        """
+        df = pd.DataFrame(self.records, columns=_COLUMNS)
+        for col in ['rss_start', 'peak_rss']:
+            df[col] = df[col] / 1024. ** 2
+        return df
+
+    def write(self, fname):
+        """
+        Write the report as fname.json and fname.csv
+        """
+        df = self.to_frame()
+        df.to_csv(fname + '.csv', index=False)
+        with open(fname + '.json', 'w') as fp:
+            json.dump(json.loads(df.to_json(orient='records')), fp, indent=2)
+        return df
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            for record in list(self._open):
+                if rss > record['peak_rss']:
+                    record['peak_rss'] = rss
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Record a stage in the active StageProfiler, if any
+    """
+    if not _ACTIVE:
+        yield {}
+        return
+    with _ACTIVE[-1].stage(name) as record:
+        yield record
+
+
+def profiled(name=None):
+    """
+    Decorator recording every call of a function as a stage (named after the
+    function by default), including the size of what it returns
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as record:
+                result = func(*args, **kwargs)
+                if _ACTIVE:
+                    record['nbytes'] = data_size(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def data_size(obj):
+    """
+    Approximate size in bytes of arrays, dataframes and loaded mne objects
+    (and of lists, tuples and dicts of them). NaN if unknown
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        sizes = [data_size(o) for o in obj]
+        sizes = [s for s in sizes if not np.isnan(s)]
+        return sum(sizes) if sizes else np.nan
+    data = getattr(obj, '_data', None)
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    return np.nan
+
+
+def current_rss():
+    """
+    Current resident set size of this process in bytes
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # peak instead of current RSS, in kB on linux and bytes on mac
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(reports):
+    """
+    Cross-subject summary of per-subject reports
+
+    Parameters
+    ----------
+    reports: list of dataframes from 'StageProfiler.to_frame' or csv file names
+
+    Returns
+    -------
+    summary: pandas dataframe with one row per stage: number of subjects,
+        median/max wall and cpu time, median/max peak RSS and median nbytes
+    """
+    reports = [pd.read_csv(r) if isinstance(r, str) else r for r in reports]
+    df = pd.concat(reports, ignore_index=True)
+    summary = df.groupby('stage', sort=False).agg(
+        n_subjects=('subject', 'nunique'),
+        wall_median=('wall', 'median'), wall_max=('wall', 'max'),
+        cpu_median=('cpu', 'median'), cpu_max=('cpu', 'max'),
+        peak_rss_median=('peak_rss', 'median'), peak_rss_max=('peak_rss', 'max'),
+        nbytes_median=('nbytes', 'median'))
+    return summary.reset_index()
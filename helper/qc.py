@@ -0,0 +1,199 @@
+"""
+Epoch rejection statistics. The drop log of an Epochs object and its metadata
+are turned once into a long table (one row per epoch and drop reason), which
+gives drop counts per reason, condition, block or subject without going
+through drop_log entry by entry or epoching again
+"""
+import itertools
+import numpy as np
+import pandas as pd
+
+_IGNORED = 'IGNORED'
+
+
+def drop_table(epochs, metadata=None, events=None, annotations=None, imp_onset=None,
+               subject=None, columns=('cond',)):
+    """
+    Table of every epoch and why it was dropped
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs (or EpochsArray) after dropping
+    metadata: pandas dataframe (None)
+        metadata passed to mne.Epochs, one row per event. without it the
+        columns of dropped epochs are NaN
+    events: array (None)
+        events passed to mne.Epochs. without it, onsets come from the
+        metadata 'onset' column (ms) or, for kept epochs only, epochs.events
+    annotations: mne.Annotations (None)
+        annotations of the raw file (onsets in seconds from the start of the
+        recording); the onset of the annotation that caused each drop is
+        looked up in them
+    imp_onset: list (None)
+        impedance onsets in seconds. epochs are numbered into blocks by the
+        impedance checks before them (0 before the first one)
+    subject: str (None)
+        added as a 'subject' column so tables of many subjects can be joined
+    columns: tuple (('cond',))
+        metadata columns copied into the table
+
+    Returns
+    -------
+    table: pandas dataframe with one row per epoch and drop reason (one row
+        with reason '' for kept epochs): subject, epoch, onset (s), the
+        metadata columns, block, dropped, reason and annotation_onset (s).
+        events mne ignored (not in event_id) are left out
+    """
+    drop_log = epochs.drop_log
+    n_epochs = len(drop_log)
+    sfreq = epochs.info['sfreq']
+    selection = np.asarray(epochs.selection)
+
+    onset = np.full(n_epochs, np.nan)
+    if events is not None:
+        onset = events[:, 0] / sfreq
+    elif metadata is not None and 'onset' in metadata:
+        onset = metadata['onset'].to_numpy(dtype=np.float64) * 0.001
+    else:
+        onset[selection] = epochs.events[:, 0] / sfreq
+
+    if metadata is None and epochs.metadata is not None:
+        metadata = epochs.metadata.reindex(columns=list(columns))
+        metadata.index = selection
+        metadata = metadata.reindex(np.arange(n_epochs))
+    per_epoch = pd.DataFrame(dict(epoch=np.arange(n_epochs), onset=onset))
+    for col in columns:
+        per_epoch[col] = metadata[col].to_numpy() if metadata is not None else np.nan
+    if imp_onset is not None:
+        per_epoch['block'] = np.searchsorted(np.sort(imp_onset), onset, side='right')
+    if subject is not None:
+        per_epoch.insert(0, 'subject', subject)
+
+    # one row per (epoch, reason) in a single pass over the drop log
+    n_reasons = np.fromiter((len(d) for d in drop_log), dtype=np.int64, count=n_epochs)
+    rows = np.repeat(np.arange(n_epochs), np.maximum(n_reasons, 1))
+    reasons = np.array(list(itertools.chain.from_iterable(d or ('',) for d in drop_log)), dtype=object)
+    table = per_epoch.iloc[rows].reset_index(drop=True)
+    table['dropped'] = n_reasons[rows] > 0
+    table['reason'] = reasons
+    table['annotation_onset'] = np.nan
+    if annotations is not None and len(annotations):
+        start = table['onset'].to_numpy() + epochs.tmin
+        stop = table['onset'].to_numpy() + epochs.tmax
+        for desc in np.unique(annotations.description):
+            sel = annotations.description == desc
+            table.loc[reasons == desc, 'annotation_onset'] = _overlapping_onset(
+                annotations.onset[sel], annotations.duration[sel],
+                start[reasons == desc], stop[reasons == desc])
+
+    ignored = np.isin(table['epoch'].to_numpy(), rows[reasons == _IGNORED])
+    table = table[~ignored].reset_index(drop=True)
+    table['reason'] = table['reason'].astype('category')
+    return table
+
+
+def update_table(table, epochs):
+    """
+    Add the drops of a later cleaning step (ie. autoreject) to the table of
+    the same epochs. epochs.drop_log still holds the earlier reasons, only
+    the new (epoch, reason) pairs are added
+
+    Returns
+    -------
+    table: a new pandas dataframe like 'drop_table'
+    """
+    drop_log = epochs.drop_log
+    n_reasons = np.fromiter((len(d) for d in drop_log), dtype=np.int64, count=len(drop_log))
+    rows = np.repeat(np.arange(len(drop_log)), n_reasons)
+    reasons = np.array(list(itertools.chain.from_iterable(drop_log)), dtype=object)
+    logged = pd.MultiIndex.from_arrays([table['epoch'].to_numpy(), table['reason'].astype(str).to_numpy()])
+    new = ~pd.MultiIndex.from_arrays([rows, reasons]).isin(logged) & (reasons != _IGNORED)
+    if not new.any():
+        return table
+    per_epoch = table.drop_duplicates('epoch').set_index('epoch', drop=False)
+    added = per_epoch.loc[rows[new]].reset_index(drop=True)
+    added['dropped'] = True
+    added['reason'] = reasons[new]
+    added['annotation_onset'] = np.nan
+    # epochs kept before and dropped now lose their '' row
+    kept = ~table['dropped'] & table['epoch'].isin(rows[new])
+    table = pd.concat([table[~kept].astype({'reason': str}), added], ignore_index=True)
+    table = table.sort_values('epoch', kind='stable').reset_index(drop=True)
+    table['reason'] = table['reason'].astype('category')
+    return table
+
+
+def drop_counts(table, by=None):
+    """
+    Drop counts of a 'drop_table' (or of several joined with pd.concat)
+
+    Parameters (defaults)
+    ---------------------
+    table: pandas dataframe from 'drop_table'
+    by: str or list (None)
+        columns to group by, ie. 'cond', 'block', 'subject' or
+        ['subject', 'cond']. one 'total' row if None
+
+    Returns
+    -------
+    counts: pandas dataframe with n_epochs, n_dropped, drop_rate (as
+        percentage, like Epochs.drop_log_stats) and one column per drop
+        reason with the number of epochs dropped for it
+    """
+    keys = ['subject', 'epoch'] if 'subject' in table else ['epoch']
+    table = table.assign(_all='total')
+    by = '_all' if by is None else by
+    epochs = table.drop_duplicates(keys)
+    grouped = epochs.groupby(by, observed=True)
+    counts = pd.DataFrame(dict(n_epochs=grouped.size(), n_dropped=grouped['dropped'].sum()))
+    counts['drop_rate'] = 100. * counts['n_dropped'] / counts['n_epochs']
+    dropped = table[table['dropped']]
+    if len(dropped):
+        reasons = pd.crosstab([dropped[b] for b in np.atleast_1d(by)],
+                              dropped['reason'].astype(str))
+        counts = counts.join(reasons).fillna(0)
+        counts[reasons.columns] = counts[reasons.columns].astype(np.int64)
+    if by == '_all':
+        counts.index.name = None
+    return counts
+
+
+def write_table(table, fname):
+    """
+    Write a drop table as fname.parquet, or fname.csv if pyarrow is missing
+
+    Returns
+    -------
+    fname: str, the written file
+    """
+    try:
+        table.to_parquet(fname + '.parquet')
+        return fname + '.parquet'
+    except ImportError:
+        table.to_csv(fname + '.csv', index=False)
+        return fname + '.csv'
+
+
+def read_tables(fnames):
+    """
+    Read and join drop tables written by 'write_table'
+    """
+    tables = [pd.read_parquet(f) if f.endswith('.parquet') else pd.read_csv(f, keep_default_na=False,
+                                                                           na_values=[''])
+              for f in fnames]
+    table = pd.concat(tables, ignore_index=True)
+    table['reason'] = table['reason'].fillna('').astype('category')
+    return table
+
+
+def _overlapping_onset(onset, duration, start, stop):
+    """
+    Onset of an annotation overlapping each (start, stop) period: the last
+    one starting before stop, if it has not ended before start. NaN if none
+    """
+    order = np.argsort(onset)
+    onset = onset[order]
+    offset = onset + duration[order]
+    i = np.searchsorted(onset, stop, side='right') - 1
+    found = (i >= 0) & (offset[np.maximum(i, 0)] >= start)
+    return np.where(found, onset[np.maximum(i, 0)], np.nan)
@@ -0,0 +1,360 @@
+"""
+Incremental data quality monitoring during acquisition. The netstation event
+log and the EGI raw file are followed while they grow, and each tick only
+parses the lines and samples appended since the previous tick: impedance
+windows, event dataframes, blink annotations and running drop rates are
+updated in O(new data)
+
+    session = synthetic.make_session(duration=600.)
+    monitor = RealtimeMonitor('live.raw', 'live_nsevent')
+    for elapsed in synthetic.simulate_acquisition('live.raw', 'live_nsevent', session, speed=1.):
+        status = monitor.tick()
+    monitor.tick(final=True)
+    print(monitor.stats())
+"""
+import dataclasses
+import io
+import os
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks
+import extract_nslog_event
+from event_schema import SFV_SCHEMA
+from intervals import Intervals
+from lowmem import read_egi_header
+from scipy_eog import eye_channel_pairs, merge_peaks
+
+
+class LogTail(object):
+    """
+    Follows a growing netstation event log. Each poll parses only the
+    complete lines appended since the previous poll
+
+    Parameters (defaults)
+    ---------------------
+    ns_eventlog: str
+        netstation event log file name
+    schema: EventSchema (SFV_SCHEMA)
+        description of the experiment's events
+    """
+    def __init__(self, ns_eventlog, schema=SFV_SCHEMA):
+        self.ns_eventlog = ns_eventlog
+        self.schema = schema
+        self.offset = 0
+        self.n_lines = 0
+
+    def poll(self):
+        """
+        Parse the new lines
+
+        Returns
+        -------
+        chunk: pandas dataframe like the chunks of 'iter_nslog' (the index
+            keeps counting lines), None if no complete line was added
+        """
+        if not os.path.exists(self.ns_eventlog):
+            return None
+        with open(self.ns_eventlog, 'rb') as fp:
+            fp.seek(self.offset)
+            text = fp.read()
+        # a partly written last line is left for the next poll
+        end = text.rfind(b'\n') + 1
+        if end == 0:
+            return None
+        self.offset += end
+        # the parser takes the number of fields from the first line; an empty
+        # first line lets it accept ragged lines as it does for the whole log
+        chunk = pd.read_csv(io.BytesIO(b'\n' + text[:end]), **self.schema.read_csv_kwargs())
+        chunk = chunk.iloc[1:]
+        chunk.index += self.n_lines - 1
+        self.n_lines += len(chunk)
+        chunk['onset'] = extract_nslog_event.timestamp_to_ms(chunk['onset'])
+        return chunk
+
+
+class RawTail(object):
+    """
+    Follows a growing EGI simple binary (.raw) file. Each poll reads only the
+    complete samples appended since the previous poll
+    """
+    def __init__(self, raw_fname):
+        self.raw_fname = raw_fname
+        self.header = None
+        self.n_read = 0
+
+    @property
+    def sfreq(self):
+        return float(self.header['sfreq'])
+
+    @property
+    def ch_names(self):
+        """eeg channels named like read_raw_egi, then one channel per event code"""
+        return (['E' + str(i + 1) for i in range(self.header['n_channels'])]
+                + self.header['event_codes'])
+
+    def poll(self, max_samples=None):
+        """
+        Read the new samples
+
+        Parameters (defaults)
+        ---------------------
+        max_samples: int (None)
+            read at most this many samples, the rest is left for later polls
+
+        Returns
+        -------
+        data: float array (n_channels + n_events, n_new), eeg in V, None if
+            no complete sample was added
+        """
+        if self.header is None:
+            self.header = read_egi_header(self.raw_fname)
+            if self.header is None:
+                return None
+        header = self.header
+        n_rows = header['n_channels'] + header['n_events']
+        frame = n_rows * header['dtype'].itemsize
+        n_new = (os.path.getsize(self.raw_fname) - header['offset']) // frame - self.n_read
+        if max_samples is not None:
+            n_new = min(n_new, max_samples)
+        if n_new <= 0:
+            return None
+        with open(self.raw_fname, 'rb') as fp:
+            fp.seek(header['offset'] + self.n_read * frame)
+            data = np.fromfile(fp, header['dtype'], n_new * n_rows)
+        data = data.reshape(n_new, n_rows).T.astype(np.float64)
+        data[:header['n_channels']] *= header['cal']
+        self.n_read += n_new
+        return data
+
+
+class RealtimeMonitor(object):
+    """
+    Incremental version of the event parsing, impedance, blink and epoch
+    rejection steps of walkthrough.py. Call `tick()` whenever new data may
+    have arrived; the results so far are in `events()`, `annotations()`,
+    `impedance_windows()` and `stats()`
+
+    Blinks are found like 'scipy_eog.find_eyeblinks' with chunks: samples
+    are final once min_dist newer samples have arrived. A trial is counted
+    once its epoch (tmin, tmax) is final; it is dropped if it overlaps an
+    impedance check or a blink annotation, as mne.Epochs would with
+    reject_by_annotation
+
+    Parameters (defaults)
+    ---------------------
+    raw_fname, ns_eventlog: str
+        the growing raw file and event log
+    eye_channels: str, tuple or list (('E8', 'E126'))
+        see 'scipy_eog.find_eyeblinks'
+    min_dist: int (100)
+        minimum distance in samples between two blinks
+    threshold: float (0.0001)
+        minimum blink peak height in V
+    eog_duration: float (0.1)
+        duration in seconds of each 'bad eye' annotation
+    tmin, tmax: float (-0.25, 0.8)
+        epoch limits around the trial onsets in seconds
+    max_samples: int (None)
+        most samples processed per tick, bounds the time a tick takes when
+        the monitor has fallen behind (the rest waits for the next ticks)
+    horizon: float (60.)
+        seconds of blinks kept to check trials whose log line arrives late
+    schema: EventSchema (SFV_SCHEMA)
+        description of the experiment's events
+    """
+    def __init__(self, raw_fname, ns_eventlog, eye_channels=('E8', 'E126'), min_dist=100,
+                 threshold=0.0001, eog_duration=0.1, tmin=-0.25, tmax=0.8, max_samples=None,
+                 horizon=60., schema=SFV_SCHEMA):
+        self.log = LogTail(ns_eventlog, schema)
+        self.raw = RawTail(raw_fname)
+        self.pairs = eye_channel_pairs(eye_channels)
+        self.min_dist = min_dist
+        self.threshold = threshold
+        self.eog_duration = eog_duration
+        self.tmin = tmin
+        self.tmax = tmax
+        self.max_samples = max_samples
+        self.horizon = horizon
+        self.schema = schema
+
+        self.type = None
+        self.lst_chunks = []
+        self.imp_onset = []
+        self.imp_offset = []
+        self.blinks = []
+        self.blink_heights = []
+        self._recent = np.zeros(0)
+        self._buffer = None
+        self._buffer_start = 0
+        self._done = 0
+        self._pending = np.zeros((0, 2))
+        self.trials = []
+        self.counts = {}
+
+    def tick(self, final=False):
+        """
+        Process what was appended since the last tick
+
+        Parameters (defaults)
+        ---------------------
+        final: bool (False)
+            the acquisition has ended: the last min_dist samples are final too
+
+        Returns
+        -------
+        status: dict with the seconds of data processed, the number of new
+            events, blinks and decided trials, and the running drop rate
+        """
+        n_events = self._update_events()
+        n_blinks = self._update_blinks(final)
+        n_trials = self._update_trials()
+        total = sum(c[0] for c in self.counts.values())
+        dropped = sum(c[1] for c in self.counts.values())
+        return dict(time=self._done / self.raw.sfreq if self.raw.header else 0.,
+                    new_events=n_events, new_blinks=n_blinks, new_trials=n_trials,
+                    n_trials=total, drop_rate=float(dropped) / total if total else np.nan)
+
+    def events(self):
+        """
+        Events of the schema codes so far, like 'create_df' but without the
+        expected count check
+
+        Returns
+        -------
+        tuple of df_lst and one pandas dataframe per schema code
+        """
+        schema = dataclasses.replace(self.schema, expected=dict.fromkeys(self.schema.expected))
+        return extract_nslog_event.split_lst(
+            extract_nslog_event.concat_events(self.lst_chunks, schema), schema)
+
+    def impedance_windows(self):
+        """
+        Impedance checks so far in seconds (see
+        'extract_nslog_event.match_impedances'). a check still going on (an
+        onset without offset) ends at np.inf
+
+        Returns
+        -------
+        imp_onset, imp_offset: float arrays
+        """
+        onset, offset, lone_onset, lone_offset, extra_onset = extract_nslog_event.match_impedances(
+            self.imp_onset, self.imp_offset)
+        if len(lone_onset):
+            onset = np.append(onset, lone_onset[0])
+            offset = np.append(offset, np.inf)
+        return onset * 0.001, offset * 0.001
+
+    def annotations(self, orig_time=None):
+        """
+        'bad imp' and 'bad eye' annotations of the data processed so far
+        """
+        import mne
+        onset, offset = self.impedance_windows()
+        offset = np.minimum(offset, self._done / self.raw.sfreq if self.raw.header else 0.)
+        blinks = np.concatenate(self.blinks or [np.zeros(0)])
+        return (mne.Annotations(onset, offset - onset, 'bad imp', orig_time=orig_time)
+                + mne.Annotations(blinks, self.eog_duration, 'bad eye', orig_time=orig_time))
+
+    def stats(self):
+        """
+        Running drop statistics of the decided trials
+
+        Returns
+        -------
+        stats: pandas dataframe with one row per condition and a 'total' row:
+            n_trials, n_dropped, bad_imp, bad_eye and drop_rate
+        """
+        columns = ['n_trials', 'n_dropped', 'bad_imp', 'bad_eye']
+        stats = pd.DataFrame.from_dict(self.counts, orient='index', columns=columns).sort_index()
+        stats.loc['total'] = stats.sum() if len(stats) else 0
+        stats['drop_rate'] = stats['n_dropped'] / stats['n_trials'].replace(0, np.nan)
+        stats.index.name = 'cond'
+        return stats
+
+    def _update_events(self):
+        chunk = self.log.poll()
+        if chunk is None:
+            return 0
+        schema = self.schema
+        if self.type is None and self.log.n_lines == len(chunk):
+            self.type = schema.version(str(chunk['code'].iloc[0]))
+        df_lst = extract_nslog_event.select_lst(chunk, schema)
+        if len(df_lst):
+            self.lst_chunks.append(df_lst)
+        if self.type is not None:
+            onset, offset = extract_nslog_event.impedance_events(chunk, self.type, schema)
+            self.imp_onset.extend(onset.tolist())
+            self.imp_offset.extend(offset.tolist())
+        trials = extract_nslog_event.create_df_onset(df_lst[df_lst['code'] == schema.trial_code], schema)
+        if len(trials):
+            new = np.column_stack([trials['onset'].to_numpy() * 0.001, trials['cond'].to_numpy()])
+            self._pending = np.concatenate([self._pending, new])
+        return len(df_lst)
+
+    def _update_blinks(self, final):
+        data = self.raw.poll(self.max_samples)
+        if self.raw.header is None:
+            return 0
+        if data is not None:
+            names = self.raw.ch_names
+            signals = np.array([data[names.index(a)] if c is None
+                                else data[names.index(a)] - data[names.index(c)]
+                                for a, c in self.pairs])
+            if self._buffer is None:
+                self._buffer = signals
+            else:
+                self._buffer = np.concatenate([self._buffer, signals], axis=1)
+        # a peak can still change until min_dist newer samples are in
+        stop = self.raw.n_read if final else self.raw.n_read - self.min_dist
+        if self._buffer is None or stop <= self._done:
+            return 0
+        start = self._done
+        samples = []
+        heights = []
+        for signal in self._buffer:
+            peaks, val = find_peaks(signal, height=self.threshold, distance=self.min_dist)
+            peaks = peaks + self._buffer_start
+            keep = (peaks >= start) & (peaks < stop)
+            samples.append(peaks[keep])
+            heights.append(val['peak_heights'][keep])
+        samples, heights = merge_peaks(np.concatenate(samples), np.concatenate(heights), self.min_dist)
+        self._done = stop
+        # keep min_dist samples of context before the next unprocessed sample
+        cut = max(stop - self.min_dist - self._buffer_start, 0)
+        self._buffer = self._buffer[:, cut:]
+        self._buffer_start += cut
+
+        onsets = samples / self.raw.sfreq
+        imp_onset, imp_offset = self.impedance_windows()
+        keep = ~Intervals(imp_onset, imp_offset).contains(onsets)
+        self.blinks.append(onsets[keep])
+        self.blink_heights.append(heights[keep])
+        now = self._done / self.raw.sfreq
+        self._recent = np.concatenate([self._recent[self._recent >= now - self.horizon], onsets[keep]])
+        return int(np.sum(keep))
+
+    def _update_trials(self):
+        if not len(self._pending) or self.raw.header is None:
+            return 0
+        now = self._done / self.raw.sfreq
+        ready = self._pending[:, 0] + self.tmax <= now
+        if not ready.any():
+            return 0
+        trials = self._pending[ready]
+        self._pending = self._pending[~ready]
+        start = trials[:, 0] + self.tmin
+        stop = trials[:, 0] + self.tmax
+        imp_onset, imp_offset = self.impedance_windows()
+        bad_imp = Intervals(imp_onset, imp_offset).overlaps(start, stop)
+        bad_eye = Intervals(self._recent, self._recent + self.eog_duration).overlaps(start, stop)
+        dropped = bad_imp | bad_eye
+        self.trials.append(pd.DataFrame(dict(onset=trials[:, 0], cond=trials[:, 1].astype(int),
+                                             bad_imp=bad_imp, bad_eye=bad_eye, dropped=dropped)))
+        for cond in np.unique(trials[:, 1]).astype(int):
+            sel = trials[:, 1] == cond
+            counts = self.counts.setdefault(cond, [0, 0, 0, 0])
+            counts[0] += int(sel.sum())
+            counts[1] += int(dropped[sel].sum())
+            counts[2] += int(bad_imp[sel].sum())
+            counts[3] += int(bad_eye[sel].sum())
+        return len(trials)
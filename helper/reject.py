@@ -0,0 +1,203 @@
+"""
+AutoReject with parallel threshold search, a smaller (n_interpolate,
+consensus) grid and reusable per-channel thresholds. The thresholds fit on
+one run are kept as a table (one row per subject and channel), from which an
+AutoReject can be rebuilt and applied to new epochs of the same subject, ie.
+with another tmin/tmax, without fitting again
+
+    ar = fit_autoreject(epochs, n_jobs=4, random_state=0)
+    write_thresholds(threshold_table(ar, epochs, 'sfv_eeg_011ts'), 'sfv_eeg_011ts_ar.csv')
+    ...
+    ar = from_thresholds(read_thresholds('sfv_eeg_011ts_ar.csv'), other_epochs)
+    epochs_clean = ar.transform(other_epochs)
+"""
+import numpy as np
+import pandas as pd
+
+# autoreject versions whose serialized state (AutoReject.__getstate__) 'from_thresholds' is known to match
+STATE_VERSIONS = ('0.4', '0.5')
+
+
+def reject_grid(n_channels, prior=None):
+    """
+    (n_interpolate, consensus) values to cross-validate. Every value of
+    n_interpolate costs an interpolation of all epochs, so instead of
+    autoreject's [1, 4, 32] the largest is a quarter of the channels (at most
+    32), and consensus values that cannot outvote the smallest n_interpolate
+    are left out (autoreject scores them inf anyway)
+
+    Parameters (defaults)
+    ---------------------
+    n_channels: int
+        number of channels autoreject is fit on
+    prior: (n_interpolate, consensus) (None)
+        values an earlier fit of the subject chose; only they and their
+        neighbours on the grid are tried
+
+    Returns
+    -------
+    n_interpolate, consensus: arrays
+    """
+    n_interpolate = np.unique([1, 4, max(4, min(32, n_channels // 4))])
+    n_interpolate = n_interpolate[n_interpolate < n_channels]
+    consensus = np.round(np.arange(1, 11) * 0.1, 1)
+    consensus = consensus[consensus * n_channels > n_interpolate.min()]
+    if prior is not None:
+        n_interpolate = _neighbours(n_interpolate, prior[0])
+        consensus = _neighbours(consensus, prior[1])
+    return n_interpolate, consensus
+
+
+def fit_autoreject(epochs, n_jobs=1, random_state=None, grid='adaptive', prior=None,
+                   thresh_method='bayesian_optimization', verbose=False):
+    """
+    Fit AutoReject with its per-channel threshold search run on n_jobs cores
+
+    Parameters (defaults)
+    ---------------------
+    epochs: mne.Epochs
+    n_jobs: int (1)
+        number of jobs of the threshold search
+    random_state: int (None)
+    grid: 'adaptive' or 'default' ('adaptive')
+        the (n_interpolate, consensus) grid of 'reject_grid', or autoreject's own
+    prior: (n_interpolate, consensus) (None)
+        see 'reject_grid', ie. from 'prior_of' of an earlier threshold table
+    thresh_method: str ('bayesian_optimization')
+        or 'random_search'
+    verbose: bool (False)
+
+    Returns
+    -------
+    ar: the fitted AutoReject
+    """
+    import mne
+    from autoreject import AutoReject
+    if grid == 'default':
+        n_interpolate, consensus = None, None
+    else:
+        picks = mne.pick_types(epochs.info, meg=True, eeg=True, exclude='bads')
+        n_interpolate, consensus = reject_grid(len(picks), prior)
+    print('fitting autoreject on ' + str(len(epochs)) + ' epochs...')
+    ar = AutoReject(n_interpolate=n_interpolate, consensus=consensus, n_jobs=n_jobs,
+                    random_state=random_state, thresh_method=thresh_method, verbose=verbose)
+    return ar.fit(epochs)
+
+
+def threshold_table(ar, epochs, subject=None):
+    """
+    Thresholds of a fitted AutoReject as a table
+
+    Returns
+    -------
+    table: pandas dataframe with one row per channel: subject, ch_name,
+        ch_type, threshold (peak-to-peak, in the unit of the data) and the
+        n_interpolate and consensus chosen for the channel type
+    """
+    ch_names = [epochs.ch_names[p] for p in ar.picks_]
+    ch_types = epochs.get_channel_types(picks=ar.picks_)
+    table = pd.DataFrame(dict(ch_name=ch_names, ch_type=ch_types))
+    table['threshold'] = [ar.threshes_[ch] for ch in ch_names]
+    table['n_interpolate'] = [int(ar.n_interpolate_[t]) for t in ch_types]
+    table['consensus'] = [float(ar.consensus_[t]) for t in ch_types]
+    if subject is not None:
+        table.insert(0, 'subject', subject)
+    return table
+
+
+def from_thresholds(table, epochs, subject=None, verbose=False):
+    """
+    Rebuild a fitted AutoReject from a threshold table, for epochs with the
+    channels it was fit on (their times may differ)
+
+    autoreject has no public way to build a fitted AutoReject from
+    thresholds, so its serialized state (what AutoReject.save writes and
+    read_auto_reject reads) is filled in and loaded with __setstate__. that
+    layout is the same in autoreject 0.4 and 0.5 (STATE_VERSIONS); other
+    versions get a warning, and a state that does not load back raises
+    instead of returning a half-fitted AutoReject
+
+    Parameters (defaults)
+    ---------------------
+    table: pandas dataframe from 'threshold_table' or 'read_thresholds'
+    epochs: mne.Epochs the AutoReject will be applied to
+    subject: str (None)
+        rows of this subject, if the table holds several
+
+    Returns
+    -------
+    ar: AutoReject ready for `ar.transform(epochs)`
+    """
+    import autoreject
+    from autoreject import AutoReject
+    if '.'.join(autoreject.__version__.split('.')[:2]) not in STATE_VERSIONS:
+        print('WARNING: from_thresholds was written for autoreject ' + ', '.join(STATE_VERSIONS)
+              + ', not ' + autoreject.__version__ + '; checking that the thresholds load')
+    if subject is not None:
+        table = table[table['subject'] == subject]
+    missing = set(table['ch_name']) - set(epochs.ch_names)
+    if missing:
+        raise ValueError('channels of the thresholds not in the epochs: ' + ', '.join(sorted(missing)))
+    picks = np.array(sorted(epochs.ch_names.index(ch) for ch in table['ch_name']))
+    types = np.array(epochs.get_channel_types(picks=picks))
+    by_type = table.groupby('ch_type', sort=False)
+    n_interpolate = dict((t, int(g['n_interpolate'].iloc[0])) for t, g in by_type)
+    consensus = dict((t, float(g['consensus'].iloc[0])) for t, g in by_type)
+    threshes = dict(zip(table['ch_name'], table['threshold'].astype(float)))
+
+    # autoreject's own serialized state (see AutoReject.__getstate__)
+    state = dict(consensus=sorted(set(consensus.values())),
+                 n_interpolate=sorted(set(n_interpolate.values())), picks=None,
+                 verbose=verbose, n_jobs=1, cv=10, random_state=None,
+                 thresh_method='bayesian_optimization', threshes_=threshes,
+                 n_interpolate_=n_interpolate, consensus_=consensus, dots=None, picks_=picks,
+                 loss_=dict(), local_reject_=dict())
+    for t in n_interpolate:
+        state['local_reject_'][t] = dict(consensus=consensus[t], n_interpolate=n_interpolate[t],
+                                         picks=picks[types == t], verbose=verbose,
+                                         threshes_=threshes, n_interpolate_={t: n_interpolate[t]},
+                                         consensus_={t: consensus[t]}, dots=None)
+    ar = AutoReject()
+    ar.__setstate__(state)
+    loaded = ar.__getstate__()
+    if (set(state) - set(loaded) or loaded.get('threshes_') != threshes
+            or set(getattr(ar, 'local_reject_', {})) != set(n_interpolate)):
+        raise ValueError('autoreject ' + autoreject.__version__ + ' did not load the thresholds (its state '
+                         'keys are ' + ', '.join(sorted(loaded)) + '), use autoreject '
+                         + ' or '.join(STATE_VERSIONS) + ' or fit again')
+    return ar
+
+
+def prior_of(table, subject=None):
+    """
+    (n_interpolate, consensus) of a threshold table, the 'prior' of 'fit_autoreject'
+    """
+    if subject is not None:
+        table = table[table['subject'] == subject]
+    return int(table['n_interpolate'].iloc[0]), float(table['consensus'].iloc[0])
+
+
+def write_thresholds(table, fname):
+    """
+    Write a threshold table (csv, it is small)
+    """
+    table.to_csv(fname, index=False)
+    return fname
+
+
+def read_thresholds(fnames):
+    """
+    Read and join threshold tables written by 'write_thresholds'
+    """
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    # round_trip so the thresholds are exactly the fitted ones
+    return pd.concat([pd.read_csv(f, float_precision='round_trip') for f in fnames], ignore_index=True)
+
+
+def _neighbours(grid, value):
+    """
+    value with the grid values next to it
+    """
+    i = int(np.argmin(np.abs(grid - value)))
+    return np.unique(np.r_[grid[max(i - 1, 0):i + 2], value])
@@ -1,11 +1,14 @@
 import mne
+import numpy as np
 from scipy.signal import find_peaks
 from scipy.signal import peak_prominences
+from intervals import Intervals
 
 # raw_fname   = '/Users/Jin/Documents/MATLAB/research/mne/sfv_eeg_011ts.raw'
 # ns_eventlog = '/Users/Jin/Documents/MATLAB/research/mne/sfv_eeg_011ts_nsevent'
 
-def scipy_annotate_eyeblinks(raw, eye_channel='EB', min_dist=100):
+def scipy_annotate_eyeblinks(raw, eye_channel='EB', min_dist=100, imp_onset=None, imp_offset=None,
+                             threshold=0.0001, duration=0.1, chunk_duration=None):
     """
     ***raw needs to be bipolar-referenced/or have specific eye channels
     finds local maximum peak points in the eye_channel and annotates on the raw file
@@ -14,66 +17,296 @@ def scipy_annotate_eyeblinks(raw, eye_channel='EB', min_dist=100):
     ---------------------
     raw: Raw object
         instance of raw file
-    eye_channel: str ('EB')
-        eye channel in string. Can be a virtual eye channel created from
-        mne.set_bipolar_reference
+    eye_channel: str, tuple or list ('EB')
+        eye channel(s), see 'find_eyeblinks'. Can be a virtual eye channel
+        created from mne.set_bipolar_reference
     min_dist: int (100)
-        minimum distance to search for another local maximum
-        peaks found within the next100 m/s range won't be considered peaks.
+        minimum distance in samples to search for another local maximum
+        peaks found within the next 100 samples won't be considered peaks.
         Use this to avoid finding excessive amount of peaks
+    imp_onset, imp_offset: list (None)
+        impedance onsets/offsets in seconds from 'find_impedances'.
+        eye blinks inside impedance periods are not annotated
+    threshold: float (0.0001)
+        minimum peak height in V
+    duration: float (0.1)
+        duration in seconds of each 'bad eye' annotation
+    chunk_duration: float (None)
+        see 'find_eyeblinks'
 
     Returns
     -------
     raw: Raw object
         the annotated raw file with local maximum peaks
     """
-
-    data, times = raw[raw.ch_names.index(eye_channel)]
-    # ie. data: array([[ 7.31836466e-19, -1.67314226e-07,  2.18515609e-07, ...,
-        # -1.38256900e-06, -7.66754021e-07, -2.03287907e-19]])
-
-    # peaks is the sample number of each peak and val creates dict of height vals
-    peaks, val = find_peaks(data[0], height=0, distance=100)
-    # ie. peaks
-    # array([      3,    1128,    1149, ..., 1028675, 1028693, 1028710])
-    # val
-    # {'peak_heights': array([9.50663807e-07, 1.42416676e-04, 4.91292689e-06, ...,
-       # 1.13145838e-06, 1.13396820e-06, 3.48277682e-06])}
-
-    # get the index number for vals that exceed the threshold
-    threshold_peak_indx = []
-    for i in range(0, len(val['peak_heights'])):
-        if val['peak_heights'][i] > 0.0001:
-            threshold_peak_indx.append(i)
-
-    # get the corresponding sample values from peaks
-    eb_samples = []
-    test_samp = []
-    val_samp = []
-    for i in threshold_peak_indx:
-        eb_samples.append(peaks[i])
-        test_samp.append(peaks[i])
-        val_samp.append(val['peak_heights'][i])
+    samples, heights = find_eyeblinks(raw, eye_channel, min_dist, threshold, chunk_duration)
 
     # convert to seconds
-    for i in range(0, len(eb_samples)):
-        eb_samples[i] = eb_samples[i]/float(200)
+    eb_onsets = samples / raw.info['sfreq']
 
     # filter out eye blinks marked in impedance periods
-    eb_samples_filtered = []
-    eb_samples_filtered_test = []
-    val_samp_filtered = []
-    for i in range(0, len(eb_samples)):
-        in_range = False
-        for j in range(0, len(imp_onset)):
-            if (imp_onset[j] <= eb_samples[i] <= imp_offset[j]):
-                in_range = True
-        if not in_range:
-            eb_samples_filtered.append(eb_samples[i])
-            eb_samples_filtered_test.append(test_samp[i])
-            val_samp_filtered.append(val_samp[i])
-
-    annot_eb = mne.Annotations(eb_samples_filtered, [0.1] * len(eb_samples_filtered), ["bad eye"] * len(eb_samples_filtered), orig_time = raw.info['meas_date'])
+    if imp_onset is not None:
+        eb_onsets = eb_onsets[~Intervals(imp_onset, imp_offset).contains(eb_onsets)]
+
+    annot_eb = mne.Annotations(eb_onsets, duration, 'bad eye', orig_time=raw.info['meas_date'])
     raw.set_annotations(annot_eb)
     print('new annotation set!')
     return raw
+
+
+def find_eyeblinks(raw, eye_channels='EB', min_dist=100, threshold=0.0001, chunk_duration=None):
+    """
+    Find eye blink peaks on one or more eye channels
+
+    Parameters (defaults)
+    ---------------------
+    raw: Raw object
+        instance of raw file, does not need to be preloaded
+    eye_channels: str, tuple or list ('EB')
+        a channel name, a (anode, cathode) pair of channel names that is
+        subtracted on the fly (ie. ('E8', 'E126')), or a list of either
+    min_dist: int (100)
+        minimum distance in samples between two peaks. peaks found on several
+        channels within min_dist of each other count as one blink
+    threshold: float (0.0001)
+        minimum peak height in V
+    chunk_duration: float (None)
+        if given, the data is read in chunks of this many seconds (overlapping
+        by min_dist samples) so a non-preloaded raw is never fully in memory
+
+    Returns
+    -------
+    samples: int array of blink peak samples, sorted
+    heights: float array of the corresponding peak heights
+    """
+    pairs = eye_channel_pairs(eye_channels)
+    names = sorted(set(ch for pair in pairs for ch in pair if ch is not None))
+    picks = [raw.ch_names.index(ch) for ch in names]
+    n_times = raw.n_times
+    if chunk_duration is None:
+        chunk = n_times
+    else:
+        chunk = max(int(round(chunk_duration * raw.info['sfreq'])), 1)
+
+    samples = []
+    heights = []
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        first = max(start - min_dist, 0)
+        last = min(stop + min_dist, n_times)
+        data = dict(zip(names, raw.get_data(picks=picks, start=first, stop=last)))
+        for anode, cathode in pairs:
+            signal = data[anode] if cathode is None else data[anode] - data[cathode]
+            # peaks is the sample number of each peak and val creates dict of height vals
+            peaks, val = find_peaks(signal, height=threshold, distance=min_dist)
+            peaks = peaks + first
+            # peaks in the overlap belong to the neighbouring chunk
+            keep = (peaks >= start) & (peaks < stop)
+            samples.append(peaks[keep])
+            heights.append(val['peak_heights'][keep])
+    return merge_peaks(np.concatenate(samples), np.concatenate(heights), min_dist)
+
+
+def merge_peaks(samples, heights, min_dist):
+    """
+    Merge peaks closer than min_dist samples (ie. the same blink seen on
+    several channels), keeping the highest peak of each group
+
+    Parameters
+    ----------
+    samples: int array of peak samples
+    heights: float array of peak heights
+    min_dist: int, minimum distance in samples between two blinks
+
+    Returns
+    -------
+    samples, heights: sorted arrays of the merged peaks
+    """
+    order = np.argsort(samples, kind='mergesort')
+    samples = samples[order]
+    heights = heights[order]
+    group = np.zeros(len(samples), dtype=np.int64)
+    group[1:] = np.cumsum(np.diff(samples) >= min_dist)
+    # highest peak first within each group, then take the first of each group
+    order = np.lexsort((-heights, group))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = group[order][1:] != group[order][:-1]
+    keep = np.sort(order[first])
+    return samples[keep], heights[keep]
+
+
+def eye_signals(raw, eye_channels='EB', chunk_duration=None):
+    """
+    Read eye channels (or (anode, cathode) pairs, see 'find_eyeblinks') into
+    float32 signals, chunk by chunk if chunk_duration is given
+
+    Returns
+    -------
+    signals: float32 array (n_pairs, n_times)
+    """
+    pairs = eye_channel_pairs(eye_channels)
+    names = sorted(set(ch for pair in pairs for ch in pair if ch is not None))
+    picks = [raw.ch_names.index(ch) for ch in names]
+    n_times = raw.n_times
+    chunk = n_times if chunk_duration is None else max(int(round(chunk_duration * raw.info['sfreq'])), 1)
+    signals = np.empty((len(pairs), n_times), dtype=np.float32)
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        data = dict(zip(names, raw.get_data(picks=picks, start=start, stop=stop)))
+        for i, (anode, cathode) in enumerate(pairs):
+            signals[i, start:stop] = data[anode] if cathode is None else data[anode] - data[cathode]
+    return signals
+
+
+def running_threshold(signal, sfreq, k=5., window=10., block_duration=0.5):
+    """
+    Robust running baseline and threshold of a signal: the median and MAD of
+    every block of block_duration seconds, each smoothed by a running median
+    over window seconds of blocks, so a few blinks do not move them
+
+    Returns
+    -------
+    baseline, threshold: float arrays (n_times,), threshold is k robust
+        standard deviations (1.4826 MAD) from the baseline
+    """
+    n_times = len(signal)
+    size = max(int(round(block_duration * sfreq)), 1)
+    n_blocks = int(np.ceil(n_times / float(size)))
+    # the last block is padded with its own values, which does not move its median much
+    blocks = np.pad(signal, (0, n_blocks * size - n_times), mode='edge').reshape(n_blocks, size)
+    median = np.median(blocks, axis=1)
+    mad = np.median(np.abs(blocks - median[:, np.newaxis]), axis=1)
+    width = max(int(round(window / block_duration)), 1) | 1
+    median = _running_median(median, width)
+    mad = _running_median(mad, width)
+    baseline = np.repeat(median, size)[:n_times]
+    threshold = np.repeat(k * 1.4826 * mad, size)[:n_times]
+    return baseline, threshold
+
+
+def find_eye_periods(raw, eye_channels='EB', k=5., window=10., block_duration=0.5, min_duration=0.02,
+                     merge_gap=0.1, pad=0.02, sign=0, chunk_duration=None):
+    """
+    Periods where any eye channel leaves its running baseline by more than
+    its adaptive threshold (see 'running_threshold'): blinks on the vertical
+    pair (upwards), saccades on the horizontal one (either way).
+    Each period lasts as long as the excursion instead of a fixed duration
+
+    Parameters (defaults)
+    ---------------------
+    raw: Raw object or lowmem.MmapRaw, does not need to be preloaded
+    eye_channels: str, tuple or list ('EB')
+        see 'find_eyeblinks'
+    k: float (5.)
+        threshold in robust standard deviations
+    window: float (10.)
+        seconds of the running median and MAD
+    block_duration: float (0.5)
+        seconds of the blocks the running statistics are made of
+    min_duration: float (0.02)
+        shorter excursions are left out (spikes)
+    merge_gap: float (0.1)
+        excursions closer than this are one period (ie. a blink and its rebound)
+    pad: float (0.02)
+        seconds added before and after each period
+    sign: int (0)
+        1 for excursions above the baseline only (ie. blinks on EB, leaving
+        out the filter's undershoot around them), -1 below only, 0 both
+    chunk_duration: float (None)
+        see 'eye_signals'
+
+    Returns
+    -------
+    onset, offset: float arrays of the merged periods in seconds from the
+        first sample, sorted and not overlapping
+    """
+    sfreq = raw.info['sfreq']
+    signals = eye_signals(raw, eye_channels, chunk_duration)
+    mask = np.zeros(signals.shape[1], dtype=bool)
+    for signal in signals:
+        baseline, threshold = running_threshold(signal, sfreq, k, window, block_duration)
+        deviation = signal - baseline
+        mask |= (deviation if sign > 0 else -deviation if sign < 0 else np.abs(deviation)) > threshold
+    # runs of samples above threshold, [start, stop)
+    edges = np.diff(np.concatenate([[0], mask.view(np.int8), [0]]))
+    start = np.flatnonzero(edges == 1)
+    stop = np.flatnonzero(edges == -1)
+    if len(start):
+        new = np.concatenate([[True], start[1:] - stop[:-1] > merge_gap * sfreq])
+        start, stop = start[new], stop[np.concatenate([new[1:], [True]])]
+        keep = stop - start >= min_duration * sfreq
+        start, stop = start[keep], stop[keep]
+    # padding can make neighbouring periods overlap; Intervals merges them
+    periods = Intervals(np.maximum(start / sfreq - pad, 0.), np.minimum(stop / sfreq + pad, signals.shape[1] / sfreq))
+    return periods.onset, periods.offset
+
+
+def eye_annotations(raw, eye_channels='EB', saccade_channels=None, imp_onset=None, imp_offset=None,
+                    orig_time=None, blink_sign=1, **kwargs):
+    """
+    'bad eye' (blink) and 'bad saccade' annotations of variable length from
+    'find_eye_periods', built in one go
+
+    Parameters (defaults)
+    ---------------------
+    raw: Raw object or lowmem.MmapRaw
+    eye_channels: str, tuple or list ('EB')
+        vertical eye channels, their periods are 'bad eye'
+    saccade_channels: str, tuple or list (None)
+        horizontal eye channels, ie. ('E125', 'E128'), their periods are
+        'bad saccade'
+    imp_onset, imp_offset: list (None)
+        impedance periods in seconds; eye periods overlapping them are left out
+    orig_time: (None)
+        orig_time of the annotations, ie. raw.info['meas_date']
+    blink_sign: int (1)
+        sign of the blinks on eye_channels (see 'find_eye_periods'), saccades
+        are found either way
+    **kwargs:
+        parameters of 'find_eye_periods'
+
+    Returns
+    -------
+    annotations: mne.Annotations
+    """
+    onsets, durations, descriptions = [], [], []
+    for channels, description, sign in [(eye_channels, 'bad eye', blink_sign),
+                                        (saccade_channels, 'bad saccade', 0)]:
+        if channels is None:
+            continue
+        onset, offset = find_eye_periods(raw, channels, sign=sign, **kwargs)
+        if imp_onset is not None and len(imp_onset):
+            keep = ~Intervals(imp_onset, imp_offset).overlaps(onset, offset)
+            onset, offset = onset[keep], offset[keep]
+        onsets.append(onset)
+        durations.append(offset - onset)
+        descriptions.append(np.repeat(description, len(onset)))
+        print(str(len(onset)) + ' ' + description + ' periods')
+    if not onsets:
+        return mne.Annotations([], [], [], orig_time=orig_time)
+    return mne.Annotations(np.concatenate(onsets), np.concatenate(durations), np.concatenate(descriptions),
+                           orig_time=orig_time)
+
+
+def eye_channel_pairs(eye_channels):
+    """
+    Normalize eye channel specs to a list of (anode, cathode or None) pairs
+    """
+    if isinstance(eye_channels, (str, tuple)):
+        eye_channels = [eye_channels]
+    pairs = []
+    for ch in eye_channels:
+        if isinstance(ch, tuple):
+            pairs.append(ch)
+        else:
+            pairs.append((ch, None))
+    return pairs
+
+
+def _running_median(values, width):
+    """
+    Centred running median of odd width, with the edges repeated
+    """
+    half = width // 2
+    padded = np.pad(values, half, mode='edge')
+    return np.median(np.lib.stride_tricks.sliding_window_view(padded, width), axis=1)
@@ -0,0 +1,246 @@
+"""
+Content-addressed on-disk cache for pipeline stages. A stage result is stored
+under a key made from the hashes of its input files, its parameters and the
+keys of the stages it depends on, so a stage is only recomputed when one of
+those changes. Entries are evicted least-recently-used once the cache grows
+past its size limit, except the ones used during the current run. Several
+processes can share a cache: every write is atomic (a temporary file or
+directory renamed into place)
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import pandas as pd
+
+_MANIFEST = 'manifest.json'
+_HASH_DIR = 'file_hashes'
+
+
+class StageCache(object):
+    """
+    Parameters (defaults)
+    ---------------------
+    cache_dir: str
+        directory of the cache, created if needed
+    max_bytes: int (20e9)
+        size limit of the cache; least recently used entries are removed
+        after each write until the cache fits
+    run_start: float (None)
+        time.time() the run started, ie. of a whole batch: entries used since
+        then (possibly by other workers) are never evicted. defaults to now
+    """
+    def __init__(self, cache_dir, max_bytes=20e9, run_start=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.run_start = time.time() if run_start is None else run_start
+        if not os.path.isdir(os.path.join(cache_dir, _HASH_DIR)):
+            os.makedirs(os.path.join(cache_dir, _HASH_DIR), exist_ok=True)
+
+    def key(self, stage, files=(), params=None, parents=()):
+        """
+        Cache key of a stage
+
+        Parameters (defaults)
+        ---------------------
+        stage: str
+            stage name
+        files: list of str (())
+            input files, hashed by content
+        params: dict (None)
+            stage parameters (must be json serializable, or have a str)
+        parents: list of str (())
+            keys of the stages this stage depends on
+
+        Returns
+        -------
+        key: str, sha1 hex digest
+        """
+        h = hashlib.sha1()
+        h.update(stage.encode())
+        for fname in files:
+            h.update(self.file_hash(fname).encode())
+        h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        for parent in parents:
+            h.update(parent.encode())
+        return h.hexdigest()
+
+    def file_hash(self, fname):
+        """
+        sha1 of a file's content. hashes are remembered by (path, size, mtime),
+        one small file per input so workers hashing other inputs never
+        overwrite each other, and large raw files are only read again when
+        they change
+        """
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        record = os.path.join(self.cache_dir, _HASH_DIR, hashlib.sha1(fname.encode()).hexdigest() + '.json')
+        try:
+            with open(record) as fp:
+                size, mtime, digest = json.load(fp)
+            if size == stat.st_size and mtime == stat.st_mtime:
+                return digest
+        except (OSError, ValueError):
+            pass
+        h = hashlib.sha1()
+        with open(fname, 'rb') as fp:
+            for block in iter(lambda: fp.read(8 * 1024 * 1024), b''):
+                h.update(block)
+        _write_json(record, (stat.st_size, stat.st_mtime, h.hexdigest()))
+        return h.hexdigest()
+
+    def get(self, stage, key):
+        """
+        Load a cached stage result, None if it is not in the cache
+        """
+        entry = self._entry_dir(stage, key)
+        manifest = os.path.join(entry, _MANIFEST)
+        try:
+            # touch the manifest first so eviction sees this entry as used in this run
+            os.utime(manifest, None)
+            with open(manifest) as fp:
+                files = json.load(fp)['files']
+            return _load(entry, files)
+        except (OSError, ValueError):
+            # not in the cache, or evicted by another process while being read
+            return None
+
+    def put(self, stage, key, value):
+        """
+        Store a stage result and evict old entries if the cache is too big
+        """
+        entry = self._entry_dir(stage, key)
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            files = _save(value, tmp, stage)
+            _write_json(os.path.join(tmp, _MANIFEST), dict(stage=stage, key=key, files=files,
+                                                           created=time.time()))
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # another worker stored the same entry first
+                pass
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=entry)
+        return value
+
+    def cached(self, stage, key, compute):
+        """
+        Return the cached result of a stage, or compute() and cache it
+        """
+        value = self.get(stage, key)
+        if value is not None:
+            print('using cached ' + stage + ' (' + key[:8] + ')')
+            return value
+        return self.put(stage, key, compute())
+
+    def entries(self):
+        """
+        List cache entries as (last used time, size in bytes, directory)
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            manifest = os.path.join(entry, _MANIFEST)
+            if name.startswith('.') or not os.path.exists(manifest):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(manifest), size, entry))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits max_bytes.
+        entries used since run_start are kept, even if the cache stays larger
+        """
+        entries = sorted(self.entries())
+        total = sum(size for used, size, entry in entries)
+        for used, size, entry in entries:
+            if total <= self.max_bytes or used >= self.run_start:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def _entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage + '-' + key)
+
+
+def cached(cache, stage, key, compute):
+    """
+    'StageCache.cached' that just computes when there is no cache (None)
+    """
+    if cache is None:
+        return compute()
+    return cache.cached(stage, key, compute)
+
+
+def _save(value, entry, name):
+    """
+    Save a value with the format that suits it: .fif for mne objects, .parquet
+    for dataframes (pickle if pyarrow is missing), and pickle for the rest.
+    dicts are saved entry by entry
+
+    Returns
+    -------
+    files: dict of name -> (file name, kind), or (file name, kind) if not a dict
+    """
+    if isinstance(value, dict):
+        return dict((k, _save(v, entry, name + '.' + k)) for k, v in value.items())
+    import mne
+    fname = os.path.join(entry, name)
+    if isinstance(value, mne.io.BaseRaw):
+        value.save(fname + '_raw.fif')
+        return (name + '_raw.fif', 'raw')
+    if isinstance(value, mne.BaseEpochs):
+        value.save(fname + '-epo.fif')
+        return (name + '-epo.fif', 'epochs')
+    if isinstance(value, mne.preprocessing.ICA):
+        value.save(fname + '-ica.fif')
+        return (name + '-ica.fif', 'ica')
+    if isinstance(value, pd.DataFrame):
+        try:
+            value.to_parquet(fname + '.parquet')
+            return (name + '.parquet', 'parquet')
+        except ImportError:
+            pass
+    with open(fname + '.pkl', 'wb') as fp:
+        pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    return (name + '.pkl', 'pickle')
+
+
+def _load(entry, files):
+    """
+    Load what '_save' wrote
+    """
+    if isinstance(files, dict):
+        return dict((k, _load(entry, v)) for k, v in files.items())
+    import mne
+    fname, kind = files
+    fname = os.path.join(entry, fname)
+    if kind == 'raw':
+        return mne.io.read_raw_fif(fname, preload=True)
+    if kind == 'epochs':
+        return mne.read_epochs(fname, preload=True)
+    if kind == 'ica':
+        return mne.preprocessing.read_ica(fname)
+    if kind == 'parquet':
+        return pd.read_parquet(fname)
+    with open(fname, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def _write_json(fname, obj):
+    """
+    Write json through a temporary file so readers never see half a file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(obj, fp)
+    os.replace(tmp, fname)
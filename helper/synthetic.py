@@ -0,0 +1,424 @@
+import numpy as np
+
+
+def format_timestamp(ms):
+    """
+    Convert milliseconds to netstation time stamp format '_HH:MM:SS:MMM'
+
+    Parameters
+    ----------
+    ms: int
+        time in milliseconds
+
+    Returns
+    -------
+    stamp: str
+    """
+    hh, ms = divmod(int(ms), 3600000)
+    mm, ms = divmod(ms, 60000)
+    ss, ms = divmod(ms, 1000)
+    return '_%02d:%02d:%02d:%03d' % (hh, mm, ss, ms)
+
+
+def nslog_events(n_plst=10, n_tlst=800, n_slst=200, n_imp=4, variant='ts', seed=0):
+    """
+    Create the ordered list of events of interest for a synthetic sfv session
+    Each impedance check (cal+) is followed by its jitr offset and one block of
+    sentence/trial events. plst trials are placed in the first block
+
+    Parameters (defaults)
+    ---------------------
+    n_plst, n_tlst, n_slst: int (10, 800, 200)
+        number of practice/trial/sentence events (onset + offset pairs)
+    n_imp: int (4)
+        number of impedance periods
+    variant: str ('ts')
+        version of the experiment, 'ts' or 'st'
+    seed: int (0)
+        seed for the random conditions
+
+    Returns
+    -------
+    events: list of (code, label, cond, indx) tuples
+    """
+    rng = np.random.RandomState(seed)
+    first_code = 'sntn' if variant == 'ts' else 'prac'
+    events = []
+    for b in range(n_imp):
+        events.append(('cal+', 'cal+', '0', '0'))
+        if b == 0:
+            events.append((first_code, 'jitr', '0', '0'))
+        else:
+            events.append(('tral', 'jitr', '0', str(b * 100)))
+        if b == 0:
+            for i in range(n_plst // 2):
+                events.append(('plst', 'lstS', '0', str(i)))
+                events.append(('plst', 'lstE', '0', str(i)))
+        for code, n in (('slst', n_slst), ('tlst', n_tlst)):
+            per_block = n // 2 // n_imp
+            extra = n // 2 - per_block * n_imp if b == n_imp - 1 else 0
+            for i in range(b * per_block, (b + 1) * per_block + extra):
+                cond = str(rng.randint(1, 5))
+                events.append((code, 'lstS', cond, str(i)))
+                events.append((code, 'lstE', cond, str(i)))
+    return events
+
+
+def write_nslog(fname, n_lines=100000, n_plst=10, n_tlst=800, n_slst=200,
+                n_imp=4, variant='ts', step_ms=5, seed=0):
+    """
+    Write a synthetic netstation event log (events export text)
+    The events of interest are spread evenly between filler events (DIN/fixation)
+    so the file can be grown to any length while keeping the sfv counts
+
+    Parameters (defaults)
+    ---------------------
+    fname: str
+        output file name
+    n_lines: int (100000)
+        total number of event lines (at least the number of events of interest)
+    n_plst, n_tlst, n_slst, n_imp, variant, seed:
+        see 'nslog_events'
+    step_ms: int (5)
+        time between two consecutive lines in ms
+
+    Returns
+    -------
+    fname: str
+    """
+    events = nslog_events(n_plst, n_tlst, n_slst, n_imp, variant, seed)
+    n_lines = max(n_lines, len(events))
+    positions = np.linspace(0, n_lines - 1, len(events)).astype(int)
+    special = dict(zip(positions, events))
+    rows = []
+    for i in range(n_lines):
+        if i in special:
+            rows.append((1000 + i * step_ms,) + special[i])
+        elif i % 2:
+            rows.append((1000 + i * step_ms, 'DIN1', 'DIN1', '0', '0'))
+        else:
+            rows.append((1000 + i * step_ms, 'tral', 'fixS', '0', '0'))
+    return _write_rows(fname, rows, variant)
+
+
+def _write_rows(fname, rows, variant):
+    """
+    Write (ms, code, label, cond, indx) rows in the netstation export format
+    """
+    with open(fname, 'w') as fp:
+        fp.write(_log_header(variant))
+        for row in rows:
+            fp.write(_log_line(*row))
+    return fname
+
+
+def _log_header(variant):
+    return ('sfv_eeg_999' + variant + '\n'
+            + 'Code\tLabel\tType\tSource\tOnset\tDuration\tKey#1\tValue#1\tKey#2\tValue#2\n')
+
+
+def _log_line(ms, code, label, cond, indx):
+    return '\t'.join([code, label, 'Stimulus Event', 'Multi-Port STIM', format_timestamp(ms),
+                      '_00:00:00:001', 'cond', cond, 'indx', indx]) + '\t\n'
+
+
+# kinds of bad channels 'make_session' can simulate
+BAD_KINDS = ('flat', 'noisy', 'line', 'uncorrelated')
+# relative size of a blink on the channels around the eyes of a 128 channel
+# GSN-HydroCel net (above the eyes positive, below negative)
+BLINK_WEIGHTS = {'E8': 1., 'E14': .6, 'E21': .6, 'E25': .8, 'E126': -.5, 'E127': -.5}
+# a saccade to one side moves the outer canthi channels in opposite directions
+SACCADE_WEIGHTS = {'E125': 1., 'E128': -1.}
+STIM_CODES = ['plst', 'slst', 'tlst']
+
+
+def make_session(duration=600., sfreq=250, n_channels=129, n_plst=10, n_tlst=800, n_slst=200,
+                 n_imp=4, imp_duration=10., n_blinks=None, variant='ts', seed=0, bad_channels=None, n_saccades=0):
+    """
+    Lay out a synthetic sfv session in time: the events of 'nslog_events' are
+    split in n_imp blocks, each starting with an impedance check of
+    imp_duration seconds followed by its trials, and blinks are placed at
+    random. The result describes both the recording ('write_egi_raw',
+    'make_raw') and its event log ('write_session_nslog')
+
+    Parameters (defaults)
+    ---------------------
+    duration: float (600.)
+        length of the recording in seconds
+    sfreq: int (250)
+        sampling rate
+    n_channels: int (129)
+        number of eeg channels, named E1..En like read_raw_egi does
+    n_plst, n_tlst, n_slst, n_imp, variant, seed:
+        see 'nslog_events'
+    imp_duration: float (10.)
+        length of each impedance check in seconds
+    n_blinks: int (None)
+        number of blinks, one every 4 seconds if None
+    bad_channels: dict (None)
+        channel name -> one of BAD_KINDS: 'flat' (all zero), 'noisy' (50 uV
+        extra white noise), 'line' (20 uV of 60 Hz) or 'uncorrelated'
+        (6 uV white noise instead of the shared signals)
+    n_saccades: int (0)
+        number of looks to the side and back (0.4 s, 50 uV steps of random
+        sign on the channels of SACCADE_WEIGHTS), placed at random
+
+    Returns
+    -------
+    session: dict with the events as (ms, code, label, cond, indx) tuples,
+        their samples, imp_onset/imp_offset, blinks and saccades in seconds
+        (saccade_signs, +-1), and the recording parameters
+    """
+    events = nslog_events(n_plst, n_tlst, n_slst, n_imp, variant, seed)
+    blocks = np.cumsum([code == 'cal+' for code, label, cond, indx in events]) - 1
+    block_len = float(duration) / n_imp
+    times = np.zeros(len(events))
+    for b in range(n_imp):
+        idx = np.flatnonzero(blocks == b)
+        start = b * block_len + 1.
+        # cal+, its jitr offset, then the trials spread over the rest of the block
+        times[idx[0]] = start
+        times[idx[1]] = start + imp_duration
+        times[idx[2:]] = np.linspace(start + imp_duration + 1., (b + 1) * block_len - 1., len(idx) - 2)
+    ms = np.round(times * 1000).astype(int)
+    samples = np.round(ms * (sfreq / 1000.)).astype(int)
+    if np.any(np.diff(samples) < 2):
+        raise ValueError('too many events for ' + str(duration) + ' s at ' + str(sfreq) + ' Hz')
+
+    rng = np.random.RandomState(seed)
+    if n_blinks is None:
+        n_blinks = int(duration // 4)
+    imp = np.array([t for t, (code, label, cond, indx) in zip(times, events) if code == 'cal+'])
+    # saccades draw from their own generator, so the blinks do not change
+    saccade_rng = np.random.RandomState(seed + 3)
+    saccades = np.sort(saccade_rng.uniform(0.5, duration - 1., n_saccades))
+    return dict(events=[(m,) + e for m, e in zip(ms, events)], samples=samples,
+                imp_onset=imp, imp_offset=imp + imp_duration,
+                blinks=np.sort(rng.uniform(0.5, duration - 0.5, n_blinks)),
+                saccades=saccades, saccade_signs=saccade_rng.choice([-1, 1], n_saccades),
+                duration=float(duration), sfreq=sfreq, n_channels=n_channels,
+                n_samples=int(round(duration * sfreq)), variant=variant, seed=seed,
+                bad_channels=dict(bad_channels or {}),
+                stim_codes=[c for c in STIM_CODES if any(e[0] == c for e in events)])
+
+
+def write_session_nslog(fname, session, n_lines=None):
+    """
+    Write the event log of a session from 'make_session'
+
+    Parameters (defaults)
+    ---------------------
+    fname: str
+        output file name
+    session: dict from 'make_session'
+    n_lines: int (None)
+        total number of lines; DIN/fixation filler events are spread over the
+        session to reach it. no fillers if None
+
+    Returns
+    -------
+    fname: str
+    """
+    rows = list(session['events'])
+    n_filler = max(0, (n_lines or 0) - len(rows))
+    filler_ms = np.linspace(0, session['duration'] * 1000, n_filler, endpoint=False).astype(int)
+    rows += [(ms, 'DIN1', 'DIN1', '0', '0') if i % 2 else (ms, 'tral', 'fixS', '0', '0')
+             for i, ms in enumerate(filler_ms)]
+    order = np.argsort([row[0] for row in rows], kind='stable')
+    return _write_rows(fname, [rows[i] for i in order], session['variant'])
+
+
+def iter_session_data(session, chunk_duration=10.):
+    """
+    Generate the recording of a session chunk by chunk: 5 uV white noise, a
+    10 Hz rhythm and a slow drift on every channel, 150 uV blinks on the
+    channels of BLINK_WEIGHTS, 50 uV saccades on those of SACCADE_WEIGHTS, 200 uV noise during impedance checks, and one
+    sample pulses on a stim channel per code of STIM_CODES at its events
+
+    Yields
+    ------
+    data: float32 array (n_channels + n_stim, n_samples in chunk), eeg in uV
+    """
+    sfreq = float(session['sfreq'])
+    n_channels = session['n_channels']
+    stim_codes = session['stim_codes']
+    rng = np.random.RandomState(session['seed'] + 1)
+    weights = np.zeros(n_channels, 'float32')
+    for name, weight in BLINK_WEIGHTS.items():
+        if int(name[1:]) <= n_channels:
+            weights[int(name[1:]) - 1] = weight
+    blinks = np.round(session['blinks'] * sfreq).astype(int)
+    half = int(0.25 * sfreq)
+    template = 150 * np.exp(-0.5 * (np.arange(-half, half + 1) / (0.05 * sfreq)) ** 2)
+    saccade_weights = np.zeros(n_channels, 'float32')
+    for name, weight in SACCADE_WEIGHTS.items():
+        if int(name[1:]) <= n_channels:
+            saccade_weights[int(name[1:]) - 1] = weight
+    saccades = np.round(session.get('saccades', np.zeros(0)) * sfreq).astype(int)
+    saccade_signs = session.get('saccade_signs', np.zeros(0))
+    saccade_len = int(0.4 * sfreq)
+    codes = np.array([e[1] for e in session['events']])
+    # bad channels draw from their own generator, so the other channels do not change
+    bad_rng = np.random.RandomState(session['seed'] + 2)
+    bads = [(int(name[1:]) - 1, kind) for name, kind in session['bad_channels'].items()]
+    for i, kind in bads:
+        if kind not in BAD_KINDS:
+            raise ValueError('unknown bad channel kind ' + str(kind))
+    step = int(chunk_duration * sfreq)
+    for start in range(0, session['n_samples'], step):
+        stop = min(start + step, session['n_samples'])
+        t = np.arange(start, stop) / sfreq
+        data = np.zeros((n_channels + len(stim_codes), stop - start), 'float32')
+        eeg = data[:n_channels]
+        eeg += 5 * rng.standard_normal(eeg.shape)
+        eeg += 5 * np.sin(2 * np.pi * 10 * t) + 20 * np.sin(2 * np.pi * 0.1 * t)
+
+        blink = np.zeros(stop - start)
+        for center in blinks[(blinks + half >= start) & (blinks - half < stop)]:
+            lo, hi = max(center - half, start), min(center + half + 1, stop)
+            blink[lo - start:hi - start] += template[lo - center + half:hi - center + half]
+        eeg += weights[:, None] * blink
+
+        if len(saccades):
+            look = np.zeros(stop - start)
+            hit = (saccades + saccade_len > start) & (saccades < stop)
+            for onset, sign in zip(saccades[hit], saccade_signs[hit]):
+                look[max(onset, start) - start:min(onset + saccade_len, stop) - start] += 50 * sign
+            eeg += saccade_weights[:, None] * look
+
+        imp = np.zeros(stop - start, bool)
+        for onset, offset in zip(session['imp_onset'], session['imp_offset']):
+            imp[(t >= onset) & (t < offset)] = True
+        eeg[:, imp] += 200 * rng.standard_normal((n_channels, imp.sum()))
+
+        for i, kind in bads:
+            if kind == 'flat':
+                eeg[i] = 0
+            elif kind == 'noisy':
+                eeg[i] += 50 * bad_rng.standard_normal(stop - start)
+            elif kind == 'line':
+                eeg[i] += 20 * np.sin(2 * np.pi * 60 * t)
+            else:
+                eeg[i] = 6 * bad_rng.standard_normal(stop - start)
+
+        for i, code in enumerate(stim_codes):
+            samples = session['samples'][codes == code]
+            samples = samples[(samples >= start) & (samples < stop)]
+            data[n_channels + i, samples - start] = 1
+        yield data
+
+
+def write_egi_raw(fname, session, chunk_duration=10.):
+    """
+    Write the recording of a session from 'make_session' as an EGI simple
+    binary (.raw) file that mne.io.read_raw_egi reads, chunk by chunk so long
+    recordings do not have to fit in memory
+
+    Returns
+    -------
+    fname: str
+    """
+    with open(fname, 'wb') as fp:
+        _write_egi_header(fp, session)
+        for data in iter_session_data(session, chunk_duration):
+            data.T.astype('>f4').tofile(fp)
+    return fname
+
+
+def _write_egi_header(fp, session):
+    """
+    EGI simple binary header, version 4: unsegmented float32. bits and range 0
+    mean the data is in uV
+    """
+    np.array([4], '>i4').tofile(fp)
+    np.array([2019, 1, 1, 0, 0, 0], '>i2').tofile(fp)
+    np.array([0], '>i4').tofile(fp)
+    np.array([session['sfreq'], session['n_channels'], 0, 0, 0], '>i2').tofile(fp)
+    np.array([session['n_samples']], '>i4').tofile(fp)
+    np.array([len(session['stim_codes'])], '>i2').tofile(fp)
+    for code in session['stim_codes']:
+        fp.write(code[:4].ljust(4).encode())
+
+
+def make_raw(session):
+    """
+    The recording of a session from 'make_session' as an in-memory RawArray
+    (eeg in V, one stim channel per code of STIM_CODES)
+    """
+    import mne
+    data = np.concatenate(list(iter_session_data(session)), axis=1).astype(float)
+    n_channels = session['n_channels']
+    data[:n_channels] *= 1e-6
+    ch_names = ['E' + str(i + 1) for i in range(n_channels)] + session['stim_codes']
+    ch_types = ['eeg'] * n_channels + ['stim'] * len(session['stim_codes'])
+    info = mne.create_info(ch_names, session['sfreq'], ch_types)
+    return mne.io.RawArray(data, info)
+
+
+def write_session(raw_fname, ns_eventlog, n_lines=None, chunk_duration=10., **kwargs):
+    """
+    Write a synthetic EGI recording and its matching netstation event log
+
+    Parameters (defaults)
+    ---------------------
+    raw_fname, ns_eventlog: str
+        output file names
+    n_lines: int (None)
+        number of lines of the event log, see 'write_session_nslog'
+    chunk_duration: float (10.)
+        seconds of data generated at once
+    **kwargs:
+        passed to 'make_session'
+
+    Returns
+    -------
+    session: dict from 'make_session'
+    """
+    session = make_session(**kwargs)
+    write_egi_raw(raw_fname, session, chunk_duration)
+    write_session_nslog(ns_eventlog, session, n_lines)
+    return session
+
+
+def simulate_acquisition(raw_fname, ns_eventlog, session, chunk_duration=1., speed=None):
+    """
+    Stand-in for the amplifier and netstation during a session: writes the
+    EGI raw file and the event log of a session from 'make_session' by
+    appending chunk_duration seconds of data, and the events up to then, at
+    each step. Iterate over it to advance the acquisition
+
+    Parameters (defaults)
+    ---------------------
+    raw_fname, ns_eventlog: str
+        files to write, truncated first
+    session: dict from 'make_session'
+    chunk_duration: float (1.)
+        seconds of data appended per step
+    speed: float (None)
+        if given, sleep so the data arrives speed times faster than real time
+        (1. is real time). no sleeping if None
+
+    Yields
+    ------
+    elapsed: float, seconds of data written so far
+    """
+    import time
+    events = session['events']
+    sfreq = float(session['sfreq'])
+    next_event = 0
+    n_written = 0
+    with open(raw_fname, 'wb') as raw_fp, open(ns_eventlog, 'w') as log_fp:
+        _write_egi_header(raw_fp, session)
+        log_fp.write(_log_header(session['variant']))
+        for data in iter_session_data(session, chunk_duration):
+            t0 = time.time()
+            data.T.astype('>f4').tofile(raw_fp)
+            raw_fp.flush()
+            n_written += data.shape[1]
+            while next_event < len(events) and events[next_event][0] < n_written / sfreq * 1000:
+                log_fp.write(_log_line(*events[next_event]))
+                next_event += 1
+            log_fp.flush()
+            if speed:
+                time.sleep(max(0., data.shape[1] / sfreq / speed - (time.time() - t0)))
+            yield n_written / sfreq
@@ -5,30 +5,52 @@ import matplotlib
 from matplotlib import pyplot as plt
 from mne.preprocessing import eog
 from mne.preprocessing import create_eog_epochs
-import Tkinter
 import os
 import sys
 sys.path.append(os.getcwd() + '/helper')
+import bad_channels
+import epoch_store
+import erp_export
 import extract_nslog_event
+import features
+import grand_average
+import ica_sweep
+import meta_index
+import qc
+import reject
 import scipy_eog
+from pipeline import GRAND_PARAMS
+from pipeline_config import PipelineConfig, check_subject, load_config
 
 ###########################################
 #       Setup and Basic Preprocessing     #
 ###########################################
+# all settings below (data directory, channels, filter band, epoch window, ICA) come from a config file
+# run as `python walkthrough.py config.toml` (see config.example.toml), or without one for the defaults
+# a wrong setting is reported here, before the raw file is read
+cfg = load_config(sys.argv[1]) if len(sys.argv) > 1 else PipelineConfig()
+
 # specify sample subject data directory
-raw_fname   = '/Users/Jin/Documents/MATLAB/research/mne-egi/data/sfv_eeg_011ts.raw'
-ns_eventlog = '/Users/Jin/Documents/MATLAB/research/mne-egi/data/sfv_eeg_011ts_nsevent'
+subject = 'sfv_eeg_011ts'
+raw_fname   = os.path.join(cfg.data_dir, subject + '.raw')
+ns_eventlog = os.path.join(cfg.data_dir, subject + '_nsevent')
+# check that the eye channels, the event code and the montage exist in the recording
+check_subject(cfg, raw_fname, ns_eventlog)
+if not os.path.isdir(cfg.out_dir):
+    os.makedirs(cfg.out_dir)
 
 # specify sub-sample of channels to look in detail
 # note that 'EB' is a newly created channel name for 'eye blink' using bipolar reference
-selection = ['EB','E11','E24','E124','E36','E104','E52','E62','E92']
+selection = cfg.selection
 
 # let's read in the raw file
 # you can specify montage (see MNE website for available montages)
 # we set `preload=True` because some of the preprocessing functions require raw file to be preloaded
 print('reading raw file...')
-raw = mne.io.read_raw_egi(raw_fname, montage='GSN-HydroCel-128', preload=True)
+raw = mne.io.read_raw_egi(raw_fname, montage=cfg.montage, preload=True)
 print('Done!')
+# for long recordings that do not fit in memory, helper/lowmem.py converts the raw file into a
+# memory-mapped float32 copy that is filtered and epoched chunk by chunk (see `make_epochs_lowmem` in helper/pipeline.py)
 
 # in HydroCel GSN model caps:
 # eye blink channels are (right, left): E8, E126, E25, E127
@@ -37,8 +59,15 @@ print('Done!')
 # raw = mne.io.read_raw_egi(raw_fname, montage='GSN-HydroCel-128', eog=['E8', 'E126', 'E25', 'E127'], preload=True)
 # you can check by raw.plot_sensors()
 
+# bad channels can also be detected from the data (see helper/bad_channels.py): flat channels, channels with outlying
+# amplitude or high-frequency noise, and channels that hardly correlate with their neighbours on the montage
+# this looks at the unfiltered data, so it runs before the filter
+if cfg.auto_bads:
+    bads_table = bad_channels.find_bad_channels(raw, z_thresh=cfg.bads_z_thresh, corr_thresh=cfg.bads_corr_thresh)
+    print(bads_table[bads_table['bad']])
+
 # apply bandpass filter to raw file(highpass, lowpass)
-raw.filter(1,30)
+raw.filter(cfg.l_freq, cfg.h_freq)
 # show raw summary
 raw.info
 
@@ -47,21 +76,25 @@ raw.info
 ###########################################
 # the below codes use custom codes created specifically for the experiment
 # create pandas data frames for different tasks
-nsdata, df_lst, df_plst, df_tlst, df_slst = extract_nslog_event.create_df(ns_eventlog)
+nsdata, df_lst, df_plst, df_tlst, df_slst = extract_nslog_event.create_df(ns_eventlog, cfg.schema())
 
 # you can see how the data is cleaned from the events-exported text file by:
 # show sample line of event of 10th item
-nsdata[10]
+nsdata.iloc[10]
 # show data frame structure of 3rd index
 df_tlst.iloc[3]
 
 # create onset-only data frame (event tag specifications)
-df_tlstS = extract_nslog_event.create_df_onset(df_tlst)
+df_tlstS = extract_nslog_event.create_df_onset(df_tlst, cfg.schema())
 # show total events of interest
 len(df_tlstS)
 
 # find impedance onsets
-imp_onset, imp_offset, imp_dur = extract_nslog_event.find_impedances(nsdata)
+imp_onset, imp_offset, imp_dur = extract_nslog_event.find_impedances(nsdata, cfg.schema())
+# the whole event log is not needed after this point
+del nsdata
+# for very long recordings, the steps above can be done in chunks without holding the whole log in memory:
+# df_lst, df_plst, df_tlst, df_slst, df_tlstS, imp_onset, imp_offset, imp_dur = extract_nslog_event.create_df_chunked(ns_eventlog, schema=cfg.schema())
 
 # annotate on raw with 'bad' tags
 # params `reject_by_annotation` will search for 'bad' tags later
@@ -75,7 +108,10 @@ raw.set_annotations(annot_imp)
 # raw.plot(bad_color='red', block=True)
 
 # or if you already know/or want to skip the plot part, you can specify more directly
-raw.info['bads'] = ['E128', 'E127', 'E107', 'E56', 'E57', 'E18', 'E49', 'E48', 'E115', 'E113', 'E122', 'E121', 'E123', 'E124', 'E108', 'E63', 'E1', 'E32', 'E33']
+raw.info['bads'] = list(cfg.bads)
+# with auto_bads in the config, the detected channels are added (an empty `bads` list then replaces the one above)
+if cfg.auto_bads:
+    raw.info['bads'] += [ch for ch in bad_channels.bad_names(bads_table) if ch not in raw.info['bads']]
 
 
 ###########################################
@@ -84,9 +120,9 @@ raw.info['bads'] = ['E128', 'E127', 'E107', 'E56', 'E57', 'E18', 'E49', 'E48', '
 # let's begin eye artifact detections
 print('Starting EOG artifact detection')
 # specify the eye channels (here I used the right side of eye channels)
-# `set_bipolar_reference` will use the two channels 'E8' and 'E126' to create a virtual eye channel 'EB'
+# `set_bipolar_reference` will use the two channels (cfg.eog_anode, cfg.eog_cathode: 'E8' and 'E126') to create a virtual eye channel 'EB'
 # it is basically a subtraction between the two
-raw = mne.set_bipolar_reference(raw, ['E8'],['E126'],['EB'])
+raw = mne.set_bipolar_reference(raw, [cfg.eog_anode], [cfg.eog_cathode], ['EB'])
 # specify this as the eye channel
 # note that when you specify none-eog specific channels as 'eog' channels, these channels will potentially
 # contain partial scalp data of frontal brain/etc
@@ -94,19 +130,24 @@ raw.set_channel_types({'EB': 'eog'})
 
 # we have the option to use mne built-in function to find peaks or use custom built eog function using scipy
 # both result in similar eye blink detections
-events_eog = eog.find_eog_events(raw, reject_by_annotation=True, thresh=0.0001, verbose=None)
-# raw = scipy_annotate_eyeblinks(raw, 'EB', 100)
-
-# `events_eog` above will give where the eye blinks occured in samples
-# we will convert the sample number to seconds so we can annotate on the raw file
-
-# get just the sample numbers from the eog events
-eog_sampleN = [i[0] for i in events_eog]
-# convert to seconds for annotation-friendly purposes
-for i in range(0, len(eog_sampleN)):
-    eog_sampleN[i] = eog_sampleN[i] / float(200)
-
-annot_eog = mne.Annotations(eog_sampleN, [0.1] * len(eog_sampleN), ["bad eye"] * len(eog_sampleN), orig_time = raw.info['meas_date'])
+if cfg.eog_method == 'adaptive':
+    # or, instead of one fixed threshold and fixed-length annotations: mark every excursion above a running
+    # median + cfg.eog_k robust standard deviations (MAD) of the last cfg.eog_window s, as long as it lasts.
+    # blinks on 'EB' become 'bad eye', looks to the side on the horizontal pair
+    # cfg.saccade_anode/cfg.saccade_cathode (ie. E125, E128, if set) 'bad saccade'
+    saccades = None if cfg.saccade_anode is None else (cfg.saccade_anode, cfg.saccade_cathode)
+    annot_eog = scipy_eog.eye_annotations(raw, 'EB', saccades, imp_onset, imp_offset, orig_time=raw.info['meas_date'],
+                                          k=cfg.eog_k, window=cfg.eog_window)
+else:
+    events_eog = eog.find_eog_events(raw, reject_by_annotation=True, thresh=cfg.eog_thresh, verbose=None)
+    # raw = scipy_eog.scipy_annotate_eyeblinks(raw, 'EB', 100, imp_onset=imp_onset, imp_offset=imp_offset)
+    # the scipy version also takes several eye channels or channel pairs at once, ie. [('E8', 'E126'), ('E25', 'E127')]
+
+    # `events_eog` above will give where the eye blinks occured in samples
+    # we will convert the sample numbers (first column) to seconds so we can annotate on the raw file
+    # (event samples count from the start of the acquisition, annotation onsets from the start of raw)
+    eog_onset = (events_eog[:, 0] - raw.first_samp) / raw.info['sfreq']
+    annot_eog = mne.Annotations(eog_onset, cfg.eog_duration, "bad eye", orig_time=raw.info['meas_date'])
 
 # add this eye blink annotation to the previous annotation by simply adding
 new_annot = annot_imp + annot_eog
@@ -125,15 +166,17 @@ raw.set_eeg_reference('average', projection=True)
 #            Creating Epochs              #
 ###########################################
 # update event ids in mne events array and double check sampling onset timing as sanity check
-events_tlst = mne.find_events(raw, stim_channel='tlst')
+events_tlst = mne.find_events(raw, stim_channel=cfg.stim_channel)
 # events_tlst is a array structure ie.  (1, 0, 1) and so far, the all the event tags are 1
 # which is not true. We will update the event tags with 1s and 2s with custom built function
-events_tlstS = extract_nslog_event.assign_event_id(df_tlst, events_tlst)
+events_tlstS = extract_nslog_event.assign_event_id(df_tlst, events_tlst, raw.info['sfreq'], cfg.schema())
+# keep only the onsets: df_tlstS (the metadata) has one row per onset
+events_tlstS = extract_nslog_event.find_onsets(events_tlstS)
 
 # epoching initially with metadata applied
-event_id_tlst = dict(lstS=1)
-tmin = -0.25  # start of each epoch
-tmax = 0.8  # end of each epoch
+event_id_tlst = cfg.event_id
+tmin = cfg.tmin  # start of each epoch
+tmax = cfg.tmax  # end of each epoch
 # set baseline to 0
 baseline = (tmin, 0)
 
@@ -149,18 +192,27 @@ print('epochs_tlstS:')
 print(epochs_tlstS)
 
 # show drop percentage from mne.Epochs
-drop_count = 0
-for j in range(0, len(epochs_tlstS.drop_log)):
-    if 'bad eye' in epochs_tlstS.drop_log[j]:
-        drop_count += 1
-print(str(drop_count) + ' epochs dropped by eog annotation')
-print('perecentage dropped: ' + str(epochs_tlstS.drop_log_stats()))
-
-# create evoked respone using pandas query based on metadata created from previous epochs
-evoked_tlst_c1 = epochs_tlstS["label=='lstS' and cond=='1'"].average()
-evoked_tlst_c2 = epochs_tlstS["label=='lstS' and cond=='2'"].average()
-evoked_tlst_c3 = epochs_tlstS["label=='lstS' and cond=='3'"].average()
-evoked_tlst_c4 = epochs_tlstS["label=='lstS' and cond=='4'"].average()
+# the drop log is turned into a table once: one row per epoch and drop reason,
+# with its condition, block (number of impedance checks before it) and the
+# onset of the annotation that dropped it
+drops = qc.drop_table(epochs_tlstS, df_tlstS, annotations=raw.annotations, imp_onset=imp_onset)
+# drop counts per reason, ie. 'bad eye' is the number of epochs dropped by eog annotation
+print(qc.drop_counts(drops))
+# or per condition/block
+print(qc.drop_counts(drops, 'cond'))
+print(qc.drop_counts(drops, 'block'))
+# qc.write_table(drops, 'sfv_eeg_011ts_drops') saves it to compare subjects later
+
+# create evoked respone using queries on the metadata created from previous epochs
+# `epochs_tlstS["label=='lstS' and cond==1"].average()` would run a pandas query and copy the epochs for every
+# subset; the metadata index answers the same queries from precomputed bitmaps with the epoch positions,
+# and meta_index.average averages them without a copy. combine with or/in/not, ie. "cond in (1, 2) and indx==300"
+meta = meta_index.MetadataIndex(epochs_tlstS.metadata)
+evoked_tlst_c1 = meta_index.average(epochs_tlstS, meta.query("label=='lstS' and cond==1"))
+evoked_tlst_c2 = meta_index.average(epochs_tlstS, meta.query("label=='lstS' and cond==2"))
+evoked_tlst_c3 = meta_index.average(epochs_tlstS, meta.query("label=='lstS' and cond==3"))
+evoked_tlst_c4 = meta_index.average(epochs_tlstS, meta.query("label=='lstS' and cond==4"))
+# epochs_tlstS[meta.query(...)] still gives an Epochs subset where one is needed
 
 
 ###########################################
@@ -174,14 +226,18 @@ evoked_tlst_c4 = epochs_tlstS["label=='lstS' and cond=='4'"].average()
 # let's first apply independent component analysis (ICA) on the epochs to filter out bad ICs
 from autoreject import get_rejection_threshold
 # the function calculates for optimal reject threshold for ICA
-reject = get_rejection_threshold(epochs_tlstS)
+reject = get_rejection_threshold(epochs_tlstS, random_state=cfg.random_state)
 
 from mne.preprocessing import ICA
-# For simplicity/time sake, we will specify n_components as 20
+# For simplicity/time sake, we will specify n_components as 20 (cfg.ica_n_components)
 # ICA can create up to as many electrodes you have
-ica = ICA(n_components=20, max_pca_components=None, n_pca_components=None, noise_cov=None, random_state=None, method='fastica', fit_params=None, max_iter=200, verbose=None)
+ica = ICA(n_components=cfg.ica_n_components, max_pca_components=None, n_pca_components=None, noise_cov=None, random_state=cfg.random_state, method=cfg.ica_method, fit_params=None, max_iter=cfg.ica_max_iter, verbose=None)
 print('fitting ica...')
 ica.fit(epochs_tlstS, reject=reject)
+# to compare several numbers of components (or random states/methods) instead of re-fitting one at a time,
+# fit them all on one shared PCA and look at their fit time and eog scores:
+# icas, ica_report = ica_sweep.sweep_ica(epochs_tlstS, n_components=[15, 20, 25], random_states=[0, 1], decim=2)
+# print(ica_report)
 
 # inspect by ICA correlation
 # the mne-built in function can suggest what bad components are using the eog channels
@@ -206,43 +262,62 @@ print('number of ICs dropped: ' + str(len(ica.exclude)))
 from autoreject import AutoReject
 ar = AutoReject()
 epochs_clean = ar.fit_transform(epochs_tlstS)
+# autoreject is the slowest step; its threshold search can run on several cores and the fitted thresholds
+# can be kept, so re-epoching with another tmin/tmax does not need to fit again:
+# ar = reject.fit_autoreject(epochs_tlstS, n_jobs=4)
+# reject.write_thresholds(reject.threshold_table(ar, epochs_tlstS, 'sfv_eeg_011ts'), 'sfv_eeg_011ts_ar.csv')
+# ar = reject.from_thresholds(reject.read_thresholds('sfv_eeg_011ts_ar.csv'), epochs_tlstS)
 
 # you can manually check the differences
 epochs_clean.plot()
 
 # now let's create a new evoked responses (ie. the autoreject evoked)
-arevoked_tlst_c1 = epochs_clean["label=='lstS' and cond=='1'"].average()
-arevoked_tlst_c2 = epochs_clean["label=='lstS' and cond=='2'"].average()
-arevoked_tlst_c3 = epochs_clean["label=='lstS' and cond=='3'"].average()
-arevoked_tlst_c4 = epochs_clean["label=='lstS' and cond=='4'"].average()
+# all four conditions are averaged in one pass over the epochs, the same as
+# epochs_clean["cond==1"].average() and so on
+evoked_dict = erp_export.grouped_evokeds(epochs_clean, cfg.conditions)
+arevoked_tlst_c1 = evoked_dict['highcosval']
+arevoked_tlst_c2 = evoked_dict['lowcosval']
+arevoked_tlst_c3 = evoked_dict['highcosinval']
+arevoked_tlst_c4 = evoked_dict['lowcosinval']
+
+# for group ERPs, fold this subject into a running grand average on disk instead of keeping every
+# subject's evoked responses: grand.evokeds() gives the grand averages (and the cfg.erp_contrasts
+# differences) at any time, grand.evokeds('sem') their standard errors and grand.tmap(...) t-maps.
+# with the settings' digest, as in the pipeline, a grand average made with other settings starts over
+if cfg.grand_average:
+    grand = grand_average.GrandAverage(os.path.join(cfg.out_dir, 'grand_average.npz'), cfg.erp_contrasts,
+                                       cfg.digest(GRAND_PARAMS))
+    grand.add(subject, evoked_dict)
+    grand.save()
+
+# for group analysis, keep the mean amplitude of every trial and channel in a few time windows
+# (cfg.feature_windows) with its cond/indx/label; all subjects go to one Parquet dataset that can be
+# read back by channel, window and condition, ie. features.read_features('features', windows=['n400'])
+features.write_features(features.trial_features(epochs_clean, cfg.feature_windows, subject=subject),
+                        os.path.join(cfg.out_dir, 'features'))
+
+# to come back to the cleaned epochs later (or to many subjects' epochs at once) without loading them,
+# write them to an on-disk store: float32, gzip-compressed in chunks of trials, with their metadata.
+# condition subsets are then read and averaged one chunk at a time (epoch_store = true in the config)
+if cfg.epoch_store:
+    epoch_store.write_epochs(epochs_clean, os.path.join(cfg.out_dir, subject, subject + '-epo'))
+    store = epoch_store.EpochStore(os.path.join(cfg.out_dir, subject, subject + '-epo'))
+    store_evokeds = store.evokeds(cfg.conditions)       # the same as evoked_dict
+    n400 = store.get_data(store.query("cond in (1, 2)"), picks=['E62', 'E72'])
+    store.close()
 
 
 ###########################################
 #   Plotting Event-Related Potentials     #
 ###########################################
-picks_select = mne.pick_types(epochs_clean.info, meg=False, eeg=True, eog=True, stim=False, exclude='bads', selection=selection)
-
-evoked_dict = {'highcosval': arevoked_tlst_c1,
-                'lowcosval': arevoked_tlst_c2,
-                'highcosinval': arevoked_tlst_c3,
-                'lowcosinval': arevoked_tlst_c4}
-
 picks_select = mne.pick_types(arevoked_tlst_c1.info, meg=False, eeg=True, eog=True, stim=False, exclude='bads', selection=selection)
 
-
-# this will plot each selected channel with comparison of two conditions
-title = '%s_vs_%s_E%s.png'
-for i in range(0, len(picks_select)):
-    fig1 = mne.viz.plot_compare_evokeds({'highcos/val':evoked_dict['highcosval'], 'lowcos/val':evoked_dict['lowcosval']}, picks=picks_select[i], show=False)
-    fig2 = mne.viz.plot_compare_evokeds({'highcos/inval':evoked_dict['highcosinval'], 'lowcos/inval':evoked_dict['lowcosinval']}, picks=picks_select[i], show=False)
-    fig3 = mne.viz.plot_compare_evokeds({'highcos/val':evoked_dict['highcosval'], 'highcos/inval':evoked_dict['highcosinval']},picks=picks_select[i], show=False)
-    fig4 = mne.viz.plot_compare_evokeds({'lowcos/val':evoked_dict['lowcosval'],'lowcos/inval':evoked_dict['lowcosinval']}, picks=picks_select[i], show=False)
-
-    # save figs
-    fig1.savefig(title % (evoked_dict.keys()[0], evoked_dict.keys()[1], i))
-    fig2.savefig(title % (evoked_dict.keys()[2], evoked_dict.keys()[3], i))
-    fig3.savefig(title % (evoked_dict.keys()[0], evoked_dict.keys()[2], i))
-    fig4.savefig(title % (evoked_dict.keys()[1], evoked_dict.keys()[3], i))
+# this will plot each selected channel with comparison of two conditions:
+# highcos/val vs lowcos/val, highcos/inval vs lowcos/inval, highcos/val vs highcos/inval
+# and lowcos/val vs lowcos/inval, 8 channels per page, into one pdf (use a .png
+# name to get one figure sheet per page instead). n_jobs renders the pages in
+# worker processes, but only from a script guarded by if __name__ == '__main__'
+erp_export.export_erps(evoked_dict, os.path.join(cfg.out_dir, subject + '-erp.pdf'), cfg.erp_contrasts, picks=picks_select, n_jobs=1)
 
 
 # this will plot just the evoked responses per conditions with all channels